@@ -4,7 +4,7 @@ import sys
 import traceback
 import logging
 import datetime
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Request, render_template, request, jsonify, send_file
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import cv2  # اختياري (غير مستخدم مباشرةً، إبقاؤه لا يضر)
@@ -14,19 +14,38 @@ import psutil
 import tempfile
 import shutil
 import subprocess
+import signal
+import fcntl
 import json
-from celery import Celery
+import hashlib
+import math
+import re
+import collections
+import contextlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from celery import Celery, chord
+from celery.exceptions import Ignore
+from celery.signals import worker_process_init, celeryd_after_setup, worker_ready, worker_shutdown, task_postrun
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['Retry-After'])  # يقرأه عميل الرفع المجزأ لإعادة الإنهاء
 
 # المتغيرات البيئية
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', '/data/uploads')
 app.config['OUTPUT_FOLDER'] = os.environ.get('OUTPUT_FOLDER', '/data/outputs')
+app.config['CACHE_FOLDER'] = os.environ.get('CACHE_FOLDER', '/data/cache')
 app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 500 * 1024 * 1024))  # 500MB كحد أقصى
 
+# طوابير Celery حسب نوع المهمة حتى لا تنتظر المقاطع القصيرة خلف الترميزات الطويلة
+QUEUE_EXPRESS = 'express'  # مقاطع قصيرة (حتى EXPRESS_MAX_DURATION ثانية)
+QUEUE_BULK = 'bulk'        # مدخلات طويلة وأجزاء الترميز الموزع
+QUEUE_MERGE = 'merge'      # دمج أكثر من فيديو
+EXPRESS_MAX_DURATION = float(os.getenv('EXPRESS_MAX_DURATION', '180'))
+
 # إعداد Celery محسن للموثوقية والأداء
 def make_celery(app):
     redis_url = os.environ.get("REDIS_URL", "redis://redis:6379/0")
@@ -53,6 +72,12 @@ def make_celery(app):
         },
         'task_soft_time_limit': int(os.getenv("TASK_SOFT_TIME_LIMIT", str(5*3600))),  # 5 ساعات
         'task_time_limit': int(os.getenv("TASK_TIME_LIMIT", str(6*3600))),  # 6 ساعات
+        # أجزاء الترميز الموزع عمل طويل: تُنفذ على عمال طابور bulk
+        'task_routes': {
+            'app.encode_chunk_task': {'queue': QUEUE_BULK},
+            'app.join_chunks_task': {'queue': QUEUE_BULK},
+            'app.cleanup_chunks_task': {'queue': QUEUE_BULK},
+        },
     }
     
     celery = Celery(app.import_name, **celery_config)
@@ -166,6 +191,10 @@ def log_detailed_error(error, context="Unknown", extra_data=None):
 # إنشاء المجلدات المطلوبة
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+OUTRO_CACHE_FOLDER = os.path.join(app.config['CACHE_FOLDER'], 'outro')
+os.makedirs(OUTRO_CACHE_FOLDER, exist_ok=True)
+WATERMARK_CACHE_FOLDER = os.path.join(app.config['CACHE_FOLDER'], 'watermark')
+os.makedirs(WATERMARK_CACHE_FOLDER, exist_ok=True)
 
 # مسارات الملفات الثابتة
 ASSETS_FOLDER = 'assets'
@@ -188,6 +217,128 @@ ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
+# استقبال الرفع بالبث: كل ملف يُكتب مباشرة داخل مجلد المشروع أثناء قراءة الطلب
+# (بدل ملف Werkzeug المؤقت ثم نسخه بـ save)، مع SHA-256 وحد الحجم وفحص بصمة الحاوية
+UPLOAD_MAX_FILE_SIZE = app.config['MAX_CONTENT_LENGTH']
+CONTAINER_MAGIC_BYTES = 512
+MP4_BOX_TYPES = (b'ftyp', b'moov', b'mdat', b'free', b'wide', b'skip', b'pnot')
+
+class UploadRejected(Exception):
+    """رفض الرفع أثناء الاستقبال (الحجم، نوع الحاوية، أو المساحة الحرة)"""
+    def __init__(self, message, status=400, decision=None):
+        super().__init__(message)
+        self.status = status
+        self.decision = decision  # قرار defer من التحكم في القبول (429)
+
+def detect_container(head):
+    """نوع الحاوية من أول البايتات، أو None إذا لم تكن حاوية فيديو معروفة"""
+    if len(head) >= 8 and head[4:8] in MP4_BOX_TYPES:
+        return 'mp4'  # MP4 / MOV
+    if head.startswith(b'\x1a\x45\xdf\xa3'):
+        return 'matroska'  # MKV / WebM
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return 'avi'
+    if head.startswith(b'FLV'):
+        return 'flv'
+    if head.startswith(b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'):
+        return 'asf'  # WMV
+    if head[:1] == b'\x47' and (len(head) <= 188 or head[188:189] == b'\x47'):
+        return 'mpegts'
+    if head.startswith(b'\x00\x00\x01\xba'):
+        return 'mpeg'
+    return None
+
+class IngestFile:
+    """
+    ملف رفع يُكتب في path أثناء تحليل الطلب: يحسب SHA-256، يرفض تجاوز max_size،
+    ويفحص بصمة الحاوية بمجرد وصول أول CONTAINER_MAGIC_BYTES بايت.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.file = open(path, 'w+b')
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.container = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise UploadRejected(
+                f'حجم الفيديو كبير جداً. الحد الأقصى {self.max_size // (1024 * 1024)}MB', 413)
+        if self.container is None:
+            self.head += data[:CONTAINER_MAGIC_BYTES - len(self.head)]
+            if len(self.head) >= CONTAINER_MAGIC_BYTES:
+                self.check_container()
+        self.sha256.update(data)
+        return self.file.write(data)
+
+    def check_container(self):
+        self.container = detect_container(self.head)
+        if self.container is None:
+            raise UploadRejected('محتوى الملف ليس فيديو بصيغة مدعومة')
+
+    def finish(self):
+        """إغلاق الملف (مع فحص البصمة للملفات الأقصر من CONTAINER_MAGIC_BYTES)"""
+        self.file.close()
+        if self.container is None:
+            self.check_container()
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class IngestRequest(Request):
+    """طلب Flask يوجه ملفات /upload إلى IngestFile داخل مجلد مشروع الطلب"""
+    ingest_project_id = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'upload_video' or not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if not allowed_file(filename, ALLOWED_EXTENSIONS):
+            raise UploadRejected(f'صيغة الفيديو غير مدعومة: {filename}')
+        if self.ingest_project_id is None:
+            # المساحة الحرة تُفحص قبل كتابة أي بايت (الطول الكلي للطلب معروف من الترويسة)
+            disk_decision = check_disk_admission(total_content_length)
+            if disk_decision:
+                raise UploadRejected(disk_decision['reason'], 429, disk_decision)
+            self.ingest_project_id = str(uuid.uuid4())
+            os.makedirs(self.ingest_project_folder, exist_ok=True)
+        part_path = os.path.join(self.ingest_project_folder, f'.ingest-{uuid.uuid4().hex}.part')
+        return IngestFile(part_path, UPLOAD_MAX_FILE_SIZE)
+
+    @property
+    def ingest_project_folder(self):
+        if self.ingest_project_id is None:
+            return None
+        return os.path.join(app.config['UPLOAD_FOLDER'], self.ingest_project_id)
+
+app.request_class = IngestRequest
+
+def save_ingested_file(file_storage, project_folder):
+    """
+    نقل ملف الرفع إلى اسمه النهائي داخل مجلد المشروع (إعادة تسمية بدون نسخة ثانية)
+    وتسجيل SHA-256 المحسوب أثناء الاستقبال حتى لا يُقرأ الملف مرة أخرى.
+    """
+    path = os.path.join(project_folder, secure_filename(file_storage.filename))
+    stream = file_storage.stream
+    if isinstance(stream, IngestFile):
+        stream.finish()
+        os.replace(stream.path, path)
+        prime_file_hash(path, stream.sha256.hexdigest())
+    else:
+        file_storage.save(path)
+    return path
+
+def discard_upload():
+    """حذف ما استُقبل من ملفات هذا الطلب (عند رفضه)"""
+    if request.ingest_project_folder:
+        shutil.rmtree(request.ingest_project_folder, ignore_errors=True)
+
+def reject_upload(message, status=400):
+    discard_upload()
+    return jsonify({'error': message}), status
+
 def get_video_info(video_path):
     """الحصول على معلومات الفيديو باستخدام FFprobe"""
     try:
@@ -195,7 +346,7 @@ def get_video_info(video_path):
             'ffprobe', '-v', 'quiet', '-print_format', 'json',
             '-show_format', '-show_streams', video_path
         ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = run_ffmpeg(cmd, timeout=FFPROBE_TIMEOUT)
         if result.returncode == 0:
             info = json.loads(result.stdout)
             return info
@@ -204,55 +355,516 @@ def get_video_info(video_path):
         print(f"❌ خطأ في الحصول على معلومات الفيديو [ID: {error_id}]: {e}")
     return None
 
-def get_nvenc_encoder():
+# أقل فاصل زمني (ثانية) بين تحديثات التقدم المنشورة عبر update_state
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', '2'))
+# حجم ما يُحتفظ به من stderr لكل أمر FFmpeg (آخر N كيلوبايت + أسطر الأخطاء)
+FFMPEG_LOG_TAIL_KB = int(os.getenv('FFMPEG_LOG_TAIL_KB', '64'))
+FFMPEG_LOG_MAX_ERROR_LINES = 200
+FFMPEG_LOG_MAX_ERROR_KB = int(os.getenv('FFMPEG_LOG_MAX_ERROR_KB', '16'))
+FFMPEG_LOG_MAX_LINE = 2048  # أطول سطر يُحتفظ به (حرف)، الباقي يُقص
+FFMPEG_ERROR_PATTERN = re.compile(
+    r'error|invalid|failed|no such file|not found|unsupported|corrupt|cannot|could not|denied',
+    re.IGNORECASE
+)
+
+def _utf8_len(text):
+    return len(text.encode('utf-8', 'replace'))
+
+class StderrRingBuffer:
     """
-    تحديد دعم h264_nvenc مع فحص أعمق للتأكد من عمل NVENC فعلياً
-    يعاد 'h264_nvenc' أو None إذا غير مدعوم.
+    حلقة محدودة الحجم لمخرجات stderr: آخر FFMPEG_LOG_TAIL_KB كيلوبايت
+    بالإضافة إلى الأسطر المطابقة لأنماط الأخطاء (حتى FFMPEG_LOG_MAX_ERROR_KB)، مهما طال تشغيل FFmpeg.
+    الأسطر تُقرأ بحد FFMPEG_LOG_MAX_LINE (readline(limit))، وبقية السطر الطويل تُهمل.
     """
+    def __init__(self, max_bytes=None, max_error_lines=FFMPEG_LOG_MAX_ERROR_LINES, max_error_bytes=None,
+                 max_line=FFMPEG_LOG_MAX_LINE):
+        self.max_bytes = max_bytes or FFMPEG_LOG_TAIL_KB * 1024
+        self.max_error_bytes = max_error_bytes or FFMPEG_LOG_MAX_ERROR_KB * 1024
+        self.max_line = max_line
+        self.lines = collections.deque()
+        self.size = 0
+        self.error_lines = collections.deque(maxlen=max_error_lines)
+        self.error_size = 0
+        self.dropped_lines = 0
+        self.truncating = False  # نحن داخل بقية سطر طويل قُص أوله
+
+    def append(self, line):
+        if self.truncating:
+            self.truncating = not line.endswith('\n')
+            return
+        if len(line) >= self.max_line and not line.endswith('\n'):
+            line = f"{line[:self.max_line]} [...]\n"
+            self.truncating = True
+        if FFMPEG_ERROR_PATTERN.search(line):
+            if len(self.error_lines) == self.error_lines.maxlen:
+                self.error_size -= _utf8_len(self.error_lines[0])
+            self.error_lines.append(line.rstrip('\n'))
+            self.error_size += _utf8_len(self.error_lines[-1])
+            while self.error_size > self.max_error_bytes and len(self.error_lines) > 1:
+                self.error_size -= _utf8_len(self.error_lines.popleft())
+        self.lines.append(line)
+        self.size += _utf8_len(line)
+        while self.size > self.max_bytes and len(self.lines) > 1:
+            self.size -= _utf8_len(self.lines.popleft())
+            self.dropped_lines += 1
+
+    def text(self):
+        tail = ''.join(self.lines)
+        if not self.dropped_lines:
+            return tail
+        return f"[... {self.dropped_lines} سطر محذوف ...]\n{tail}"
+
+# إلغاء المهام: علامة في Redis يراها العامل أثناء الترميز فيقتل مجموعة عمليات FFmpeg
+CANCEL_KEY_PREFIX = 'cancel:'
+CANCEL_KEY_TTL = 24 * 3600
+CANCEL_CHECK_INTERVAL = 1.0  # ثانية بين فحوصات العلامة لكل مهمة
+
+class JobCancelled(Exception):
+    """أُلغيت المهمة من المستخدم أثناء المعالجة"""
+
+_redis_client = None
+
+def get_redis_client():
+    """اتصال Redis مشترك (نفس REDIS_URL المستخدم لـ Celery)"""
+    global _redis_client
+    if _redis_client is None:
+        from redis import Redis
+        redis_url = os.environ.get("REDIS_URL", "redis://redis:6379/0")
+        _redis_client = Redis.from_url(redis_url, socket_connect_timeout=2, socket_timeout=2)
+    return _redis_client
+
+def request_job_cancel(job_id):
+    """تعليم المهمة كملغاة حتى يراها العامل الذي يعالجها"""
+    get_redis_client().set(f'{CANCEL_KEY_PREFIX}{job_id}', '1', ex=CANCEL_KEY_TTL)
+
+def is_job_cancelled(job_id):
+    if not job_id:
+        return False
     try:
-        # فحص أولي للـ encoders
-        res = subprocess.run(['ffmpeg', '-encoders'], capture_output=True, text=True)
-        if res.returncode != 0:
-            return None
-        encs = res.stdout
-        
-        # نستخدم h264_nvenc فقط للسرعة القصوى
-        if 'h264_nvenc' in encs:
-            # فحص إضافي للتأكد من عمل NVENC فعلياً
+        return bool(get_redis_client().exists(f'{CANCEL_KEY_PREFIX}{job_id}'))
+    except Exception as e:
+        logger.debug(f"⚠️ تعذر فحص علامة الإلغاء: {e}")
+        return False
+
+class FFmpegJob:
+    """
+    سياق أوامر FFmpeg لمهمة واحدة:
+    - تجميع التقدم (من مخرجات -progress) وتحويله إلى نسبة مئوية حقيقية وETA،
+      مع نشرها عبر update_state بمعدل محدود. كل أمر يُسجل بمفتاح ومدة متوقعة
+      حتى يمكن جمع أجزاء متوازية.
+    - سجل أخطاء FFmpeg (ذيل stderr المحدود) لحفظه في سجل خطأ المهمة.
+    - فحص علامة الإلغاء (بمعرف المهمة) بمعدل محدود.
+    """
+    MAX_ERRORS = 5
+
+    def __init__(self, task=None, status='معالجة الفيديو...', start_pct=5, end_pct=98, job_id=None):
+        self.task = task
+        self.job_id = job_id or (task.request.id if task is not None else None)
+        self.start_pct = start_pct
+        self.end_pct = end_pct
+        self.errors = []
+        self.cancelled = False
+        self.cancel_checked_at = 0.0
+        self.lease_renewed_at = time.time()
+        self.placement = None  # الأنوية والأولوية (plan_job_placement)
+        self.x264_preset = None  # preset المختار لهذه المهمة (choose_x264_preset)، None = X264_PRESET
+        self.ingest = None  # GrowingUpload عند الترميز أثناء الرفع
+        self.lock = threading.Lock()
+        self.reset(status)
+
+    def reset(self, status):
+        """بدء مرحلة ترميز جديدة (مثلاً الانتقال من GPU إلى CPU)"""
+        with self.lock:
+            self.status = status
+            self.work = {}    # key -> المدة المتوقعة بالثواني
+            self.done = {}    # key -> الثواني المرمّزة حتى الآن
+            self.speed = {}   # key -> سرعة FFmpeg (x من الزمن الحقيقي)
+            self.fps = {}
+            self.started_at = time.time()
+            self.last_published = 0.0
+
+    def add_work(self, key, seconds):
+        with self.lock:
+            self.work[key] = max(float(seconds), 0.0)
+            self.done[key] = 0.0
+
+    def remove(self, key_prefix):
+        with self.lock:
+            for key in [k for k in self.work if k.startswith(key_prefix)]:
+                for table in (self.work, self.done, self.speed, self.fps):
+                    table.pop(key, None)
+
+    def update(self, key, out_time=None, fps=None, speed=None):
+        with self.lock:
+            if key not in self.work:
+                return
+            if out_time is not None:
+                self.done[key] = min(max(out_time, 0.0), self.work[key])
+            if fps is not None:
+                self.fps[key] = fps
+            if speed is not None:
+                self.speed[key] = speed
+        self.publish()
+
+    def complete(self, key):
+        with self.lock:
+            if key in self.work:
+                self.done[key] = self.work[key]
+                self.speed.pop(key, None)
+                self.fps.pop(key, None)
+        self.publish(force=True)
+
+    def is_cancelled(self):
+        now = time.time()
+        if not self.cancelled and now - self.cancel_checked_at >= CANCEL_CHECK_INTERVAL:
+            self.cancel_checked_at = now
+            self.cancelled = is_job_cancelled(self.job_id)
+        return self.cancelled
+
+    def renew_lease(self):
+        """تمديد تسجيل المهمة الجارية (إزالة التكرار) كل INFLIGHT_RENEW_INTERVAL"""
+        now = time.time()
+        if self.job_id and now - self.lease_renewed_at >= INFLIGHT_RENEW_INTERVAL:
+            self.lease_renewed_at = now
+            renew_inflight_lease(self.job_id)
+
+    def check_cancelled(self):
+        if self.is_cancelled():
+            raise JobCancelled(f"تم إلغاء المهمة {self.job_id}")
+
+    def record_failure(self, cmd, returncode, stderr_buffer):
+        """حفظ ذيل stderr لأمر فاشل (آخر MAX_ERRORS أوامر فقط)"""
+        with self.lock:
+            self.errors.append({
+                'command': ' '.join(cmd[:12]) + (' ...' if len(cmd) > 12 else ''),
+                'returncode': returncode,
+                'error_lines': list(stderr_buffer.error_lines),
+                'stderr_tail': stderr_buffer.text(),
+            })
+            del self.errors[:-self.MAX_ERRORS]
+
+    def snapshot(self):
+        """الحالة الحالية: النسبة، ETA، fps، السرعة"""
+        with self.lock:
+            total = sum(self.work.values())
+            done = sum(self.done.values())
+            speed = sum(self.speed.values())
+            fps = sum(self.fps.values())
+            status = self.status
+            started_at = self.started_at
+        fraction = done / total if total > 0 else 0.0
+        eta = None
+        if speed > 0:
+            eta = (total - done) / speed
+        elif fraction > 0:
+            elapsed = time.time() - started_at
+            eta = elapsed * (1 - fraction) / fraction
+        return {
+            'progress': round(self.start_pct + (self.end_pct - self.start_pct) * fraction, 1),
+            'status': status,
+            'eta_seconds': int(eta) if eta is not None else None,
+            'fps': round(fps, 1) if fps else None,
+            'speed': round(speed, 2) if speed else None,
+            'encoded_seconds': round(done, 1),
+            'total_seconds': round(total, 1),
+            'placement': self.placement,
+            'x264_preset': self.x264_preset,
+        }
+
+    def publish(self, force=False):
+        now = time.time()
+        if not force and now - self.last_published < PROGRESS_UPDATE_INTERVAL:
+            return
+        self.last_published = now
+        if self.task is not None:
             try:
-                test_result = subprocess.run([
-                    'ffmpeg', '-f', 'lavfi', '-i', 'testsrc=duration=1:size=320x240:rate=1',
-                    '-c:v', 'h264_nvenc', '-preset', 'p1', '-f', 'null', '-'
-                ], capture_output=True, text=True, timeout=10)
-                if test_result.returncode == 0:
-                    print("✅ NVENC يعمل فعلياً - يمكن استخدام GPU!")
-                    return 'h264_nvenc'
-                else:
-                    print("⚠️ NVENC موجود لكن لا يعمل - سيتم استخدام CPU")
-                    return None
-            except subprocess.TimeoutExpired:
-                print("⚠️ NVENC timeout - سيتم استخدام CPU")
-                return None
+                self.task.update_state(state='PROCESSING', meta=self.snapshot())
             except Exception as e:
-                print(f"⚠️ خطأ في اختبار NVENC: {e} - سيتم استخدام CPU")
-                return None
+                logger.warning(f"⚠️ فشل نشر التقدم: {e}")
+
+def _parse_progress_value(value):
+    """تحويل قيم -progress مثل '1.5x' أو 'N/A' إلى float"""
+    try:
+        return float(value.rstrip('x'))
+    except (AttributeError, ValueError):
         return None
+
+# حدود زمن أوامر FFmpeg: مراقبة التوقف + حد أقصى يتناسب مع مدة/حجم المدخل
+FFMPEG_STALL_TIMEOUT = float(os.getenv('FFMPEG_STALL_TIMEOUT', '120'))  # ثوانٍ بدون تقدم out_time
+FFMPEG_MIN_SPEED = float(os.getenv('FFMPEG_MIN_SPEED', '0.2'))  # أبطأ سرعة ترميز مقبولة (x من الزمن الحقيقي)
+FFMPEG_COPY_MIN_MBPS = float(os.getenv('FFMPEG_COPY_MIN_MBPS', '10'))  # أبطأ قراءة مقبولة للنسخ المباشر
+FFMPEG_TIME_LIMIT_BASE = float(os.getenv('FFMPEG_TIME_LIMIT_BASE', '300'))  # هامش ثابت لكل أمر
+FFPROBE_TIMEOUT = float(os.getenv('FFPROBE_TIMEOUT', '60'))
+
+class FFmpegStalled(Exception):
+    """FFmpeg لم يتقدم (out_time ثابت) خلال نافذة FFMPEG_STALL_TIMEOUT"""
+
+def encode_time_limit(duration):
+    """الحد الأقصى لترميز duration ثانية من الوسائط بأبطأ سرعة مقبولة"""
+    return FFMPEG_TIME_LIMIT_BASE + max(float(duration or 0), 0.0) / FFMPEG_MIN_SPEED
+
+def copy_time_limit(paths):
+    """الحد الأقصى لأمر نسخ مباشر/قراءة حزم يتناسب مع حجم الملفات"""
+    total_mb = sum(os.path.getsize(p) for p in paths if os.path.exists(p)) / (1024 * 1024)
+    return FFMPEG_TIME_LIMIT_BASE + total_mb / FFMPEG_COPY_MIN_MBPS
+
+def faststart_stall_timeout(paths):
+    """
+    نافذة التوقف لأمر بـ -movflags +faststart: بعد آخر حزمة يعيد FFmpeg كتابة الملف كاملاً
+    لنقل moov إلى البداية بدون أي -progress، فتتسع النافذة بحجم الناتج.
+    """
+    total_mb = sum(os.path.getsize(p) for p in paths if os.path.exists(p)) / (1024 * 1024)
+    return FFMPEG_STALL_TIMEOUT + total_mb / FFMPEG_COPY_MIN_MBPS
+
+def _kill_process_group(proc):
+    """قتل FFmpeg وكل عملياته الفرعية (يعمل في جلسة مستقلة)"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def run_ffmpeg(cmd, job=None, key=None, timeout=None, stdout_handler=None, stall_timeout=None):
+    """
+    تشغيل أمر FFmpeg/FFprobe مع قراءة المخرجات تدريجياً:
+    - stderr يُحفظ في StderrRingBuffer محدود الحجم بدل تخزينه كاملاً.
+    - عند تمرير job و key (أو stall_timeout) يُضاف -progress pipe:1 وتُقرأ out_time/fps/speed.
+    - stdout_handler (اختياري) يستقبل أسطر stdout واحداً واحداً بدل تجميعها.
+    - مراقب يقتل مجموعة العمليات عند تجاوز timeout (TimeoutExpired)، أو ثبات out_time
+      لمدة stall_timeout (FFmpegStalled)، أو إلغاء المهمة (JobCancelled).
+      بدون timeout لمهمة تقرأ رفعاً نامياً (job.ingest) يُعتمد حدها بعد وصول الملف كاملاً.
+    يُرجع CompletedProcess مثل subprocess.run (stderr = الذيل المحدود).
+    """
+    if job is not None:
+        job.check_cancelled()
+    report_progress = job is not None and key is not None
+    read_progress = cmd[0] == 'ffmpeg' and (report_progress or bool(stall_timeout))
+    if read_progress:
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats'] + list(cmd[1:])
+
+    placement = job.placement if job is not None else None
+    # الأنوية تُورث عند التشغيل، وnice/ionice لا يمكن إرجاعها على الخيط فتُطبق على FFmpeg نفسه
+    with inherited_affinity(placement['cpus'] if placement else None):
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                text=True, errors='replace', start_new_session=True)
+    if placement:
+        apply_process_placement(proc.pid, placement)
+
+    # قراءة stderr في خيط منفصل حتى لا يمتلئ الـ pipe ويتوقف FFmpeg
+    stderr_buffer = StderrRingBuffer()
+    def drain_stderr():
+        # readline بحد أقصى: سطر بلا نهاية لا يُقرأ كاملاً في الذاكرة
+        for line in iter(lambda: proc.stderr.readline(stderr_buffer.max_line), ''):
+            stderr_buffer.append(line)
+    stderr_reader = threading.Thread(target=drain_stderr, daemon=True)
+    stderr_reader.start()
+
+    finished = threading.Event()
+    kill_reason = []
+    # [أكبر out_time حتى الآن، وقت آخر تقدم]
+    last_advance = [-1.0, time.time()]
+    started = time.time()
+    deadline = [started + timeout if timeout else None]
+    ingest = job.ingest if job is not None and not timeout else None
+    def watchdog():
+        placement_pending = bool(placement)
+        while not finished.wait(0.5):
+            now = time.time()
+            if deadline[0] is None and ingest is not None:
+                deadline[0] = ingest.deadline
+            if placement_pending:
+                # خيوط FFmpeg التي أُنشئت قبل التطبيق الأول بعد Popen
+                apply_process_placement(proc.pid, placement)
+                placement_pending = False
+            if job is not None:
+                job.renew_lease()
+            if deadline[0] is not None and now > deadline[0]:
+                kill_reason.append('timeout')
+            elif stall_timeout and now - last_advance[1] > stall_timeout:
+                kill_reason.append('stalled')
+            elif job is not None and job.is_cancelled():
+                kill_reason.append('cancelled')
+            else:
+                continue
+            _kill_process_group(proc)
+            return
+    watcher = None
+    if timeout or stall_timeout or job is not None:
+        watcher = threading.Thread(target=watchdog, daemon=True)
+        watcher.start()
+
+    stdout_lines = []
+    fields = {}
+    try:
+        for line in proc.stdout:
+            if not read_progress:
+                if stdout_handler:
+                    stdout_handler(line)
+                else:
+                    stdout_lines.append(line)
+                continue
+            field, _, value = line.strip().partition('=')
+            fields[field] = value
+            if field != 'progress':
+                continue
+            # out_time_us (وout_time_ms رغم اسمه) بالميكروثانية
+            out_time_us = _parse_progress_value(fields.get('out_time_us') or fields.get('out_time_ms'))
+            out_time = out_time_us / 1_000_000 if out_time_us is not None else None
+            if out_time is not None and out_time > last_advance[0]:
+                last_advance[:] = [out_time, time.time()]
+            if report_progress:
+                job.update(
+                    key,
+                    out_time=out_time,
+                    fps=_parse_progress_value(fields.get('fps')),
+                    speed=_parse_progress_value(fields.get('speed')),
+                )
+            fields = {}
+        proc.wait()
+    finally:
+        finished.set()
+        if proc.poll() is None:
+            _kill_process_group(proc)
+            proc.wait()
+        stderr_reader.join()
+        if watcher:
+            watcher.join()
+
+    if 'cancelled' in kill_reason:
+        raise JobCancelled(f"تم إلغاء المهمة {job.job_id}")
+    if kill_reason and job is not None:
+        job.record_failure(cmd, proc.returncode, stderr_buffer)
+    if 'stalled' in kill_reason:
+        logger.error(f"⏱️ FFmpeg متوقف بدون تقدم لمدة {stall_timeout:.0f}s - تم إيقافه")
+        raise FFmpegStalled(f"FFmpeg لم يتقدم لمدة {stall_timeout:.0f} ثانية (out_time={last_advance[0]:.1f}s)")
+    if 'timeout' in kill_reason:
+        limit = deadline[0] - started
+        logger.error(f"⏱️ FFmpeg تجاوز الحد الأقصى {limit:.0f}s - تم إيقافه")
+        raise subprocess.TimeoutExpired(cmd, limit, stderr=stderr_buffer.text())
+
+    if proc.returncode == 0:
+        if report_progress:
+            job.complete(key)
+    elif job is not None:
+        job.record_failure(cmd, proc.returncode, stderr_buffer)
+    return subprocess.CompletedProcess(cmd, proc.returncode, ''.join(stdout_lines), stderr_buffer.text())
+
+# سجل قدرات FFmpeg: يُبنى مرة واحدة لكل عملية عامل ويُعاد استخدامه بين المهام
+FFMPEG_CAPS_TTL = int(os.getenv('FFMPEG_CAPS_TTL', '3600'))  # ثانية
+_ffmpeg_caps = None
+_ffmpeg_caps_lock = threading.Lock()
+
+def _parse_ffmpeg_listing(output):
+    """استخراج أسماء العناصر من مخرجات ffmpeg -encoders / -filters"""
+    names = set()
+    for line in output.splitlines():
+        stripped = line.strip()
+        # تجاهل العناوين وشرح الأعمدة وسطر الفاصل
+        if not stripped or stripped.endswith(':') or ' = ' in stripped or stripped.startswith('------'):
+            continue
+        parts = stripped.split()
+        if len(parts) >= 2:
+            names.add(parts[1])
+    return names
+
+def _test_nvenc_encode():
+    """ترميز تجريبي قصير للتأكد من أن NVENC يعمل فعلياً على هذا الجهاز"""
+    try:
+        test_result = run_ffmpeg([
+            'ffmpeg', '-f', 'lavfi', '-i', 'testsrc=duration=1:size=320x240:rate=1',
+            '-c:v', 'h264_nvenc', '-preset', 'p1', '-f', 'null', '-'
+        ], timeout=10)
+        if test_result.returncode == 0:
+            print("✅ NVENC يعمل فعلياً - يمكن استخدام GPU!")
+            return True
+        print("⚠️ NVENC موجود لكن لا يعمل - سيتم استخدام CPU")
+    except subprocess.TimeoutExpired:
+        print("⚠️ NVENC timeout - سيتم استخدام CPU")
     except Exception as e:
-        print(f"⚠️ خطأ في فحص NVENC: {e}")
-        return None
+        print(f"⚠️ خطأ في اختبار NVENC: {e} - سيتم استخدام CPU")
+    return False
 
-def test_gpu_support():
-    """اختبار وجود FFmpeg ووجود دعم NVENC"""
+def probe_ffmpeg_capabilities():
+    """فحص FFmpeg كاملاً (الإصدار، encoders، filters، hwaccels، NVENC)"""
+    caps = {
+        'ffmpeg_available': False,
+        'ffmpeg_version': None,
+        'encoders': [],
+        'filters': [],
+        'hwaccels': [],
+        'nvenc_encoder': None,
+        'probed_at': time.time(),
+    }
     try:
-        # اختبار FFmpeg
-        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+        result = run_ffmpeg(['ffmpeg', '-version'], timeout=10)
         if result.returncode != 0:
             print("❌ FFmpeg غير مثبت أو غير متاح")
-            return False
+            return caps
+        caps['ffmpeg_available'] = True
+        caps['ffmpeg_version'] = (result.stdout.splitlines() or [''])[0].strip()
 
-        print("✅ FFmpeg مثبت ويعمل")
+        res = run_ffmpeg(['ffmpeg', '-hide_banner', '-encoders'], timeout=10)
+        if res.returncode == 0:
+            caps['encoders'] = sorted(_parse_ffmpeg_listing(res.stdout))
 
-        encoder = get_nvenc_encoder()
+        res = run_ffmpeg(['ffmpeg', '-hide_banner', '-filters'], timeout=10)
+        if res.returncode == 0:
+            caps['filters'] = sorted(_parse_ffmpeg_listing(res.stdout))
+
+        res = run_ffmpeg(['ffmpeg', '-hide_banner', '-hwaccels'], timeout=10)
+        if res.returncode == 0:
+            caps['hwaccels'] = [
+                line.strip() for line in res.stdout.splitlines()[1:] if line.strip()
+            ]
+
+        # نستخدم h264_nvenc فقط للسرعة القصوى
+        if 'h264_nvenc' in caps['encoders'] and _test_nvenc_encode():
+            caps['nvenc_encoder'] = 'h264_nvenc'
+    except Exception as e:
+        error_id, _ = log_detailed_error(e, "probe_ffmpeg_capabilities")
+        print(f"⚠️ خطأ في فحص قدرات FFmpeg [ID: {error_id}]: {e}")
+
+    logger.info(
+        f"🧭 قدرات FFmpeg: {caps['ffmpeg_version']} | "
+        f"encoders={len(caps['encoders'])} filters={len(caps['filters'])} "
+        f"hwaccels={caps['hwaccels']} nvenc={caps['nvenc_encoder']}"
+    )
+    return caps
+
+def get_ffmpeg_capabilities(refresh=False):
+    """
+    إرجاع سجل القدرات المخزن مؤقتاً لهذه العملية.
+    يُعاد الفحص فقط عند refresh=True أو عند انتهاء FFMPEG_CAPS_TTL.
+    """
+    global _ffmpeg_caps
+    with _ffmpeg_caps_lock:
+        expired = (
+            _ffmpeg_caps is None
+            or (FFMPEG_CAPS_TTL > 0 and time.time() - _ffmpeg_caps['probed_at'] > FFMPEG_CAPS_TTL)
+        )
+        if refresh or expired:
+            _ffmpeg_caps = probe_ffmpeg_capabilities()
+        return _ffmpeg_caps
+
+def refresh_ffmpeg_capabilities():
+    """إعادة فحص FFmpeg صراحةً (مثلاً بعد تحديث التعريفات)"""
+    return get_ffmpeg_capabilities(refresh=True)
+
+def get_nvenc_encoder():
+    """
+    تحديد دعم h264_nvenc من سجل القدرات (بدون تشغيل FFmpeg لكل مهمة)
+    يعاد 'h264_nvenc' أو None إذا غير مدعوم.
+    """
+    return get_ffmpeg_capabilities()['nvenc_encoder']
+
+def test_gpu_support():
+    """اختبار وجود FFmpeg ووجود دعم NVENC (من سجل القدرات)"""
+    try:
+        caps = get_ffmpeg_capabilities()
+        if not caps['ffmpeg_available']:
+            print("❌ FFmpeg غير مثبت أو غير متاح")
+            return False
+
+        encoder = caps['nvenc_encoder']
         if encoder:
             print(f"✅ NVENC مدعوم ({encoder}) - يمكن استخدام GPU!")
             return True
@@ -265,6 +877,249 @@ def test_gpu_support():
         print(f"❌ خطأ في اختبار GPU [ID: {error_id}]: {e}")
         return False
 
+@worker_process_init.connect
+def warm_ffmpeg_capabilities(**kwargs):
+    """بناء سجل القدرات مرة واحدة عند بدء كل عملية عامل Celery"""
+    get_ffmpeg_capabilities(refresh=True)
+
+# ميزانية أنوية CPU لكل جهاز: تُقسم بين مهام FFmpeg النشطة فعلاً بدل أن يبدأ
+# كل أمر FFmpeg خيوطاً بعدد كل الأنوية (تزاحم عند CELERY_CONCURRENCY > 1)
+FFMPEG_CPU_BUDGET = int(os.getenv('FFMPEG_CPU_BUDGET', '0'))  # 0 = تلقائي (cgroup + affinity)
+FFMPEG_MAX_THREADS = int(os.getenv('FFMPEG_THREADS', '0'))  # حد أعلى لخيوط أمر واحد (0 = بدون حد)
+JOB_SLOTS_DIR = os.getenv('JOB_SLOTS_DIR', os.path.join(tempfile.gettempdir(), 'ffmpeg-job-slots'))
+
+def _read_cgroup_cpu_limit():
+    """حصة CPU من cgroup (v2 ثم v1) كعدد أنوية، أو None إذا لم يوجد حد"""
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+_cpu_budget = None
+
+def get_cpu_budget():
+    """عدد الأنوية المتاحة فعلاً لهذه الحاوية (يُحسب مرة لكل عملية)"""
+    global _cpu_budget
+    if _cpu_budget is None:
+        if FFMPEG_CPU_BUDGET > 0:
+            _cpu_budget = FFMPEG_CPU_BUDGET
+        else:
+            try:
+                cores = len(os.sched_getaffinity(0))
+            except AttributeError:
+                cores = os.cpu_count() or 1
+            quota = _read_cgroup_cpu_limit()
+            if quota:
+                cores = min(cores, max(1, round(quota)))
+            _cpu_budget = cores
+    return _cpu_budget
+
+def acquire_job_slot():
+    """
+    حجز خانة مهمة ترميز على هذا الجهاز: ملف slot-<index> يحوي PID المالك، مشترك بين
+    عمليات العامل. رقم الخانة يحدد مجموعة الأنوية عند تفعيل FFMPEG_CPU_AFFINITY.
+    """
+    os.makedirs(JOB_SLOTS_DIR, exist_ok=True)
+    index = 0
+    while True:
+        slot_path = os.path.join(JOB_SLOTS_DIR, f'slot-{index}')
+        try:
+            fd = os.open(slot_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _slot_owner_alive(slot_path):
+                # خانة عملية منتهية: تُحذف ويُعاد المحاولة بنفس الرقم
+                try:
+                    os.unlink(slot_path)
+                    continue
+                except OSError:
+                    pass
+            index += 1
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return {'path': slot_path, 'index': index}
+
+def release_job_slot(slot):
+    try:
+        os.unlink(slot['path'])
+    except OSError:
+        pass
+
+def _slot_owner_alive(slot_path):
+    try:
+        with open(slot_path) as f:
+            os.kill(int(f.read().strip()), 0)
+    except ProcessLookupError:
+        return False
+    except (OSError, ValueError):
+        # ملف قيد الكتابة أو لعملية مستخدم آخر: نعتبره مشغولاً
+        pass
+    return True
+
+def count_busy_slots():
+    """عدد المهام النشطة على هذا الجهاز (مع حذف خانات العمليات المنتهية)"""
+    busy = 0
+    try:
+        names = os.listdir(JOB_SLOTS_DIR)
+    except OSError:
+        return 1
+    for name in names:
+        slot_path = os.path.join(JOB_SLOTS_DIR, name)
+        if not _slot_owner_alive(slot_path):
+            release_job_slot({'path': slot_path})
+            continue
+        busy += 1
+    return max(1, busy)
+
+# تثبيت أنوية وأولوية عمليات FFmpeg لكل خانة: مجموعات أنوية منفصلة (حسب عقد NUMA)
+# حتى لا تتزاحم المهام المتزامنة على نفس الأنوية والكاش. يُلغي توسع المهمة الوحيدة
+# على كل الجهاز (plan_threads) لذلك هو اختياري.
+FFMPEG_CPU_AFFINITY = os.getenv('FFMPEG_CPU_AFFINITY', 'false').lower() == 'true'
+JOB_SLOTS_PER_HOST = int(os.getenv('CELERY_CONCURRENCY', '2'))
+# فئات الأولوية: المقاطع القصيرة تفاعلية والطويلة دفعات في الخلفية
+INTERACTIVE_MAX_DURATION = float(os.getenv('INTERACTIVE_MAX_DURATION', '120'))  # ثانية
+PRIORITY_CLASSES = {
+    'interactive': {
+        'nice': int(os.getenv('FFMPEG_INTERACTIVE_NICE', '0')),
+        'ionice': int(os.getenv('FFMPEG_INTERACTIVE_IONICE', '4')),
+    },
+    'batch': {
+        'nice': int(os.getenv('FFMPEG_BATCH_NICE', '10')),
+        'ionice': int(os.getenv('FFMPEG_BATCH_IONICE', '7')),
+    },
+}
+
+def _parse_cpulist(text):
+    """تحويل صيغة cpulist مثل '0-3,8,10-11' إلى قائمة أرقام"""
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+def _numa_ordered_cpus():
+    """الأنوية المسموحة للعملية مرتبة حسب عقدة NUMA (حتى تبقى كل خانة داخل عقدة واحدة إن أمكن)"""
+    try:
+        allowed = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        allowed = list(range(os.cpu_count() or 1))
+    ordered = []
+    node_root = '/sys/devices/system/node'
+    try:
+        nodes = sorted((n for n in os.listdir(node_root) if re.fullmatch(r'node\d+', n)),
+                       key=lambda n: int(n[4:]))
+        for node in nodes:
+            with open(os.path.join(node_root, node, 'cpulist')) as f:
+                ordered.extend(cpu for cpu in _parse_cpulist(f.read()) if cpu in allowed)
+    except (OSError, ValueError):
+        pass
+    # أي أنوية لم تظهر في عقد NUMA (أو لا يوجد NUMA) تُضاف بترتيبها
+    ordered.extend(cpu for cpu in allowed if cpu not in ordered)
+    return ordered
+
+def get_slot_cpus(index):
+    """مجموعة الأنوية المنفصلة للخانة index، أو None بدون تثبيت"""
+    if not FFMPEG_CPU_AFFINITY or index is None or index >= JOB_SLOTS_PER_HOST:
+        return None
+    cpus = _numa_ordered_cpus()[:get_cpu_budget()]
+    per_slot = len(cpus) // JOB_SLOTS_PER_HOST
+    if per_slot < 1:
+        return None
+    return cpus[index * per_slot:(index + 1) * per_slot]
+
+def classify_job_priority(duration):
+    """مقطع قصير = تفاعلي (المستخدم ينتظر)، غير ذلك = دفعة في الخلفية (duration: مجموع مدد المدخلات)"""
+    return 'interactive' if duration <= INTERACTIVE_MAX_DURATION else 'batch'
+
+def plan_job_placement(slot, priority):
+    """أنوية وأولوية عمليات FFmpeg لهذه المهمة (تُحفظ في FFmpegJob وتظهر في مقاييسها)"""
+    if priority not in PRIORITY_CLASSES:
+        priority = 'batch'
+    placement = {'slot': slot['index'], 'priority': priority, 'cpus': get_slot_cpus(slot['index'])}
+    placement.update(PRIORITY_CLASSES[priority])
+    return placement
+
+@contextlib.contextmanager
+def inherited_affinity(cpus):
+    """
+    أنوية الخيط المنفّذ أثناء Popen فقط (sched_setaffinity(0) تخص الخيط الحالي في Linux)،
+    فيرثها FFmpeg من لحظة تشغيله قبل أن ينشئ أي خيط.
+    """
+    previous = None
+    if cpus:
+        try:
+            previous = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cpus)
+        except (OSError, AttributeError) as e:
+            logger.debug(f"⚠️ تعذر تعيين أنوية خيط التشغيل: {e}")
+            previous = None
+    try:
+        yield
+    finally:
+        if previous is not None:
+            os.sched_setaffinity(0, previous)
+
+def apply_process_placement(pid, placement):
+    """
+    تطبيق الأنوية وnice/ionice على FFmpeg بعد تشغيله. القيم لكل خيط في Linux،
+    لذلك تُطبق على كل خيوط العملية الموجودة (ويُعاد التطبيق مرة في أول دورة للمراقب
+    للخيوط التي أُنشئت بينهما)، والخيوط الأحدث ترثها من الخيط الذي ينشئها.
+    """
+    try:
+        proc = psutil.Process(pid)
+        for thread in proc.threads():
+            if placement.get('cpus'):
+                os.sched_setaffinity(thread.id, placement['cpus'])
+            os.setpriority(os.PRIO_PROCESS, thread.id, placement['nice'])
+        proc.ionice(psutil.IOPRIO_CLASS_BE, placement['ionice'])
+    except (psutil.Error, OSError, AttributeError) as e:
+        logger.debug(f"⚠️ تعذر تطبيق الأولوية/الأنوية على FFmpeg ({pid}): {e}")
+
+def plan_threads(parallel=1, job=None):
+    """
+    ميزانية الخيوط لأمر FFmpeg واحد: الأنوية مقسومة على المهام النشطة الآن
+    (فتحصل مهمة وحيدة على الجهاز كاملاً) ثم على الأوامر المتوازية داخل المهمة.
+    يُعاد الحساب عند بدء كل أمر، فتتوسع المهام اللاحقة عندما تنتهي مهام أخرى.
+    عند تثبيت الأنوية تكون الميزانية هي أنوية خانة المهمة.
+    """
+    cpus = job.placement.get('cpus') if job is not None and job.placement else None
+    if cpus:
+        threads = max(1, len(cpus) // max(1, parallel))
+    else:
+        threads = max(1, get_cpu_budget() // (count_busy_slots() * max(1, parallel)))
+    if FFMPEG_MAX_THREADS > 0:
+        threads = min(threads, FFMPEG_MAX_THREADS)
+    # المرمّز هو عنق الزجاجة؛ فك الترميز والفلاتر تعمل بالتوازي معه بخيوط أقل
+    side = max(1, threads // 4)
+    return {'encoder': threads, 'decoder': side, 'filter': side}
+
+def thread_input_args(threads):
+    """خيارات فك الترميز (تُوضع قبل -i لكل مدخل فيديو)"""
+    return ['-threads', str(threads['decoder'])]
+
+def thread_global_args(threads):
+    return ['-filter_complex_threads', str(threads['filter'])]
+
+@worker_process_init.connect
+def plan_worker_resources(**kwargs):
+    """حساب ميزانية الأنوية مرة واحدة عند بدء كل عملية عامل Celery"""
+    concurrency = os.getenv('CELERY_CONCURRENCY', '?')
+    logger.info(f"🧮 ميزانية CPU: {get_cpu_budget()} نواة تُقسم على المهام النشطة (CELERY_CONCURRENCY={concurrency})")
+
 def get_final_nvenc_settings():
     """إعدادات NVENC نهائية محسنة للسرعة والجودة المتوازنة"""
     # استخدام متغيرات البيئة إذا كانت متوفرة
@@ -273,9 +1128,7 @@ def get_final_nvenc_settings():
     bufsize = os.getenv('NVENC_BUFSIZE', '32M')
     bv = os.getenv('NVENC_BV', '8M')
     preset = os.getenv('NVENC_PRESET', 'p1')
-    
-    print(f"🔧 إعدادات NVENC: CQ={cq}, MaxRate={maxrate}, BufSize={bufsize}, BV={bv}, Preset={preset}")
-    
+
     return [
         '-c:v', 'h264_nvenc',      # استخدام h264_nvenc
         '-preset', preset,         # preset قابل للتخصيص
@@ -290,528 +1143,2280 @@ def get_final_nvenc_settings():
         '-rc-lookahead', '20',     # تحسين التنبؤ
     ]
 
-def process_video_ffmpeg_gpu(video_path, output_path):
-    """معالجة الفيديو باستخدام FFmpeg مع تسريع GPU في تمرير واحد"""
-    with tempfile.TemporaryDirectory() as temp_dir:
-        try:
-            # استخدام h264_nvenc فقط (أسرع وأكثر توافقاً)
-            encoder = 'h264_nvenc'
-            
-            # التحقق من دعم NVENC
-            nvenc_available = get_nvenc_encoder()
-            if nvenc_available != "h264_nvenc":
-                print("❌ h264_nvenc غير متوفر، استخدم CPU")
-                return False
+# ملفات الناتج: economy أسرع وأرخص (يُستخدم عند الضغط من التحكم في القبول)
+OUTPUT_PROFILE_STANDARD = 'standard'
+OUTPUT_PROFILE_ECONOMY = 'economy'
+ECONOMY_X264_PRESET = os.getenv('ECONOMY_X264_PRESET', 'ultrafast')
 
-            # معلومات الفيديوهات
-            video_info = get_video_info(video_path)
-            outro_info = get_video_info(OUTRO_PATH)
-            if not video_info or not outro_info:
-                return False
+def get_x264_preset(output_profile=OUTPUT_PROFILE_STANDARD):
+    """preset الأساسي لملف الناتج (قبل تكييفه حسب الحمل)"""
+    if output_profile == OUTPUT_PROFILE_ECONOMY:
+        return ECONOMY_X264_PRESET
+    return os.getenv('X264_PRESET', 'veryfast')
 
-            video_stream = next((s for s in video_info['streams'] if s['codec_type'] == 'video'), None)
-            if not video_stream:
-                return False
+def get_cpu_encoder_settings(preset=None):
+    """إعدادات libx264 من متغيرات البيئة (أو preset المهمة)"""
+    cpu_preset = preset or get_x264_preset()
+    cpu_crf = os.getenv('X264_CRF', '20')
 
-            width = int(video_stream['width'])
-            height = int(video_stream['height'])
-            video_has_audio = any(s['codec_type'] == 'audio' for s in video_info['streams'])
-            outro_has_audio = any(s['codec_type'] == 'audio' for s in outro_info['streams'])
+    # عدد الخيوط يُحدد لكل أمر من plan_threads
+    return [
+        '-c:v', 'libx264',
+        '-preset', cpu_preset,
+        '-crf', cpu_crf,
+        '-pix_fmt', 'yuv420p',
+    ]
 
-            print(f"🚀 معالجة GPU في تمرير واحد: {width}x{height}")
+def get_encoder_profile(use_gpu, x264_preset=None):
+    """
+    ملف الترميز المستخدم للمقطع الرئيسي والأوترو معاً.
+    key يميز الإعدادات المؤثرة على تدفق البتات (بدون -threads) لاستخدامه في الكاش.
+    """
+    args = get_final_nvenc_settings() if use_gpu else get_cpu_encoder_settings(x264_preset)
+    # الطباعة هنا (عند الترميز فعلاً) لا في دوال الإعدادات التي يستخدمها مفتاح كاش النتائج أيضاً
+    print(f"{'🔧 إعدادات NVENC' if use_gpu else '🖥️ إعدادات CPU'}: {' '.join(args)}")
+    key_args = []
+    it = iter(args)
+    for arg in it:
+        if arg == '-threads':
+            next(it, None)
+            continue
+        key_args.append(arg)
+    return {
+        'name': 'nvenc' if use_gpu else 'x264',
+        'args': args,
+        'key': hashlib.sha256(' '.join(key_args).encode('utf-8')).hexdigest()[:12],
+    }
 
-            # بناء filter_complex واحد للمعالجة الكاملة (watermark + outro + concat)
-            video_duration = float(video_info['format']['duration'])
-            
-            if video_has_audio and outro_has_audio:
-                filter_complex = (
-                    f'[1:v]scale={width}:{height}[outro_scaled];'
-                    f'[0:v][outro_scaled]concat=n=2:v=1:a=0[concat_v];'
-                    f'movie={WATERMARK_PATH}[wm];'
-                    f'[wm]scale={width}:{height},format=rgba,colorchannelmixer=aa=0.3[wm_scaled];'
-                    f'[concat_v][wm_scaled]overlay=0:0[outv];'
-                    f'[0:a][1:a]concat=n=2:v=0:a=1[outa]'
-                )
-                map_args = ['-map', '[outv]', '-map', '[outa]']
-                audio_codec = ['-c:a', 'aac', '-b:a', '128k']
-            elif video_has_audio and not outro_has_audio:
-                filter_complex = (
-                    f'[1:v]scale={width}:{height}[outro_scaled];'
-                    f'anullsrc=channel_layout=stereo:sample_rate=48000[silence];'
-                    f'[0:v][outro_scaled]concat=n=2:v=1:a=0[concat_v];'
-                    f'movie={WATERMARK_PATH}[wm];'
-                    f'[wm]scale={width}:{height},format=rgba,colorchannelmixer=aa=0.3[wm_scaled];'
-                    f'[concat_v][wm_scaled]overlay=0:0[outv];'
-                    f'[0:a][silence]concat=n=2:v=0:a=1[outa]'
-                )
-                map_args = ['-map', '[outv]', '-map', '[outa]']
-                audio_codec = ['-c:a', 'aac', '-b:a', '128k']
-            else:
-                filter_complex = (
-                    f'[1:v]scale={width}:{height}[outro_scaled];'
-                    f'[0:v][outro_scaled]concat=n=2:v=1:a=0[concat_v];'
-                    f'movie={WATERMARK_PATH}[wm];'
-                    f'[wm]scale={width}:{height},format=rgba,colorchannelmixer=aa=0.3[wm_scaled];'
-                    f'[concat_v][wm_scaled]overlay=0:0[outv]'
-                )
-                map_args = ['-map', '[outv]']
-                audio_codec = ['-an']
-
-            # أمر FFmpeg واحد للمعالجة الكاملة
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', video_path,
-                '-i', OUTRO_PATH,
-                '-filter_complex', filter_complex
-            ]
-            cmd.extend(map_args)
-            cmd.extend(['-c:v', 'h264_nvenc'])
-            cmd.extend(get_final_nvenc_settings())
-            cmd.extend(audio_codec)
-            cmd.extend(['-movflags', '+faststart'])
-            cmd.append(output_path)
-
-            print("🚀 معالجة GPU في تمرير واحد...")
-            print(f"أمر FFmpeg: {' '.join(cmd)}")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode == 0:
-                print("✅ تمت المعالجة بنجاح في تمرير واحد!")
-                return True
-            else:
-                print(f"❌ خطأ في المعالجة: {result.stderr}")
-                return False
+# الصوت الموحد لكل المقاطع حتى يمكن لصقها بدون إعادة ترميز
+AUDIO_ENCODE_ARGS = ['-c:a', 'aac', '-b:a', '128k', '-ar', '48000', '-ac', '2']
+AUDIO_LAYOUT_STEREO = 'aac_stereo_48000'
+AUDIO_LAYOUT_NONE = 'none'
+# نفس الـ timescale لكل المقاطع حتى تبقى الطوابع الزمنية متوافقة عند اللصق
+SEGMENT_MUX_ARGS = ['-video_track_timescale', '90000', '-f', 'mp4']
 
-        except Exception as e:
-            error_id, _ = log_detailed_error(e, "process_video_ffmpeg_gpu", {
-                'video_path': video_path,
-                'output_path': output_path,
-                'encoder': encoder
-            })
-            print(f"❌ خطأ في معالجة GPU [ID: {error_id}]: {str(e)}")
-            return False
+# LRU محدود: عملية الـ API طويلة العمر وكل ملف مرفوع يضيف مدخلاً
+FILE_HASH_CACHE_SIZE = 256
+_file_hash_cache = collections.OrderedDict()
+_file_hash_lock = threading.Lock()
 
-def process_video_fallback(video_path, output_path):
-    """معالجة بديلة باستخدام FFmpeg CPU (أسرع من MoviePy)"""
-    with tempfile.TemporaryDirectory() as temp_dir:
+def _remember_file_hash(cache_key, digest):
+    with _file_hash_lock:
+        _file_hash_cache[cache_key] = digest
+        _file_hash_cache.move_to_end(cache_key)
+        while len(_file_hash_cache) > FILE_HASH_CACHE_SIZE:
+            _file_hash_cache.popitem(last=False)
+
+def get_file_hash(path):
+    """SHA-256 لملف مع تخزين مؤقت حسب (الحجم، وقت التعديل) لتجنب إعادة القراءة"""
+    stat = os.stat(path)
+    cache_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hash_lock:
+        cached = _file_hash_cache.get(cache_key)
+        if cached:
+            _file_hash_cache.move_to_end(cache_key)
+            return cached
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _remember_file_hash(cache_key, digest)
+    return digest
+
+def prime_file_hash(path, digest):
+    """تسجيل SHA-256 محسوب مسبقاً (مثلاً أثناء استقبال الرفع)"""
+    stat = os.stat(path)
+    _remember_file_hash((os.path.abspath(path), stat.st_size, stat.st_mtime_ns), digest)
+
+# r_frame_rate في VFR (MKV/FLV) قد يكون أساس الطوابع الزمنية (1000/1) لا معدل الإطارات
+MAX_OUTPUT_FPS = float(os.getenv('MAX_OUTPUT_FPS', '120'))
+
+def get_stream_fps(video_stream):
+    """معدل إطارات الناتج: avg_frame_rate ثم r_frame_rate، بشرط أن يكون ضمن (0, MAX_OUTPUT_FPS]"""
+    for key in ('avg_frame_rate', 'r_frame_rate'):
+        fps = video_stream.get(key)
+        if not fps:
+            continue
+        num, _, den = fps.partition('/')
         try:
-            # معلومات الفيديوهات
-            video_info = get_video_info(video_path)
-            outro_info = get_video_info(OUTRO_PATH)
-            if not video_info or not outro_info:
-                return False
+            value = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            continue
+        if 0 < value <= MAX_OUTPUT_FPS:
+            return fps
+    return '30/1'
 
-            video_stream = next((s for s in video_info['streams'] if s['codec_type'] == 'video'), None)
-            if not video_stream:
-                return False
+def get_stream_rotation(video_stream):
+    """دوران العرض بالدرجات (وسم rotate أو Display Matrix)، يطبقه FFmpeg تلقائياً عند فك الترميز"""
+    rotation = (video_stream.get('tags') or {}).get('rotate')
+    for side_data in video_stream.get('side_data_list') or []:
+        if 'rotation' in side_data:
+            rotation = side_data['rotation']
+    try:
+        return int(float(rotation or 0)) % 360
+    except ValueError:
+        return 0
 
-            width = int(video_stream['width'])
-            height = int(video_stream['height'])
-            video_has_audio = any(s['codec_type'] == 'audio' for s in video_info['streams'])
-            outro_has_audio = any(s['codec_type'] == 'audio' for s in outro_info['streams'])
-
-            print(f"🖥️ معالجة CPU في تمرير واحد: {width}x{height}")
-
-            # نفس filter_complex لكن مع libx264
-            if video_has_audio and outro_has_audio:
-                filter_complex = (
-                    f'[1:v]scale={width}:{height}[outro_scaled];'
-                    f'[0:v][outro_scaled]concat=n=2:v=1:a=0[concat_v];'
-                    f'movie={WATERMARK_PATH}[wm];'
-                    f'[wm]scale={width}:{height},format=rgba,colorchannelmixer=aa=0.3[wm_scaled];'
-                    f'[concat_v][wm_scaled]overlay=0:0[outv];'
-                    f'[0:a][1:a]concat=n=2:v=0:a=1[outa]'
-                )
-                map_args = ['-map', '[outv]', '-map', '[outa]']
-                audio_codec = ['-c:a', 'aac', '-b:a', '128k']
-            elif video_has_audio and not outro_has_audio:
-                filter_complex = (
-                    f'[1:v]scale={width}:{height}[outro_scaled];'
-                    f'anullsrc=channel_layout=stereo:sample_rate=48000[silence];'
-                    f'[0:v][outro_scaled]concat=n=2:v=1:a=0[concat_v];'
-                    f'movie={WATERMARK_PATH}[wm];'
-                    f'[wm]scale={width}:{height},format=rgba,colorchannelmixer=aa=0.3[wm_scaled];'
-                    f'[concat_v][wm_scaled]overlay=0:0[outv];'
-                    f'[0:a][silence]concat=n=2:v=0:a=1[outa]'
+def get_video_geometry(video_info):
+    """استخراج (الأبعاد، fps، الصوت، المدة) من مخرجات get_video_info"""
+    video_stream = next((s for s in video_info['streams'] if s['codec_type'] == 'video'), None)
+    if not video_stream:
+        return None
+
+    # الأبعاد بعد الدوران التلقائي: مقطع هاتف بدوران 90 يُرمّز عمودياً
+    width, height = int(video_stream['width']), int(video_stream['height'])
+    if get_stream_rotation(video_stream) in (90, 270):
+        width, height = height, width
+
+    has_audio = any(s['codec_type'] == 'audio' for s in video_info['streams'])
+    return {
+        'width': width,
+        'height': height,
+        'fps': get_stream_fps(video_stream),
+        'pix_fmt': 'yuv420p',
+        'audio_layout': AUDIO_LAYOUT_STEREO if has_audio else AUDIO_LAYOUT_NONE,
+        'duration': float(video_info['format'].get('duration', 0) or 0),
+        'start_time': float(video_info['format'].get('start_time', 0) or 0),
+    }
+
+def get_inputs_geometry(video_infos):
+    """
+    أبعاد الناتج لقائمة مدخلات تُدمج معاً: أبعاد وfps المقطع الأول،
+    صوت ستيريو إذا كان لأي مقطع صوت، والمدة مجموع المدد.
+    """
+    inputs = []
+    for info in video_infos:
+        clip = get_video_geometry(info)
+        if not clip:
+            return None
+        inputs.append(clip)
+
+    geometry = dict(inputs[0])
+    geometry['duration'] = sum(clip['duration'] for clip in inputs)
+    if any(clip['audio_layout'] != AUDIO_LAYOUT_NONE for clip in inputs):
+        geometry['audio_layout'] = AUDIO_LAYOUT_STEREO
+    geometry['inputs'] = [
+        {'duration': clip['duration'], 'has_audio': clip['audio_layout'] != AUDIO_LAYOUT_NONE}
+        for clip in inputs
+    ]
+    return geometry
+
+def build_merge_filter(geometry):
+    """
+    توحيد أبعاد وfps وصوت كل المدخلات ثم concat في نفس الرسم البياني،
+    وينتج [cat_v] و [cat_a] (الصوت فقط إذا كان الناتج بصوت).
+    """
+    width, height, fps = geometry['width'], geometry['height'], geometry['fps']
+    with_audio = geometry['audio_layout'] != AUDIO_LAYOUT_NONE
+    parts = []
+    concat_inputs = ''
+    for i, clip in enumerate(geometry['inputs']):
+        parts.append(
+            f"[{i}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1,fps={fps},format=yuv420p[v{i}]"
+        )
+        concat_inputs += f'[v{i}]'
+        if with_audio:
+            if clip['has_audio']:
+                parts.append(
+                    f"[{i}:a:0]aresample=48000,aformat=sample_fmts=fltp:channel_layouts=stereo[a{i}]"
                 )
-                map_args = ['-map', '[outv]', '-map', '[outa]']
-                audio_codec = ['-c:a', 'aac', '-b:a', '128k']
             else:
-                filter_complex = (
-                    f'[1:v]scale={width}:{height}[outro_scaled];'
-                    f'[0:v][outro_scaled]concat=n=2:v=1:a=0[concat_v];'
-                    f'movie={WATERMARK_PATH}[wm];'
-                    f'[wm]scale={width}:{height},format=rgba,colorchannelmixer=aa=0.3[wm_scaled];'
-                    f'[concat_v][wm_scaled]overlay=0:0[outv]'
+                # مقطع بدون صوت داخل دمج بصوت: صمت بنفس مدته
+                parts.append(
+                    f"anullsrc=channel_layout=stereo:sample_rate=48000,"
+                    f"atrim=duration={clip['duration']}[a{i}]"
                 )
-                map_args = ['-map', '[outv]']
-                audio_codec = ['-an']
-
-            # أمر FFmpeg CPU للمعالجة الكاملة
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', video_path,
-                '-i', OUTRO_PATH,
-                '-filter_complex', filter_complex
-            ]
-            cmd.extend(map_args)
-            # قراءة إعدادات CPU من متغيرات البيئة
-            cpu_preset = os.getenv('X264_PRESET', 'veryfast')
-            cpu_crf = os.getenv('X264_CRF', '20')
-            cpu_threads = os.getenv('FFMPEG_THREADS', '0')
-            
-            print(f"🖥️ إعدادات CPU: Preset={cpu_preset}, CRF={cpu_crf}, Threads={cpu_threads}")
-            
-            cmd.extend(['-c:v', 'libx264'])
-            cmd.extend(['-preset', cpu_preset, '-crf', cpu_crf, '-threads', cpu_threads])
-            cmd.extend(audio_codec)
-            cmd.extend(['-movflags', '+faststart'])
-            cmd.append(output_path)
-
-            print("🖥️ معالجة CPU في تمرير واحد...")
-            print(f"أمر FFmpeg CPU: {' '.join(cmd)}")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            if result.returncode == 0:
-                print("✅ تمت المعالجة بنجاح باستخدام CPU!")
-                return True
-            else:
-                print(f"❌ خطأ في معالجة CPU: {result.stderr}")
-                return False
+            concat_inputs += f'[a{i}]'
 
-        except Exception as e:
-            error_id, _ = log_detailed_error(e, "process_video_fallback", {
-                'video_path': video_path,
-                'output_path': output_path
-            })
-            print(f"❌ خطأ في معالجة CPU [ID: {error_id}]: {str(e)}")
-            return False
+    count = len(geometry['inputs'])
+    if with_audio:
+        parts.append(f'{concat_inputs}concat=n={count}:v=1:a=1[cat_v][cat_a]')
+    else:
+        parts.append(f'{concat_inputs}concat=n={count}:v=1:a=0[cat_v]')
+    return ';'.join(parts)
 
-def merge_videos(video1_path, video2_path):
-    """دمج فيديوهين معاً باستخدام FFmpeg مع تنظيف مضمون"""
-    with tempfile.TemporaryDirectory() as temp_dir:
-        merged_path = os.path.join(temp_dir, 'merged_video.mp4')
-        
-        try:
-            # أمر FFmpeg لدمج الفيديوهات بإعدادات محسنة
-            encoder = get_nvenc_encoder()
-            if encoder == 'h264_nvenc':
-                # استخدام GPU للدمج
-                # قراءة إعدادات NVENC من متغيرات البيئة
-                nvenc_settings = get_final_nvenc_settings()
-                
-                merge_cmd = [
-                    'ffmpeg', '-y',
-                    '-i', video1_path,
-                    '-i', video2_path,
-                    '-filter_complex', '[0:v][0:a][1:v][1:a]concat=n=2:v=1:a=1[outv][outa]',
-                    '-map', '[outv]',
-                    '-map', '[outa]',
-                    '-c:a', 'aac'
-                ]
-                merge_cmd.extend(nvenc_settings)
-                merge_cmd.append(merged_path)
-            else:
-                # استخدام CPU مع أسرع إعدادات
-                # قراءة إعدادات CPU من متغيرات البيئة
-                cpu_preset = os.getenv('X264_PRESET', 'veryfast')
-                cpu_crf = os.getenv('X264_CRF', '20')
-                cpu_threads = os.getenv('FFMPEG_THREADS', '0')
-                
-                merge_cmd = [
-                    'ffmpeg', '-y',
-                    '-i', video1_path,
-                    '-i', video2_path,
-                    '-filter_complex', '[0:v][0:a][1:v][1:a]concat=n=2:v=1:a=1[outv][outa]',
-                    '-map', '[outv]',
-                    '-map', '[outa]',
-                    '-c:v', 'libx264',
-                    '-c:a', 'aac',
-                    '-preset', cpu_preset,
-                    '-crf', cpu_crf,
-                    '-threads', cpu_threads,
-                    '-pix_fmt', 'yuv420p',
-                    merged_path
-                ]
-
-            logger.info(f"🔗 دمج الفيديوهات: {' '.join(merge_cmd)}")
-            result = subprocess.run(merge_cmd, capture_output=True, text=True)
-            
-            if result.returncode == 0:
-                logger.info("✅ تم دمج الفيديوهات بنجاح")
-                return merged_path
-            else:
-                logger.error(f"❌ خطأ في دمج الفيديوهات: {result.stderr}")
-                return None
+# شفافية العلامة المائية (كانت colorchannelmixer=aa=0.3 داخل FFmpeg)
+WATERMARK_OPACITY = 0.3
+
+def get_prepared_watermark(width, height):
+    """
+    العلامة المائية مُحجّمة لأبعاد الفيديو ومعدّلة الشفافية (ألفا عادية straight)،
+    ومقصوصة إلى الصندوق غير الشفاف فقط حتى لا يمزج overlay كل بكسلات الإطار.
+    محفوظة على القرص حسب (hash الأصل، الأبعاد) وتُرجع {'path', 'x', 'y'}.
+    """
+    wm_hash = get_file_hash(WATERMARK_PATH)
+    base_name = f"wm_{width}x{height}_{int(WATERMARK_OPACITY * 100)}_straight_{wm_hash[:16]}"
+    cache_path = os.path.join(WATERMARK_CACHE_FOLDER, f"{base_name}.png")
+    meta_path = os.path.join(WATERMARK_CACHE_FOLDER, f"{base_name}.json")
+    if os.path.exists(cache_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return {'path': cache_path, 'x': meta['x'], 'y': meta['y']}
+
+    with Image.open(WATERMARK_PATH) as source:
+        watermark = source.convert('RGBA').resize((width, height), Image.BICUBIC)
+
+    r, g, b, a = watermark.split()
+    a = a.point(lambda v: int(round(v * WATERMARK_OPACITY)))
+    # ألفا عادية: الألوان المضروبة مسبقاً تصبح Y=16 (لا 0) بعد التحويل إلى yuva420p
+    # فيضيف overlay بـ alpha=premultiplied إضاءة لكل الصندوق حتى البكسلات الشفافة
+    watermark = Image.merge('RGBA', (r, g, b, a))
+
+    # الصندوق المحيط بالجزء المرئي، بإحداثيات زوجية لتتوافق مع yuv420
+    left, top, right, bottom = a.getbbox() or (0, 0, 2, 2)
+    left, top = left - left % 2, top - top % 2
+    right = min(width, right + right % 2)
+    bottom = min(height, bottom + bottom % 2)
+    watermark = watermark.crop((left, top, right, bottom))
+
+    # الصورة ثم الموضع، كلاهما بكتابة مؤقتة + os.replace حتى لا يُقرأ ملف ناقص
+    token = uuid.uuid4().hex[:8]
+    tmp_path = f"{cache_path}.{token}.tmp.png"
+    tmp_meta_path = f"{meta_path}.{token}.tmp"
+    watermark.save(tmp_path, format='PNG')
+    with open(tmp_meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'x': left, 'y': top, 'width': right - left, 'height': bottom - top}, f)
+    os.replace(tmp_path, cache_path)
+    os.replace(tmp_meta_path, meta_path)
+    logger.info(
+        f"💧 تم تجهيز العلامة المائية للكاش: {os.path.basename(cache_path)} "
+        f"({right - left}x{bottom - top} عند {left},{top})"
+    )
+    return {'path': cache_path, 'x': left, 'y': top}
+
+def build_watermark_filter(watermark, wm_input_index, in_label, out_label):
+    """
+    دمج العلامة المائية الجاهزة (المدخل رقم wm_input_index) فوق [in_label] وإنتاج [out_label].
+    المزج يتم بصيغة yuv420 الأصلية للفيديو وعلى منطقة العلامة فقط.
+    """
+    return (
+        f"[{wm_input_index}:v]format=yuva420p[wm];"
+        f"[{in_label}][wm]overlay={watermark['x']}:{watermark['y']}"
+        f":format=yuv420[{out_label}]"
+    )
+
+def get_outro_cache_path(geometry, encoder_profile):
+    """مسار الأوترو الجاهز لهذه المجموعة (الأبعاد، fps، pix_fmt، الترميز، الصوت، الأصول)"""
+    key_source = '|'.join([
+        str(geometry['width']), str(geometry['height']), geometry['fps'],
+        geometry['pix_fmt'], encoder_profile['name'], encoder_profile['key'],
+        geometry['audio_layout'], get_file_hash(OUTRO_PATH), get_file_hash(WATERMARK_PATH),
+        str(WATERMARK_OPACITY),
+    ])
+    key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()[:20]
+    return os.path.join(
+        OUTRO_CACHE_FOLDER,
+        f"outro_{geometry['width']}x{geometry['height']}_{encoder_profile['name']}_{key}.mp4"
+    )
+
+def get_cached_outro(geometry, encoder_profile, job=None):
+    """
+    إرجاع الأوترو مُحجّماً ومع العلامة المائية ومرمّزاً بنفس إعدادات المقطع الرئيسي.
+    يُرمّز مرة واحدة لكل مجموعة إعدادات ثم يُعاد استخدامه بالنسخ المباشر.
+    """
+    cache_path = get_outro_cache_path(geometry, encoder_profile)
+    if os.path.exists(cache_path):
+        logger.info(f"♻️ استخدام الأوترو من الكاش: {os.path.basename(cache_path)}")
+        return cache_path
+
+    outro_info = get_video_info(OUTRO_PATH)
+    if not outro_info:
+        return None
+    outro_has_audio = any(s['codec_type'] == 'audio' for s in outro_info['streams'])
+    outro_duration = float(outro_info['format'].get('duration', 0) or 0)
+
+    width, height = geometry['width'], geometry['height']
+    watermark = get_prepared_watermark(width, height)
+    filter_complex = (
+        f"[0:v]scale={width}:{height},setsar=1,fps={geometry['fps']}[outro_scaled];"
+        + build_watermark_filter(watermark, 1, 'outro_scaled', 'outv')
+    )
+
+    threads = plan_threads(job=job)
+    cmd = ['ffmpeg', '-y'] + thread_global_args(threads)
+    cmd.extend(thread_input_args(threads) + ['-i', OUTRO_PATH, '-i', watermark['path']])
+    map_args = ['-map', '[outv]']
+    if geometry['audio_layout'] == AUDIO_LAYOUT_NONE:
+        audio_args = ['-an']
+    elif outro_has_audio:
+        map_args.extend(['-map', '0:a:0'])
+        audio_args = AUDIO_ENCODE_ARGS
+    else:
+        # الأوترو بدون صوت: صمت بنفس مدته حتى يبقى الصوت متصلاً بعد اللصق
+        cmd.extend(['-f', 'lavfi', '-t', str(outro_duration),
+                    '-i', 'anullsrc=channel_layout=stereo:sample_rate=48000'])
+        map_args.extend(['-map', '2:a'])
+        audio_args = AUDIO_ENCODE_ARGS
+
+    tmp_path = f"{cache_path}.{uuid.uuid4().hex[:8]}.tmp.mp4"
+    cmd.extend(['-filter_complex', filter_complex])
+    cmd.extend(map_args)
+    cmd.extend(_with_threads(encoder_profile['args'], threads['encoder']))
+    cmd.extend(audio_args)
+    cmd.extend(SEGMENT_MUX_ARGS)
+    cmd.append(tmp_path)
+
+    logger.info(f"🎞️ ترميز الأوترو للكاش: {' '.join(cmd)}")
+    if job is not None:
+        job.add_work('outro', outro_duration)
+    try:
+        result = run_ffmpeg(cmd, job, 'outro', timeout=encode_time_limit(outro_duration),
+                            stall_timeout=FFMPEG_STALL_TIMEOUT)
+    except JobCancelled:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    if result.returncode != 0:
+        logger.error(f"❌ فشل ترميز الأوترو: {result.stderr}")
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return None
+
+    # إعادة تسمية ذرية حتى لا يقرأ عامل آخر ملفاً نصف مكتوب
+    os.replace(tmp_path, cache_path)
+    logger.info(f"✅ تم حفظ الأوترو في الكاش: {os.path.basename(cache_path)}")
+    return cache_path
+
+def write_concat_list(segment_paths, list_path):
+    """كتابة ملف قائمة concat demuxer"""
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in segment_paths:
+            escaped = os.path.abspath(path).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+
+def concat_segments(segment_paths, output_path):
+    """لصق مقاطع مرمّزة بنفس الإعدادات عبر concat demuxer بدون إعادة ترميز"""
+    list_path = f"{output_path}.concat.txt"
+    try:
+        write_concat_list(segment_paths, list_path)
+
+        cmd = [
+            'ffmpeg', '-y',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            output_path
+        ]
+        logger.info(f"🔗 لصق المقاطع بالنسخ المباشر: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, timeout=copy_time_limit(segment_paths),
+                            stall_timeout=faststart_stall_timeout(segment_paths))
+        if result.returncode != 0:
+            logger.error(f"❌ فشل لصق المقاطع: {result.stderr}")
+            return False
+        return True
+    finally:
+        if os.path.exists(list_path):
+            os.unlink(list_path)
+
+# الترميز المجزأ المتوازي على CPU: تقسيم المدخل عند الإطارات المفتاحية وترميز الأجزاء معاً
+CHUNKED_ENCODING = os.getenv('CHUNKED_ENCODING', 'true').lower() == 'true'
+CHUNK_SECONDS = float(os.getenv('CHUNK_SECONDS', '60'))
+CHUNK_WORKERS = int(os.getenv('CHUNK_WORKERS', '0'))  # 0 = تلقائي حسب عدد الأنوية
+
+def get_keyframe_times(video_path, start_time=0.0):
+    """
+    أزمنة الإطارات المفتاحية لمسار الفيديو الأول (من الحزم بدون فك ترميز).
+    pts_time مطلق بينما -ss على المدخل نسبي إلى start_time للملف (غير صفري في MPEG-TS
+    وMP4 مع edit list)، لذا تُرجع الأزمنة نسبية إلى start_time مثل المدة.
+    """
+    cmd = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_path
+    ]
+    # قائمة الحزم قد تكون ضخمة للمدخلات الطويلة: نحتفظ بالإطارات المفتاحية فقط
+    times = []
+    def collect_keyframe(line):
+        pts_time, _, flags = line.strip().partition(',')
+        if 'K' in flags:
+            try:
+                times.append(float(pts_time) - start_time)
+            except ValueError:
+                pass
+    result = run_ffmpeg(cmd, timeout=copy_time_limit([video_path]), stdout_handler=collect_keyframe)
+    if result.returncode != 0:
+        return []
+    return sorted(set(times))
+
+def plan_chunks(keyframes, duration, chunk_seconds):
+    """
+    تقسيم [0, duration] إلى أجزاء تبدأ كلها عند إطار مفتاحي وبطول chunk_seconds تقريباً.
+    الأزمنة نسبية إلى start_time؛ الجزء الأول يبدأ من 0 حتى لا يضيع أول الفيديو.
+    """
+    if not keyframes or duration <= 0:
+        return []
+    chunks = []
+    start = 0.0
+    for kf in keyframes:
+        if kf <= 0:
+            continue
+        if kf - start >= chunk_seconds and duration - kf >= chunk_seconds / 2:
+            chunks.append((start, kf))
+            start = kf
+    chunks.append((start, duration))
+    return chunks if len(chunks) > 1 else []
+
+def _with_threads(encoder_args, threads):
+    """نسخة من إعدادات الترميز مع قيمة -threads مختلفة"""
+    args = list(encoder_args)
+    if '-threads' in args:
+        args[args.index('-threads') + 1] = str(threads)
+    else:
+        args.extend(['-threads', str(threads)])
+    return args
+
+def encode_main_segment(video_paths, main_segment, geometry, encoder_profile, watermark, label,
+                        job=None):
+    """
+    ترميز المقطع الرئيسي كاملاً في تمرير واحد (فيديو + صوت).
+    عند وجود أكثر من مدخل يتم التوحيد والدمج والعلامة المائية في نفس أمر FFmpeg
+    بدل ترميز ملف مدموج وسيط ثم إعادة ترميزه.
+    """
+    wm_index = len(video_paths)
+    if len(video_paths) == 1:
+        # setsar=1 مثل الأوترو المخزن ومسار الدمج، حتى يتطابق SAR عند اللصق بالنسخ المباشر
+        filter_complex = (
+            f"[0:v]setsar=1,fps={geometry['fps']}[main_v];"
+            + build_watermark_filter(watermark, wm_index, 'main_v', 'outv')
+        )
+        audio_map = '0:a:0'
+    else:
+        filter_complex = (
+            build_merge_filter(geometry) + ';'
+            + build_watermark_filter(watermark, wm_index, 'cat_v', 'outv')
+        )
+        audio_map = '[cat_a]'
+
+    map_args = ['-map', '[outv]']
+    if geometry['audio_layout'] == AUDIO_LAYOUT_NONE:
+        audio_args = ['-an']
+    else:
+        map_args.extend(['-map', audio_map])
+        audio_args = AUDIO_ENCODE_ARGS
+
+    threads = plan_threads(job=job)
+    cmd = ['ffmpeg', '-y'] + thread_global_args(threads)
+    for path in video_paths:
+        cmd.extend(thread_input_args(threads) + ['-i', path])
+    cmd.extend([
+        '-i', watermark['path'],
+        '-filter_complex', filter_complex
+    ])
+    cmd.extend(map_args)
+    cmd.extend(_with_threads(encoder_profile['args'], threads['encoder']))
+    cmd.extend(audio_args)
+    cmd.extend(SEGMENT_MUX_ARGS)
+    cmd.append(main_segment)
+
+    print(f"أمر FFmpeg {label}: {' '.join(cmd)}")
+    if job is not None:
+        job.add_work('main', geometry['duration'])
+    if job is not None and job.ingest is not None:
+        # المدخل يصل بسرعة الرفع والمدة من ملف ناقص: التوقف يُقاس بمهلة الرفع،
+        # والحد الأقصى يُحسب من المدة الحقيقية بعد وصول الملف كاملاً (GrowingUpload.deadline)
+        time_limit, stall_timeout = None, STREAMING_INGEST_STALL
+    else:
+        time_limit, stall_timeout = encode_time_limit(geometry['duration']), FFMPEG_STALL_TIMEOUT
+    result = run_ffmpeg(cmd, job, 'main', timeout=time_limit, stall_timeout=stall_timeout)
+    if result.returncode != 0:
+        print(f"❌ خطأ في معالجة {label}: {result.stderr}")
+        return False
+    return True
+
+def encode_video_chunk(video_path, chunk_path, start, end, geometry, encoder_args, watermark,
+                       job=None, job_key=None, threads=None):
+    """ترميز جزء فيديو واحد [start, end) بنفس سلسلة العلامة المائية (بدون صوت)"""
+    if threads is None:
+        threads = plan_threads(job=job)
+    filter_complex = (
+        f"[0:v]setsar=1,fps={geometry['fps']}[main_v];"
+        + build_watermark_filter(watermark, 1, 'main_v', 'outv')
+    )
+    cmd = ['ffmpeg', '-y'] + thread_global_args(threads) + thread_input_args(threads) + [
+        '-ss', f'{start:.6f}', '-t', f'{end - start:.6f}', '-i', video_path,
+        '-i', watermark['path'],
+        '-filter_complex', filter_complex,
+        '-map', '[outv]'
+    ]
+    cmd.extend(_with_threads(encoder_args, threads['encoder']))
+    cmd.append('-an')
+    cmd.extend(SEGMENT_MUX_ARGS)
+    cmd.append(chunk_path)
+
+    result = run_ffmpeg(cmd, job, job_key, timeout=encode_time_limit(end - start),
+                        stall_timeout=FFMPEG_STALL_TIMEOUT)
+    if result.returncode != 0:
+        logger.error(f"❌ فشل ترميز الجزء {start:.2f}-{end:.2f}: {result.stderr}")
+        return False
+    return True
+
+def encode_main_chunked(video_path, main_segment, geometry, encoder_profile, watermark, temp_dir,
+                        job=None):
+    """
+    ترميز المقطع الرئيسي على أجزاء متوازية مقسومة عند الإطارات المفتاحية،
+    ثم لصق الأجزاء بالنسخ المباشر مع ترميز الصوت مرة واحدة للمقطع كاملاً
+    (حتى لا تظهر فجوات AAC عند حدود الأجزاء).
+    يُرجع None إذا كان المدخل غير مناسب للتقسيم.
+    """
+    keyframes = get_keyframe_times(video_path, geometry['start_time'])
+    chunks = plan_chunks(keyframes, geometry['duration'], CHUNK_SECONDS)
+    if not chunks:
+        return None
+
+    # عدد الأجزاء المتوازية من نصيب هذه المهمة من الأنوية (لا من كل أنوية الجهاز)
+    slot_cores = plan_threads(job=job)['encoder']
+    workers = CHUNK_WORKERS or max(1, slot_cores // 4)
+    workers = min(workers, len(chunks))
+    threads = plan_threads(workers, job)
+    logger.info(f"🧩 ترميز مجزأ: {len(chunks)} أجزاء × {workers} متوازية × {threads['encoder']} خيوط "
+                f"({CHUNK_SECONDS:.0f}s لكل جزء)")
+
+    # ThreadPoolExecutor يكفي: العمل الفعلي داخل عمليات FFmpeg المنفصلة،
+    # وعمليات Celery (prefork) لا تسمح بإنشاء multiprocessing.Pool داخلها
+    chunk_paths = [os.path.join(temp_dir, f'chunk_{i:04d}.mp4') for i in range(len(chunks))]
+    if job is not None:
+        for i, (start, end) in enumerate(chunks):
+            job.add_work(f'chunk_{i:04d}', end - start)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(encode_video_chunk, video_path, chunk_path, start, end,
+                        geometry, encoder_profile['args'], watermark, job, f'chunk_{i:04d}', threads)
+            for i, (chunk_path, (start, end)) in enumerate(zip(chunk_paths, chunks))
+        ]
+        try:
+            ok = all(future.result() for future in futures)
+        finally:
+            # عند فشل/توقف/إلغاء جزء لا داعي لترميز الأجزاء التي لم تبدأ بعد
+            for future in futures:
+                future.cancel()
+    if not ok:
+        if job is not None:
+            job.remove('chunk_')
+        return False
+
+    return join_video_chunks(chunk_paths, video_path, main_segment, geometry)
+
+def join_video_chunks(chunk_paths, video_path, main_segment, geometry):
+    """لصق أجزاء الفيديو بالنسخ المباشر مع ترميز صوت المدخل الأصلي مرة واحدة، ثم حذف الأجزاء"""
+    list_path = f"{main_segment}.chunks.txt"
+    write_concat_list(chunk_paths, list_path)
+    cmd = [
+        'ffmpeg', '-y',
+        '-f', 'concat', '-safe', '0', '-i', list_path,
+        '-i', video_path,
+        '-map', '0:v'
+    ]
+    if geometry['audio_layout'] == AUDIO_LAYOUT_NONE:
+        cmd.append('-an')
+    else:
+        cmd.extend(['-map', '1:a:0'])
+        cmd.extend(AUDIO_ENCODE_ARGS)
+    cmd.extend(['-c:v', 'copy'])
+    cmd.extend(SEGMENT_MUX_ARGS)
+    cmd.append(main_segment)
+
+    logger.info(f"🔗 تجميع الأجزاء مع الصوت: {' '.join(cmd)}")
+    result = run_ffmpeg(cmd, timeout=copy_time_limit(chunk_paths + [video_path]),
+                        stall_timeout=FFMPEG_STALL_TIMEOUT)
+    for path in chunk_paths + [list_path]:
+        if os.path.exists(path):
+            os.unlink(path)
+    if result.returncode != 0:
+        logger.error(f"❌ فشل تجميع الأجزاء: {result.stderr}")
+        return False
+    return True
+
+def process_video_with_outro(video_paths, output_path, use_gpu, temp_dir, job=None):
+    """
+    ترميز المقطع الرئيسي (مدخل واحد أو عدة مدخلات تُدمج) مع العلامة المائية
+    بإعدادات الأوترو المخزن، ثم لصق الأوترو الجاهز بالنسخ المباشر.
+    على CPU تُرمّز المدخلات الفردية الطويلة على أجزاء متوازية (CHUNKED_ENCODING).
+    """
+    if isinstance(video_paths, str):
+        video_paths = [video_paths]
+
+    video_infos = [get_video_info(path) for path in video_paths]
+    if not all(video_infos):
+        return False
+    geometry = get_inputs_geometry(video_infos)
+    if not geometry:
+        return False
+
+    encoder_profile = get_encoder_profile(use_gpu, job.x264_preset if job is not None else None)
+    outro_path = get_cached_outro(geometry, encoder_profile, job)
+    if not outro_path:
+        return False
+
+    width, height = geometry['width'], geometry['height']
+    watermark = get_prepared_watermark(width, height)
+    main_segment = os.path.join(temp_dir, 'main.mp4')
+
+    label = 'GPU' if use_gpu else 'CPU'
+    print(f"🚀 معالجة {label}: {len(video_paths)} مدخل → {width}x{height} @ {geometry['fps']}")
+
+    # الترميز أثناء الرفع: تمرير واحد يقرأ الملف النامي بالترتيب (التقسيم يحتاج الملف كاملاً)
+    streaming = job is not None and job.ingest is not None
+    if streaming:
+        video_paths = [job.ingest.feed()]
+
+    encoded = None
+    if (not use_gpu and CHUNKED_ENCODING and not streaming and len(video_paths) == 1
+            and geometry['duration'] >= 2 * CHUNK_SECONDS):
+        encoded = encode_main_chunked(video_paths[0], main_segment, geometry, encoder_profile, watermark,
+                                      temp_dir, job)
+        if encoded is False:
+            logger.warning("⚠️ فشل الترميز المجزأ، الانتقال إلى تمرير واحد...")
+    if not encoded:
+        if not encode_main_segment(video_paths, main_segment, geometry, encoder_profile, watermark, label,
+                                   job):
+            return False
+
+    return concat_segments([main_segment, outro_path], output_path)
+
+def process_video_ffmpeg_gpu(video_paths, output_path, job=None):
+    """معالجة الفيديو (أو عدة فيديوهات تُدمج) باستخدام FFmpeg مع تسريع GPU ثم لصق الأوترو المخزن"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            # استخدام h264_nvenc فقط (أسرع وأكثر توافقاً)
+            encoder = 'h264_nvenc'
+
+            # التحقق من دعم NVENC
+            nvenc_available = get_nvenc_encoder()
+            if nvenc_available != "h264_nvenc":
+                print("❌ h264_nvenc غير متوفر، استخدم CPU")
+                return False
+
+            if process_video_with_outro(video_paths, output_path, True, temp_dir, job):
+                print("✅ تمت المعالجة بنجاح باستخدام GPU!")
+                return True
+            return False
+
+        except JobCancelled:
+            raise
+        except Exception as e:
+            error_id, _ = log_detailed_error(e, "process_video_ffmpeg_gpu", {
+                'video_paths': video_paths,
+                'output_path': output_path,
+                'encoder': encoder
+            })
+            print(f"❌ خطأ في معالجة GPU [ID: {error_id}]: {str(e)}")
+            return False
+
+def process_video_fallback(video_paths, output_path, job=None):
+    """معالجة بديلة باستخدام FFmpeg CPU (مدخل أو عدة مدخلات تُدمج) ثم لصق الأوترو المخزن"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            if process_video_with_outro(video_paths, output_path, False, temp_dir, job):
+                print("✅ تمت المعالجة بنجاح باستخدام CPU!")
+                return True
+            return False
+
+        except JobCancelled:
+            raise
+        except Exception as e:
+            error_id, _ = log_detailed_error(e, "process_video_fallback", {
+                'video_paths': video_paths,
+                'output_path': output_path
+            })
+            print(f"❌ خطأ في معالجة CPU [ID: {error_id}]: {str(e)}")
+            return False
+
+# مفاتيح ffprobe التي يجب أن تتطابق حتى يمكن دمج المدخلات بالنسخ المباشر
+COPY_MERGE_VIDEO_KEYS = ('codec_name', 'profile', 'level', 'width', 'height', 'pix_fmt',
+                         'r_frame_rate', 'time_base', 'sample_aspect_ratio')
+COPY_MERGE_AUDIO_KEYS = ('codec_name', 'profile', 'sample_rate', 'channels', 'channel_layout')
+
+def get_stream_signature(video_info):
+    """بصمة معاملات التدفقات (فيديو + صوت) للمقارنة بين المدخلات"""
+    signature = []
+    for stream in video_info['streams']:
+        if stream['codec_type'] == 'video':
+            signature.append(('video',) + tuple(stream.get(k) for k in COPY_MERGE_VIDEO_KEYS))
+        elif stream['codec_type'] == 'audio':
+            signature.append(('audio',) + tuple(stream.get(k) for k in COPY_MERGE_AUDIO_KEYS))
+    return tuple(signature)
+
+def merge_videos_copy(video_paths, merged_path):
+    """
+    دمج سريع بالنسخ المباشر (concat demuxer + -c copy) عندما تتطابق معاملات كل المدخلات.
+    يُرجع False إذا اختلفت المعاملات أو فشل الدمج، فيُستخدم مسار إعادة الترميز.
+    """
+    infos = [get_video_info(path) for path in video_paths]
+    if not all(infos):
+        return False
+    signatures = {get_stream_signature(info) for info in infos}
+    if len(signatures) != 1:
+        logger.info("🔀 معاملات المدخلات مختلفة، الدمج سيتم داخل أمر الترميز")
+        return False
+
+    list_path = f"{merged_path}.concat.txt"
+    try:
+        write_concat_list(video_paths, list_path)
+        cmd = [
+            'ffmpeg', '-y',
+            '-f', 'concat', '-safe', '0', '-i', list_path,
+            '-map', '0', '-c', 'copy',
+            merged_path
+        ]
+        logger.info(f"⚡ دمج بالنسخ المباشر: {' '.join(cmd)}")
+        result = run_ffmpeg(cmd, timeout=copy_time_limit(video_paths), stall_timeout=FFMPEG_STALL_TIMEOUT)
+        if result.returncode != 0:
+            logger.warning(f"⚠️ فشل الدمج بالنسخ المباشر: {result.stderr}")
+            if os.path.exists(merged_path):
+                os.unlink(merged_path)
+            return False
+        return True
+    finally:
+        if os.path.exists(list_path):
+            os.unlink(list_path)
+
+def prepare_merge_inputs(video_paths):
+    """
+    تجهيز المدخلات قبل الترميز: إذا كانت متطابقة تُدمج بالنسخ المباشر إلى ملف واحد
+    بجانب المدخل الأول (فيصبح مؤهلاً للترميز المجزأ/الموزع).
+    يُرجع (video_paths, merge_mode) حيث merge_mode: None أو 'copy' أو 'reencode'.
+    """
+    if len(video_paths) < 2:
+        return video_paths, None
+    # النقطة في البداية تمنع التصادم مع ملف مرفوع (secure_filename يحذف النقاط البادئة)
+    merged_path = os.path.join(os.path.dirname(video_paths[0]), '.merged_copy.mkv')
+    if merge_videos_copy(video_paths, merged_path):
+        logger.info("✅ تم الدمج بالنسخ المباشر")
+        return [merged_path], 'copy'
+    return video_paths, 'reencode'
+
+def cleanup_merged_copy(video_paths, merge_mode):
+    """حذف ملف الدمج بالنسخ المباشر بعد انتهاء الترميز"""
+    if merge_mode != 'copy':
+        return
+    try:
+        os.unlink(video_paths[0])
+        logger.info("🧹 تم تنظيف الملف المدموج المؤقت")
+    except OSError as e:
+        logger.warning(f"⚠️ فشل في تنظيف الملف المؤقت: {str(e)}")
+
+def mark_job_cancelled(task, video_path, output_path, job_id=None):
+    """
+    تنظيف مهمة ملغاة: حذف الناتج الجزئي ومجلد المشروع المرفوع (المدخلات، الملف
+    المدموج، أجزاء الترميز الموزع) ثم تعيين الحالة CANCELLED.
+    task=None مع job_id للتنظيف من خارج المهمة (errback الترميز الموزع).
+    """
+    if output_path and os.path.exists(output_path):
+        os.unlink(output_path)
+    project_folder = os.path.realpath(os.path.dirname(video_path))
+    if os.path.dirname(project_folder) == os.path.realpath(app.config['UPLOAD_FOLDER']):
+        shutil.rmtree(project_folder, ignore_errors=True)
+    meta = {
+        'progress': 0,
+        'status': 'تم إلغاء المعالجة',
+        'timestamp': datetime.datetime.now().isoformat()
+    }
+    if task is not None:
+        job_id = task.request.id
+        task.update_state(state='CANCELLED', meta=meta)
+    else:
+        celery.backend.store_result(job_id, meta, 'CANCELLED')
+    logger.info(f"🛑 تم إلغاء المهمة {job_id} وتنظيف ملفاتها")
+
+# نموذج تكلفة الترميز: ثوانٍ متوقعة = overhead + work / rate لكل مسار ترميز،
+# حيث work = ميغابكسل-إطارات الناتج مع معامل لصعوبة فك ترميز المدخل.
+# يُعاد ضبطه من أزمنة المهام المكتملة المحفوظة محلياً في CACHE_FOLDER.
+COST_MODEL_PATH = os.path.join(app.config['CACHE_FOLDER'], 'cost_model.json')
+COST_MODEL_MAX_SAMPLES = 200
+COST_MODEL_MIN_SAMPLES = 5
+# تقديرات أولية قبل المعايرة (ميغابكسل/ثانية لكل نواة لـ x264، وللجهاز كاملاً لـ NVENC)
+X264_PRESET_MPIX_PER_CORE = {
+    'ultrafast': 40.0, 'superfast': 28.0, 'veryfast': 16.0, 'faster': 11.0,
+    'fast': 9.0, 'medium': 7.0, 'slow': 4.5, 'slower': 2.5, 'veryslow': 1.2,
+}
+NVENC_MPIX_PER_SECOND = 300.0
+DEFAULT_ENCODE_OVERHEAD = 3.0  # ثوانٍ (ffprobe، تهيئة FFmpeg، لصق الأوترو)
+DECODE_COST_FACTORS = {'h264': 1.0, 'mpeg4': 0.9, 'hevc': 1.3, 'vp9': 1.3, 'av1': 1.6, 'prores': 1.2}
+
+_cost_model_cache = {'mtime': None, 'samples': {}}
+
+def _fps_value(fps):
+    num, _, den = str(fps).partition('/')
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 30.0
+
+def get_encoder_path_key(use_gpu, x264_preset=None):
+    """مفتاح مسار الترميز في نموذج التكلفة (nvenc أو x264_<preset>)"""
+    return 'nvenc' if use_gpu else f"x264_{x264_preset or get_x264_preset()}"
+
+def get_job_features(video_infos, merge_mode=None):
+    """خصائص المهمة المؤثرة على زمن الترميز من مخرجات get_video_info"""
+    geometry = get_inputs_geometry(video_infos)
+    if not geometry:
+        return None
+    codecs = [
+        next((s.get('codec_name') for s in info['streams'] if s['codec_type'] == 'video'), None)
+        for info in video_infos
+    ]
+    fps = _fps_value(geometry['fps'])
+    decode_factor = max(DECODE_COST_FACTORS.get(codec, 1.1) for codec in codecs)
+    # الدمج بإعادة الترميز يضيف توحيد الأبعاد لكل مدخل داخل نفس الأمر
+    merge_factor = 1.05 if merge_mode == 'reencode' or (merge_mode is None and len(video_infos) > 1) else 1.0
+    work = geometry['duration'] * fps * geometry['width'] * geometry['height'] / 1e6
+    return {
+        'duration': round(geometry['duration'], 2),
+        'width': geometry['width'],
+        'height': geometry['height'],
+        'fps': round(fps, 3),
+        'codecs': codecs,
+        'has_audio': geometry['audio_layout'] != AUDIO_LAYOUT_NONE,
+        'inputs': len(video_infos),
+        'merge_mode': merge_mode,
+        'work': round(work * decode_factor * merge_factor, 2),
+    }
+
+def _load_cost_samples():
+    """عينات المعايرة (تُقرأ من الملف فقط عند تغيره)"""
+    try:
+        mtime = os.path.getmtime(COST_MODEL_PATH)
+    except OSError:
+        return {}
+    if _cost_model_cache['mtime'] != mtime:
+        try:
+            with open(COST_MODEL_PATH) as f:
+                _cost_model_cache['samples'] = json.load(f).get('samples', {})
+            _cost_model_cache['mtime'] = mtime
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠️ تعذر قراءة نموذج التكلفة: {e}")
+            return {}
+    return _cost_model_cache['samples']
+
+def get_estimate_cores():
+    """
+    أنوية العامل الذي سيرمّز المهمة: أنوية هذه العملية داخل العامل، وفي خادم الـ API
+    وسيط ما تعلنه العمال الحية (أنوية الـ API ليست أنوية الترميز).
+    """
+    if _worker_info.get('hostname'):
+        return get_cpu_budget()
+    cores = sorted(w['cores'] for w in get_live_workers() if w.get('cores'))
+    return cores[len(cores) // 2] if cores else get_cpu_budget()
+
+def _default_cost_params(path_key):
+    if path_key == 'nvenc':
+        rate = NVENC_MPIX_PER_SECOND
+    else:
+        preset = path_key.split('_', 1)[1] if '_' in path_key else 'veryfast'
+        rate = X264_PRESET_MPIX_PER_CORE.get(preset, 16.0) * get_estimate_cores()
+    return DEFAULT_ENCODE_OVERHEAD, 1.0 / rate
+
+def fit_cost_params(samples):
+    """
+    ملاءمة seconds = overhead + per_mpix * work بالمربعات الصغرى.
+    إذا لم تكن النتيجة منطقية (تباين ضئيل في work) يُستخدم الوسيط مع overhead الافتراضي.
+    """
+    n = len(samples)
+    mean_w = sum(w for w, _ in samples) / n
+    mean_s = sum(s for _, s in samples) / n
+    var_w = sum((w - mean_w) ** 2 for w, _ in samples)
+    if var_w > 0:
+        per_mpix = sum((w - mean_w) * (s - mean_s) for w, s in samples) / var_w
+        overhead = mean_s - per_mpix * mean_w
+        if per_mpix > 0 and overhead >= 0:
+            return overhead, per_mpix
+    ratios = sorted(max(s - DEFAULT_ENCODE_OVERHEAD, 0.0) / w for w, s in samples if w > 0)
+    if not ratios:
+        return None
+    return DEFAULT_ENCODE_OVERHEAD, ratios[len(ratios) // 2]
+
+def get_cost_params(path_key):
+    """(overhead، ثوانٍ لكل ميغابكسل، عدد العينات) لمسار ترميز"""
+    samples = _load_cost_samples().get(path_key, [])
+    if len(samples) >= COST_MODEL_MIN_SAMPLES:
+        params = fit_cost_params(samples)
+        if params:
+            return params[0], params[1], len(samples)
+    overhead, per_mpix = _default_cost_params(path_key)
+    return overhead, per_mpix, len(samples)
+
+def estimate_job_cost(video_infos, merge_mode=None):
+    """
+    تقدير ثواني الترميز لكل مسار (NVENC و x264 بالـ preset الحالي).
+    يُرجع None إذا تعذر تحليل المدخلات.
+    """
+    if not video_infos or not all(video_infos):
+        return None
+    features = get_job_features(video_infos, merge_mode)
+    if not features:
+        return None
+    paths = {}
+    for path_key in (get_encoder_path_key(True), get_encoder_path_key(False),
+                     get_encoder_path_key(False, get_x264_preset(OUTPUT_PROFILE_ECONOMY))):
+        overhead, per_mpix, samples = get_cost_params(path_key)
+        paths[path_key] = {
+            'seconds': round(overhead + per_mpix * features['work'], 1),
+            'calibrated': samples >= COST_MODEL_MIN_SAMPLES,
+            'samples': samples,
+        }
+    return {'features': features, 'paths': paths}
+
+def record_cost_sample(path_key, work, seconds):
+    """إضافة زمن مهمة مكتملة لعينات المعايرة (كتابة ذرية مع قفل بين العمليات)"""
+    if not work or seconds <= 0:
+        return
+    try:
+        os.makedirs(os.path.dirname(COST_MODEL_PATH), exist_ok=True)
+        with open(f"{COST_MODEL_PATH}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(COST_MODEL_PATH) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {'samples': {}}
+            samples = data.setdefault('samples', {}).setdefault(path_key, [])
+            samples.append([round(work, 2), round(seconds, 2)])
+            del samples[:-COST_MODEL_MAX_SAMPLES]
+            tmp_path = f"{COST_MODEL_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, COST_MODEL_PATH)
+        logger.info(f"📈 معايرة التكلفة [{path_key}]: {work:.0f} Mpix في {seconds:.1f}s")
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر حفظ عينة التكلفة: {e}")
+
+# preset لـ x264 لكل مهمة: أبطأ (ضغط أفضل بنفس CRF) عندما يكون الطابور فارغاً،
+# وأسرع عند تراكم العمل، ضمن الحدود [X264_PRESET_FASTEST, X264_PRESET_SLOWEST]
+X264_PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow')
+ADAPTIVE_PRESET = os.getenv('ADAPTIVE_PRESET', 'true').lower() == 'true'
+X264_PRESET_FASTEST = os.getenv('X264_PRESET_FASTEST', 'superfast')
+X264_PRESET_SLOWEST = os.getenv('X264_PRESET_SLOWEST', 'medium')
+# ثوانٍ منتظرة لكل خانة: حتى IDLE يُسمح بالأبطأ، ومن BUSY تبدأ خطوات التسريع
+ADAPTIVE_PRESET_IDLE_BACKLOG = float(os.getenv('ADAPTIVE_PRESET_IDLE_BACKLOG', '60'))
+ADAPTIVE_PRESET_BUSY_BACKLOG = float(os.getenv('ADAPTIVE_PRESET_BUSY_BACKLOG', '900'))
+# أقصى زمن ترميز مقدر للمهمة بـ preset أبطأ من الافتراضي (المهام الكبيرة لا تحجز الخانة لساعات)
+ADAPTIVE_PRESET_MAX_SECONDS = float(os.getenv('ADAPTIVE_PRESET_MAX_SECONDS', '900'))
+
+def _preset_index(name, default):
+    try:
+        return X264_PRESETS.index(name)
+    except ValueError:
+        return X264_PRESETS.index(default)
+
+def choose_x264_preset(work, backlog_per_slot):
+    """
+    preset لمهمة بحجم work (ميغابكسل-إطارات) حسب العمل المنتظر لكل خانة:
+    - حمل غير معروف: X264_PRESET
+    - طابور فارغ تقريباً: أبطأ preset ضمن الحدود يبقى زمنه المقدر تحت ADAPTIVE_PRESET_MAX_SECONDS
+    - طابور مزدحم: خطوة أسرع لكل مضاعفة لـ ADAPTIVE_PRESET_BUSY_BACKLOG حتى X264_PRESET_FASTEST
+    """
+    fastest = _preset_index(X264_PRESET_FASTEST, 'ultrafast')
+    slowest = max(_preset_index(X264_PRESET_SLOWEST, 'veryslow'), fastest)
+    base = min(max(_preset_index(get_x264_preset(), 'veryfast'), fastest), slowest)
+    if not ADAPTIVE_PRESET or backlog_per_slot is None:
+        return X264_PRESETS[base]
+
+    if backlog_per_slot <= ADAPTIVE_PRESET_IDLE_BACKLOG:
+        if not work:
+            return X264_PRESETS[base]
+        for index in range(slowest, base, -1):
+            overhead, per_mpix, _ = get_cost_params(f'x264_{X264_PRESETS[index]}')
+            if overhead + per_mpix * work <= ADAPTIVE_PRESET_MAX_SECONDS:
+                return X264_PRESETS[index]
+        return X264_PRESETS[base]
+
+    index = base
+    threshold = ADAPTIVE_PRESET_BUSY_BACKLOG
+    while backlog_per_slot >= threshold and index > fastest:
+        index -= 1
+        threshold *= 2
+    return X264_PRESETS[index]
+
+# الترميز الموزع: أجزاء المدخلات الطويلة جداً تُرسل كمهام Celery مستقلة لكل العمال
+DISTRIBUTED_ENCODING = os.getenv('DISTRIBUTED_ENCODING', 'false').lower() == 'true'
+DISTRIBUTED_MIN_DURATION = float(os.getenv('DISTRIBUTED_MIN_DURATION', '1800'))  # ثانية
+DISTRIBUTED_CHUNK_SECONDS = float(os.getenv('DISTRIBUTED_CHUNK_SECONDS', '300'))
+CHUNK_MAX_RETRIES = int(os.getenv('CHUNK_MAX_RETRIES', '3'))
+
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(Exception,), dont_autoretry_for=(JobCancelled,),
+             max_retries=CHUNK_MAX_RETRIES, retry_backoff=True, retry_jitter=True)
+def encode_chunk_task(self, video_path, chunk_path, start, end, geometry, encoder_args, job_id=None):
+    """مهمة Celery لترميز جزء واحد من فيديو طويل (يُعاد تلقائياً عند الفشل)"""
+    # الجزء يتبع علامة إلغاء المهمة الأصلية وليس معرفه الخاص
+    job = FFmpegJob(job_id=job_id)
+    job.check_cancelled()
+    watermark = get_prepared_watermark(geometry['width'], geometry['height'])
+    logger.info(f"🧩 ترميز الجزء {start:.2f}-{end:.2f} (محاولة {self.request.retries + 1})")
+    # كل عامل يحسب خيوطه من ميزانية جهازه بدل قيمة العامل المنسّق
+    slot = acquire_job_slot()
+    job.placement = plan_job_placement(slot, 'batch')
+    try:
+        if not encode_video_chunk(video_path, chunk_path, start, end, geometry, encoder_args, watermark, job):
+            raise Exception(f"فشل ترميز الجزء {start:.2f}-{end:.2f}")
+    finally:
+        release_job_slot(slot)
+    return chunk_path
+
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def join_chunks_task(self, chunk_paths, video_path, output_path, geometry, encoder_profile, chunks_dir,
+                     merge_mode=None):
+    """callback الـ chord: لصق الأجزاء مع الصوت ثم إلحاق الأوترو المخزن"""
+    try:
+        if is_job_cancelled(self.request.id):
+            mark_job_cancelled(self, video_path, output_path)
+            raise Ignore()
+        self.update_state(state='PROCESSING', meta={'progress': 90, 'status': 'تجميع الأجزاء...'})
+        main_segment = os.path.join(chunks_dir, 'main.mp4')
+        if not join_video_chunks(chunk_paths, video_path, main_segment, geometry):
+            raise Exception("فشل تجميع الأجزاء")
+
+        outro_path = get_cached_outro(geometry, encoder_profile)
+        if not outro_path or not concat_segments([main_segment, outro_path], output_path):
+            raise Exception("فشل إلحاق الأوترو")
+
+        args = encoder_profile['args']
+        return {'status': 'completed', 'output_path': output_path,
+                'mode': 'distributed', 'chunks': len(chunk_paths), 'merge_mode': merge_mode,
+                'x264_preset': args[args.index('-preset') + 1]}
+    finally:
+        shutil.rmtree(chunks_dir, ignore_errors=True)
+        if os.path.exists(video_path):
+            cleanup_merged_copy([video_path], merge_mode)
+
+@celery.task
+def cleanup_chunks_task(chunks_dir, video_path=None, output_path=None, merge_mode=None, job_id=None):
+    """
+    errback الـ chord عند فشل أحد الأجزاء: حذف مجلد الأجزاء والملف المدموج.
+    إذا كان الفشل بسبب إلغاء المهمة (JobCancelled في الأجزاء) يُنظف كإلغاء وتصبح الحالة CANCELLED.
+    """
+    shutil.rmtree(chunks_dir, ignore_errors=True)
+    logger.info(f"🧹 تم تنظيف أجزاء الترميز الموزع: {chunks_dir}")
+    if video_path is None:
+        return
+    if is_job_cancelled(job_id):
+        mark_job_cancelled(None, video_path, output_path, job_id)
+    elif os.path.exists(video_path):
+        cleanup_merged_copy([video_path], merge_mode)
+
+def build_distributed_encode(video_path, output_path, job_id, merge_mode=None, x264_preset=None):
+    """
+    تجهيز chord للترميز الموزع: جزء لكل مهمة encode_chunk_task ثم join_chunks_task.
+    الأجزاء تُكتب بجانب المدخل داخل UPLOAD_FOLDER المشترك بين كل العمال.
+    يُرجع None إذا كان الترميز الموزع غير مناسب لهذا المدخل.
+    """
+    upload_root = os.path.realpath(app.config['UPLOAD_FOLDER'])
+    if not os.path.realpath(video_path).startswith(upload_root):
+        return None
+
+    video_info = get_video_info(video_path)
+    geometry = get_video_geometry(video_info) if video_info else None
+    if not geometry or geometry['duration'] < DISTRIBUTED_MIN_DURATION:
+        return None
+
+    keyframes = get_keyframe_times(video_path, geometry['start_time'])
+    chunks = plan_chunks(keyframes, geometry['duration'], DISTRIBUTED_CHUNK_SECONDS)
+    if not chunks:
+        return None
+
+    # كل الأجزاء بنفس ملف x264 حتى تُلصق بالنسخ المباشر مهما كان العامل
+    encoder_profile = get_encoder_profile(False, x264_preset)
+    if not get_cached_outro(geometry, encoder_profile):
+        return None
+
+    chunks_dir = os.path.join(os.path.dirname(video_path), f'chunks_{job_id}')
+    os.makedirs(chunks_dir, exist_ok=True)
+    header = [
+        encode_chunk_task.s(video_path, os.path.join(chunks_dir, f'chunk_{i:04d}.mp4'),
+                            start, end, geometry, encoder_profile['args'], job_id)
+        for i, (start, end) in enumerate(chunks)
+    ]
+    body = join_chunks_task.s(video_path, output_path, geometry, encoder_profile, chunks_dir, merge_mode)
+    body.on_error(cleanup_chunks_task.si(chunks_dir, video_path, output_path, merge_mode, job_id))
+    logger.info(f"🌐 ترميز موزع: {len(chunks)} أجزاء ({DISTRIBUTED_CHUNK_SECONDS:.0f}s لكل جزء)")
+    return chord(header, body)
+
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def process_video_task(self, video_path, output_path, video2_path=None, priority=None, estimate=None,
+                       output_profile=OUTPUT_PROFILE_STANDARD, streaming=False):
+    """مهمة Celery لمعالجة الفيديو (streaming: video_path ملف رفع مجزأ ما زال يصل)"""
+    job = FFmpegJob(self)
+    slot = acquire_job_slot()
+    backlog_remove(self.request.id)
+    edf_mark_started(self.request.id)
+    renew_inflight_lease(self.request.id)
+    upload_part_path = video_path
+    growing = None
+    try:
+        # تحديث حالة المهمة
+        self.update_state(state='PROCESSING', meta={'progress': 1, 'status': 'بدء المعالجة...'})
+
+        # الترميز أثناء الرفع: إذا اكتمل الرفع قبل بدء المهمة فهي مهمة عادية على الملف النهائي
+        if streaming:
+            growing = open_growing_upload(video_path)
+            if growing is None:
+                video_path = wait_for_upload(upload_part_path, job)
+            else:
+                video_path = growing.path
+
+        # أولوية المهمة (من الطلب أو حسب مدة المدخلات) وأنوية خانتها
+        if priority not in PRIORITY_CLASSES:
+            # المدة محسوبة مسبقاً في تقدير الرفع، وffprobe فقط للمهام بدون تقدير
+            if estimate:
+                duration = estimate['features']['duration']
+            else:
+                input_paths = [video_path] + ([video2_path] if video2_path else [])
+                infos = [get_video_info(path) for path in input_paths]
+                duration = sum(float(info['format'].get('duration', 0) or 0) for info in infos if info)
+            priority = classify_job_priority(duration)
+        job.placement = plan_job_placement(slot, priority)
+        logger.info(f"🎚️ خانة {slot['index']}: أولوية {priority}، أنوية {job.placement['cpus'] or 'كل الأنوية'}")
+        
+        print("🔍 اختبار دعم GPU...")
+        gpu_supported = test_gpu_support()
+
+        # الفيديو الثاني (إن وجد): نسخ مباشر إذا تطابقت المعاملات، وإلا يُدمج داخل أمر الترميز
+        video_paths = [video_path] + ([video2_path] if video2_path else [])
+        if video2_path:
+            self.update_state(state='PROCESSING', meta={'progress': 3, 'status': 'دمج الفيديوهات...'})
+        video_paths, merge_mode = prepare_merge_inputs(video_paths)
+
+        # تحديث التقدم (النسبة الفعلية تأتي من FFmpegJob أثناء الترميز)
+        self.update_state(state='PROCESSING', meta={'progress': 5, 'status': 'معالجة الفيديو...'})
+
+        job.check_cancelled()
+
+        # خصائص المدخلات النهائية (بعد الدمج) لمعايرة نموذج التكلفة بالزمن الفعلي
+        infos = [get_video_info(path) for path in video_paths]
+        features = get_job_features(infos, merge_mode) if all(infos) else None
+        work = features['work'] if features else None
+
+        # preset المهمة: ثابت لملف economy، وإلا حسب العمل المنتظر في طابورها وحجمها
+        if output_profile == OUTPUT_PROFILE_ECONOMY:
+            job.x264_preset = get_x264_preset(output_profile)
+        else:
+            queue = (self.request.delivery_info or {}).get('routing_key')
+            job.x264_preset = choose_x264_preset(work, get_backlog_per_slot(queue))
+        logger.info(f"🎛️ preset x264 للمهمة: {job.x264_preset} (ملف {output_profile})")
+
+        # ترميز أثناء وصول الملف، والناتج لا يُعتمد إلا بعد إنهاء الرفع والتحقق منه.
+        # عند الفشل (حاوية لا تُقرأ بالترتيب، توقف الرفع، ...) معالجة عادية بعد اكتمال الملف
+        if growing is not None:
+            self.update_state(state='PROCESSING', meta={'progress': 5, 'status': 'ترميز أثناء الرفع...'})
+            job.reset('ترميز أثناء الرفع...')
+            job.ingest = growing
+            encode_started = time.time()
+            process = process_video_ffmpeg_gpu if gpu_supported else process_video_fallback
+            streamed = process(video_paths, output_path, job) and growing.complete
+            encode_seconds = time.time() - encode_started
+            job.ingest = None
+            growing.close()
+            video_path = wait_for_upload(upload_part_path, job)
+            video_paths = [video_path]
+            if streamed:
+                # زمن الترميز هنا محكوم بسرعة الرفع فلا يُستخدم لمعايرة نموذج التكلفة
+                self.update_state(state='SUCCESS', meta={'progress': 100, 'status': 'تمت المعالجة بنجاح!'})
+                return {'status': 'completed', 'output_path': output_path, 'merge_mode': merge_mode,
+                        'placement': job.placement, 'estimate': estimate,
+                        'output_profile': output_profile,
+                        'x264_preset': None if gpu_supported else job.x264_preset,
+                        'encode_seconds': round(encode_seconds, 1), 'streamed': True}
+            logger.warning("⚠️ تعذر الترميز أثناء الرفع، معالجة عادية للملف المكتمل...")
+
+        # المدخلات الطويلة جداً تُوزع أجزاؤها على كل العمال (بدل عامل واحد)
+        if DISTRIBUTED_ENCODING and not gpu_supported and len(video_paths) == 1:
+            workflow = build_distributed_encode(video_paths[0], output_path, self.request.id, merge_mode,
+                                                job.x264_preset)
+            if workflow is not None:
+                self.update_state(state='PROCESSING', meta={'progress': 5, 'status': 'ترميز موزع على العمال...'})
+                # join_chunks_task يرث معرف هذه المهمة فيبقى /status/<task_id> صالحاً
+                return self.replace(workflow)
+
+        if gpu_supported:
+            print("🚀 استخدام GPU (NVENC)...")
+            self.update_state(state='PROCESSING', meta={'progress': 5, 'status': 'معالجة بـ GPU...'})
+            job.reset('معالجة بـ GPU...')
+            encode_started = time.time()
+            if process_video_ffmpeg_gpu(video_paths, output_path, job):
+                encode_seconds = time.time() - encode_started
+                record_cost_sample(get_encoder_path_key(True), work, encode_seconds)
+                cleanup_merged_copy(video_paths, merge_mode)
+                self.update_state(state='SUCCESS', meta={'progress': 100, 'status': 'تمت المعالجة بنجاح!'})
+                return {'status': 'completed', 'output_path': output_path, 'merge_mode': merge_mode,
+                        'placement': job.placement, 'estimate': estimate,
+                        'output_profile': output_profile, 'x264_preset': None,
+                        'encode_seconds': round(encode_seconds, 1)}
+            else:
+                print("⚠️ فشل GPU، الانتقال إلى CPU...")
+
+        print("🖥️ استخدام FFmpeg CPU كبديل...")
+        self.update_state(state='PROCESSING', meta={'progress': 5, 'status': 'معالجة بـ FFmpeg CPU...'})
+        job.reset('معالجة بـ FFmpeg CPU...')
+        encode_started = time.time()
+        result = process_video_fallback(video_paths, output_path, job)
+        encode_seconds = time.time() - encode_started
+        cleanup_merged_copy(video_paths, merge_mode)
+
+        if result:
+            record_cost_sample(get_encoder_path_key(False, job.x264_preset), work, encode_seconds)
+            self.update_state(state='SUCCESS', meta={'progress': 100, 'status': 'تمت المعالجة بنجاح!'})
+            return {'status': 'completed', 'output_path': output_path, 'merge_mode': merge_mode,
+                    'placement': job.placement, 'estimate': estimate,
+                    'output_profile': output_profile, 'x264_preset': job.x264_preset,
+                    'encode_seconds': round(encode_seconds, 1)}
+        else:
+            raise Exception("فشل في معالجة الفيديو")
+
+    except Ignore:
+        # استبدال المهمة بالـ chord ليس خطأ
+        raise
+    except JobCancelled:
+        mark_job_cancelled(self, upload_part_path, output_path)
+        # Ignore حتى لا يستبدل Celery حالة CANCELLED بـ SUCCESS/FAILURE
+        raise Ignore()
+    except UploadStalled as e:
+        # الإنهاء لاحقاً يرسل مهمة عادية جديدة، فلا يبقى العامل محجوزاً لرفع متوقف
+        if output_path and os.path.exists(output_path):
+            os.unlink(output_path)
+        self.update_state(state='CANCELLED', meta={
+            'progress': 0,
+            'status': str(e),
+            'timestamp': datetime.datetime.now().isoformat()
+        })
+        logger.warning(f"⏸️ المهمة {self.request.id}: {e}")
+        raise Ignore()
+    except Exception as e:
+        error_id, error_details = log_detailed_error(e, "process_video_task", {
+            'video_path': video_path,
+            'output_path': output_path,
+            'video2_path': video2_path,
+            'task_id': self.request.id,
+            'ffmpeg_errors': job.errors
+        })
+        
+        error_message = f"خطأ في المعالجة [ID: {error_id}]: {str(e)}"
+        logger.error(f"❌ {error_message}")
+        
+        self.update_state(
+            state='FAILURE', 
+            meta={
+                'progress': 0, 
+                'status': error_message,
+                'error_id': error_id,
+                'error_details': error_details,
+                'timestamp': datetime.datetime.now().isoformat()
+            }
+        )
+        raise
+    finally:
+        if growing is not None:
+            growing.close()
+        release_job_slot(slot)
+
+def process_video_direct(video_path, output_path, video2_path=None):
+    """
+    معالجة مباشرة بدون Celery (fallback mode).
+    يُرجع نتيجة بنفس شكل process_video_task ({status, output_path, merge_mode}) أو None عند الفشل.
+    """
+    job = FFmpegJob()
+    slot = acquire_job_slot()
+    # المستخدم ينتظر الرد مباشرة
+    job.placement = plan_job_placement(slot, 'interactive')
+    try:
+        logger.info("🔍 بدء المعالجة المباشرة...")
+        
+        # الفيديو الثاني (إن وجد): نسخ مباشر إذا تطابقت المعاملات، وإلا يُدمج داخل أمر الترميز
+        video_paths = [video_path] + ([video2_path] if video2_path else [])
+        video_paths, merge_mode = prepare_merge_inputs(video_paths)
+        if merge_mode:
+            logger.info(f"🔗 نمط الدمج: {merge_mode}")
+
+        infos = [get_video_info(path) for path in video_paths]
+        features = get_job_features(infos, merge_mode) if all(infos) else None
+        work = features['work'] if features else None
+
+        # فحص GPU
+        gpu_supported = test_gpu_support()
+
+        if gpu_supported:
+            logger.info("🚀 استخدام GPU (NVENC)...")
+            encode_started = time.time()
+            if process_video_ffmpeg_gpu(video_paths, output_path, job):
+                record_cost_sample(get_encoder_path_key(True), work, time.time() - encode_started)
+                cleanup_merged_copy(video_paths, merge_mode)
+                logger.info("✅ تمت المعالجة بنجاح باستخدام GPU!")
+                return {'status': 'completed', 'output_path': output_path, 'merge_mode': merge_mode}
+            else:
+                logger.warning("⚠️ فشل GPU، الانتقال إلى CPU...")
+
+        logger.info("🖥️ استخدام FFmpeg CPU...")
+        encode_started = time.time()
+        result = process_video_fallback(video_paths, output_path, job)
+        encode_seconds = time.time() - encode_started
+        cleanup_merged_copy(video_paths, merge_mode)
+
+        if result:
+            record_cost_sample(get_encoder_path_key(False), work, encode_seconds)
+            logger.info("✅ تمت المعالجة بنجاح باستخدام CPU!")
+            return {'status': 'completed', 'output_path': output_path, 'merge_mode': merge_mode}
+
+        for failure in job.errors:
+            logger.error(f"❌ {failure['command']} (rc={failure['returncode']}):\n{failure['stderr_tail']}")
+        return None
+
+    except Exception as e:
+        error_id, _ = log_detailed_error(e, "process_video_direct", {
+            'video_path': video_path,
+            'output_path': output_path,
+            'video2_path': video2_path,
+            'ffmpeg_errors': job.errors
+        })
+        logger.error(f"❌ خطأ في المعالجة المباشرة [ID: {error_id}]: {str(e)}")
+        return None
+    finally:
+        release_job_slot(slot)
+
+# توجيه حسب قدرات العمال: كل عامل يعلن قدراته في Redis، والعمال الذين يملكون NVENC
+# يستهلكون طوابير <queue>_gpu إضافية لا يستهلكها غيرهم
+JOB_QUEUES = (QUEUE_EXPRESS, QUEUE_MERGE, QUEUE_BULK)
+GPU_QUEUE_SUFFIX = '_gpu'
+WORKER_REGISTRY_PREFIX = 'worker_caps:'
+WORKER_REGISTRY_TTL = 90          # ثانية بدون تحديث = العامل غير متاح
+WORKER_REGISTRY_INTERVAL = 30
+# ثوانٍ مقدرة من العمل المنتظر لكل خانة GPU قبل تحويل المهام الجديدة إلى طوابير CPU
+GPU_BACKLOG_THRESHOLD = float(os.getenv('GPU_BACKLOG_THRESHOLD', '600'))
+# العمل المنتظر في كل طابور: task_id -> {queue, seconds, submitted_at}
+BACKLOG_KEY = 'queue_backlog'
+BACKLOG_MAX_AGE = 24 * 3600
+
+_worker_info = {}
+
+def get_worker_capabilities():
+    """القدرات التي يعلنها هذا العامل (NVENC، الأنوية، المساحة الحرة)"""
+    caps = get_ffmpeg_capabilities()
+    try:
+        free_disk = psutil.disk_usage(app.config['UPLOAD_FOLDER']).free
+    except OSError:
+        free_disk = None
+    return {
+        'hostname': _worker_info.get('hostname'),
+        'nvenc': bool(caps.get('nvenc_encoder')),
+        'cores': get_cpu_budget(),
+        'concurrency': _worker_info.get('concurrency', 1),
+        'free_disk_bytes': free_disk,
+        'queues': _worker_info.get('queues', []),
+        'updated_at': time.time(),
+    }
+
+def advertise_worker():
+    """تحديث سجل هذا العامل في Redis (بمهلة WORKER_REGISTRY_TTL)"""
+    try:
+        info = get_worker_capabilities()
+        get_redis_client().set(f"{WORKER_REGISTRY_PREFIX}{info['hostname']}", json.dumps(info),
+                               ex=WORKER_REGISTRY_TTL)
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر تسجيل قدرات العامل: {e}")
+
+def get_live_workers():
+    """العمال الذين حدّثوا سجلهم خلال WORKER_REGISTRY_TTL"""
+    workers = []
+    try:
+        client = get_redis_client()
+        for key in client.scan_iter(f'{WORKER_REGISTRY_PREFIX}*'):
+            raw = client.get(key)
+            if raw:
+                workers.append(json.loads(raw))
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر قراءة سجل العمال: {e}")
+    return workers
+
+@celeryd_after_setup.connect
+def add_capability_queues(sender, instance, **kwargs):
+    """عند بدء العامل: إضافة طوابير GPU إذا كان NVENC يعمل، وحفظ بيانات التسجيل"""
+    queues = instance.app.amqp.queues
+    consumed = list(queues.consume_from) if queues.consume_from else list(JOB_QUEUES)
+    if get_ffmpeg_capabilities().get('nvenc_encoder'):
+        for name in consumed:
+            if name in JOB_QUEUES:
+                queues.select_add(f'{name}{GPU_QUEUE_SUFFIX}')
+                consumed.append(f'{name}{GPU_QUEUE_SUFFIX}')
+    _worker_info.update({
+        'hostname': sender,
+        'concurrency': instance.concurrency,
+        'queues': consumed,
+    })
+    logger.info(f"🏷️ العامل {sender} يستهلك الطوابير: {', '.join(consumed)}")
+
+@worker_ready.connect
+def start_worker_advertising(**kwargs):
+    def refresh():
+        while True:
+            advertise_worker()
+            if EDF_SCHEDULING:
+                dispatch_edf_jobs()
+            renew_queued_leases()
+            sweep_expired_outputs()
+            sweep_stale_upload_sessions()
+            time.sleep(WORKER_REGISTRY_INTERVAL)
+    threading.Thread(target=refresh, daemon=True).start()
+
+@worker_shutdown.connect
+def remove_worker_advertising(**kwargs):
+    try:
+        get_redis_client().delete(f"{WORKER_REGISTRY_PREFIX}{_worker_info.get('hostname')}")
+    except Exception:
+        pass
+
+def backlog_add(task_id, queue, seconds, video_path=None, output_path=None):
+    try:
+        get_redis_client().hset(BACKLOG_KEY, task_id, json.dumps({
+            'queue': queue, 'seconds': seconds or 0, 'submitted_at': time.time(),
+            'video_path': video_path, 'output_path': output_path,
+        }))
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر تسجيل المهمة في العمل المنتظر: {e}")
+
+def backlog_remove(task_id):
+    try:
+        get_redis_client().hdel(BACKLOG_KEY, task_id)
+    except Exception:
+        pass
+
+def backlog_pop(task_id):
+    """حذف قيد المهمة وإرجاعه إذا كان هذا الاستدعاء من حذفه (أي أن المهمة لم تبدأ بعد)، وإلا None"""
+    try:
+        client = get_redis_client()
+        raw = client.hget(BACKLOG_KEY, task_id)
+        if raw and client.hdel(BACKLOG_KEY, task_id):
+            return json.loads(raw)
+    except Exception:
+        pass
+    return None
+
+def get_queue_backlog():
+    """العمل المنتظر لكل طابور: {queue: {'jobs': n, 'seconds': s}} (مع حذف القيود القديمة)"""
+    backlog = {}
+    try:
+        client = get_redis_client()
+        now = time.time()
+        for task_id, raw in client.hgetall(BACKLOG_KEY).items():
+            entry = json.loads(raw)
+            if now - entry['submitted_at'] > BACKLOG_MAX_AGE:
+                client.hdel(BACKLOG_KEY, task_id)
+                continue
+            stats = backlog.setdefault(entry['queue'], {'jobs': 0, 'seconds': 0.0})
+            stats['jobs'] += 1
+            stats['seconds'] += entry['seconds']
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر قراءة العمل المنتظر: {e}")
+    return backlog
+
+def get_backlog_per_slot(queue, extra_seconds=0.0):
+    """
+    ثوانٍ منتظرة لكل خانة عامل حي يخدم queue (مع extra_seconds إضافية).
+    None إذا لم يكن هناك طابور أو عمال معروفون.
+    """
+    if not queue:
+        return None
+    slots = sum(w['concurrency'] for w in get_live_workers() if queue in w['queues'])
+    if not slots:
+        return None
+    backlog = get_queue_backlog().get(queue, {'seconds': 0.0})['seconds']
+    return (backlog + extra_seconds) / slots
+
+def choose_job_queue(estimate, has_second_video):
+    """
+    طابور المهمة عند الإرسال: merge للدمج، وexpress أو bulk حسب المدة المقاسة.
+    تُرسل إلى نسخة _gpu من الطابور إذا كان NVENC أرخص ويوجد عامل GPU حي،
+    إلا إذا تجاوز العمل المنتظر لكل خانة GPU حد GPU_BACKLOG_THRESHOLD.
+    """
+    if has_second_video:
+        queue = QUEUE_MERGE
+    elif estimate and estimate['features']['duration'] <= EXPRESS_MAX_DURATION:
+        queue = QUEUE_EXPRESS
+    else:
+        # مدة غير معروفة تُعامل كمهمة طويلة
+        queue = QUEUE_BULK
+    if not estimate:
+        return queue
+
+    paths = estimate['paths']
+    gpu_cost = paths[get_encoder_path_key(True)]['seconds']
+    if gpu_cost >= paths[get_encoder_path_key(False)]['seconds']:
+        return queue
+
+    gpu_queue = f'{queue}{GPU_QUEUE_SUFFIX}'
+    gpu_slots = sum(w['concurrency'] for w in get_live_workers() if w['nvenc'] and gpu_queue in w['queues'])
+    if not gpu_slots:
+        return queue
+    backlog = get_queue_backlog().get(gpu_queue, {'seconds': 0.0})['seconds']
+    if backlog / gpu_slots > GPU_BACKLOG_THRESHOLD:
+        logger.info(f"↪️ طابور {gpu_queue} مزدحم ({backlog:.0f}s لـ {gpu_slots} خانات) - استخدام CPU")
+        return queue
+    return gpu_queue
+
+def get_queue_cost(estimate, queue):
+    """الثواني المقدرة للمهمة على مسار الترميز الذي يخدم هذا الطابور"""
+    if not estimate:
+        return None
+    return estimate['paths'][get_encoder_path_key(queue.endswith(GPU_QUEUE_SUFFIX))]['seconds']
+
+# التحكم في القبول: رفض مؤقت (429) أو تخفيض ملف الناتج بدل تكديس ساعات من العمل
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', 'true').lower() == 'true'
+ADMISSION_MIN_FREE_GB = float(os.getenv('ADMISSION_MIN_FREE_GB', '5'))
+# ثوانٍ مقدرة من العمل المنتظر لكل خانة عامل
+ADMISSION_DOWNGRADE_BACKLOG = float(os.getenv('ADMISSION_DOWNGRADE_BACKLOG', '1800'))
+ADMISSION_MAX_BACKLOG = float(os.getenv('ADMISSION_MAX_BACKLOG', '7200'))
+ADMISSION_NO_WORKERS_RETRY = 60
+ADMISSION_DISK_RETRY = 300
+ADMISSION_RETRY_MIN, ADMISSION_RETRY_MAX = 30, 3600
+# مساحة العمل لكل بايت مرفوع: الملف نفسه + الناتج + ملفات الدمج/الأجزاء المؤقتة
+ADMISSION_DISK_FACTOR = 3
+
+def check_disk_admission(incoming_bytes):
+    """
+    فحص المساحة الحرة قبل حفظ الرفع.
+    يُرجع None إذا كانت كافية، وإلا قرار defer.
+    """
+    if not ADMISSION_CONTROL:
+        return None
+    try:
+        free = psutil.disk_usage(app.config['UPLOAD_FOLDER']).free
+    except OSError:
+        return None
+    required = ADMISSION_MIN_FREE_GB * 1024 ** 3 + (incoming_bytes or 0) * ADMISSION_DISK_FACTOR
+    if free >= required:
+        return None
+    return {'action': 'defer', 'retry_after': ADMISSION_DISK_RETRY,
+            'reason': f'disk_low ({free / 1024 ** 3:.1f}GB free)'}
+
+def admit_job(estimate, queue):
+    """
+    قرار القبول لمهمة موجهة إلى queue:
+    accept، أو downgrade إلى ملف economy (طوابير CPU فقط)، أو defer مع retry_after بالثواني.
+    الحمل = (العمل المنتظر في الطابور + تكلفة هذه المهمة) / خانات العمال الأحياء التي تخدمه.
+    """
+    decision = {'action': 'accept', 'output_profile': OUTPUT_PROFILE_STANDARD}
+    if not ADMISSION_CONTROL:
+        return decision
+
+    workers = get_live_workers()
+    slots = sum(w['concurrency'] for w in workers if queue in w['queues'])
+    if not slots:
+        # لا يوجد عامل يخدم الطابور (أو السجل غير متاح بعد) - التأجيل أفضل من التكديس بلا حد
+        if workers:
+            return {'action': 'defer', 'retry_after': ADMISSION_NO_WORKERS_RETRY,
+                    'reason': f'no_workers ({queue})'}
+        return decision
+
+    cost = get_queue_cost(estimate, queue) or 0.0
+    backlog = get_queue_backlog().get(queue, {'seconds': 0.0})['seconds']
+    per_slot = (backlog + cost) / slots
+    decision['backlog_per_slot'] = round(per_slot, 1)
+
+    if per_slot > ADMISSION_MAX_BACKLOG:
+        retry_after = min(max(int(per_slot - ADMISSION_MAX_BACKLOG), ADMISSION_RETRY_MIN), ADMISSION_RETRY_MAX)
+        decision.update({'action': 'defer', 'retry_after': retry_after,
+                         'reason': f'backlog ({per_slot:.0f}s per slot on {queue})'})
+    elif per_slot > ADMISSION_DOWNGRADE_BACKLOG and not queue.endswith(GPU_QUEUE_SUFFIX):
+        decision.update({'action': 'downgrade', 'output_profile': OUTPUT_PROFILE_ECONOMY,
+                         'reason': f'backlog ({per_slot:.0f}s per slot on {queue})'})
+    return decision
+
+def admission_rejected(decision):
+    """استجابة 429 مع Retry-After"""
+    logger.warning(f"🚦 رفض مؤقت للرفع: {decision['reason']} - إعادة المحاولة بعد {decision['retry_after']}s")
+    return jsonify({
+        'error': 'الخادم مشغول حالياً، يرجى إعادة المحاولة لاحقاً',
+        'retry_after': decision['retry_after'],
+        'reason': decision['reason'],
+    }), 429, {'Retry-After': str(decision['retry_after'])}
+
+# جدولة حسب الموعد النهائي (EDF): المهام تنتظر في Redis داخل sorted set لكل طابور مرتبة
+# بالموعد النهائي، ولا تُرسل إلى Celery إلا عند توفر خانة، فتتقدم المهمة الأقرب موعداً
+# على ما وصل قبلها بدل ترتيب FIFO في الوسيط
+EDF_SCHEDULING = os.getenv('EDF_SCHEDULING', 'true').lower() == 'true'
+SLA_CLASSES = {
+    'rush': float(os.getenv('SLA_RUSH_SECONDS', '900')),
+    'standard': float(os.getenv('SLA_STANDARD_SECONDS', '14400')),
+    'overnight': float(os.getenv('SLA_OVERNIGHT_SECONDS', '86400')),
+}
+DEFAULT_SLA_CLASS = os.getenv('DEFAULT_SLA_CLASS', 'standard')
+EDF_QUEUE_PREFIX = 'edf:'
+EDF_JOBS_KEY = 'edf_jobs'              # job_id -> معاملات المهمة التي لم تُرسل بعد
+EDF_DISPATCHED_KEY = 'edf_dispatched'  # job_id -> {queue, at} أُرسلت إلى Celery ولم تبدأ
+EDF_DISPATCH_STALE = 3600              # رسالة لم تبدأ خلال هذه المدة لا تُحسب من الخانات المحجوزة
+EDF_LOCK_KEY = 'edf_dispatch_lock'
+EDF_LOCK_TTL = 10
+# حذف القفل فقط إذا كان ما زال لهذا الإرسال (قد تنتهي مهلته ويأخذه إرسال آخر)
+EDF_LOCK_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+DEADLINE_KEY_PREFIX = 'deadline:'
+
+def parse_job_deadline(form):
+    """
+    الموعد النهائي من حقول الرفع: deadline (ISO 8601 أو Unix timestamp، التوقيت بدون منطقة = UTC)
+    أو sla_class. يُرجع (deadline_ts, sla_class)، ويرفع ValueError للقيم غير الصالحة.
+    """
+    sla_class = form.get('sla_class') or None
+    if sla_class and sla_class not in SLA_CLASSES:
+        raise ValueError(f'فئة SLA غير معروفة: {sla_class}')
+    raw_deadline = (form.get('deadline') or '').strip()
+    if not raw_deadline:
+        sla_class = sla_class or DEFAULT_SLA_CLASS
+        return time.time() + SLA_CLASSES[sla_class], sla_class
+    try:
+        deadline = float(raw_deadline)
+    except ValueError:
+        try:
+            parsed = datetime.datetime.fromisoformat(raw_deadline)
+        except ValueError:
+            raise ValueError(f'صيغة الموعد النهائي غير صالحة: {raw_deadline}')
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        deadline = parsed.timestamp()
+    if not math.isfinite(deadline):
+        raise ValueError(f'صيغة الموعد النهائي غير صالحة: {raw_deadline}')
+    if deadline <= time.time():
+        raise ValueError('الموعد النهائي في الماضي')
+    # أبعد من أطول فئة SLA لا معنى له للجدولة (وقيم ضخمة تكسر fromtimestamp)
+    if deadline > time.time() + max(SLA_CLASSES.values()):
+        raise ValueError('الموعد النهائي أبعد من أطول فئة SLA')
+    return deadline, sla_class
+
+def record_job_deadline(job_id, deadline, sla_class, seconds, at_risk=False):
+    try:
+        ttl = int(max(deadline - time.time(), 0) + BACKLOG_MAX_AGE)
+        get_redis_client().set(f'{DEADLINE_KEY_PREFIX}{job_id}', json.dumps({
+            'deadline': deadline, 'sla_class': sla_class, 'seconds': seconds or 0, 'at_risk': at_risk,
+        }), ex=ttl)
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر حفظ الموعد النهائي للمهمة: {e}")
+
+def get_job_deadline(job_id):
+    try:
+        raw = get_redis_client().get(f'{DEADLINE_KEY_PREFIX}{job_id}')
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
+
+def check_deadline_risk(job_id, stage):
+    """تعليم المهمة بأنها لن تلحق موعدها إذا كان الآن + زمنها المقدر بعد الموعد"""
+    info = get_job_deadline(job_id)
+    if not info or info['at_risk']:
+        return
+    if time.time() + info['seconds'] > info['deadline']:
+        record_job_deadline(job_id, info['deadline'], info['sla_class'], info['seconds'], at_risk=True)
+        logger.warning(f"⏰ المهمة {job_id} لن تلحق موعدها النهائي ({stage})")
+
+def estimate_edf_finish(queue, deadline, seconds):
+    """
+    وقت الانتهاء المتوقع لمهمة جديدة: العمل المنتظر الأسبق موعداً في الطابور (في sorted set
+    والمُرسل فعلاً) موزعاً على خانات الطابور، ثم تكلفة المهمة نفسها.
+    المهام قيد التشغيل لا تُحسب. None إذا لم تُعرف الخانات.
+    """
+    slots = sum(w['concurrency'] for w in get_live_workers() if queue in w['queues'])
+    if not slots:
+        return None
+    client = get_redis_client()
+    ahead = {m.decode() for m in client.zrangebyscore(f'{EDF_QUEUE_PREFIX}{queue}', '-inf', deadline)}
+    for job_id, raw in client.hgetall(EDF_DISPATCHED_KEY).items():
+        if json.loads(raw)['queue'] == queue:
+            ahead.add(job_id.decode())
+    backlog = client.hgetall(BACKLOG_KEY)
+    ahead_seconds = sum(json.loads(backlog[job_id.encode()])['seconds']
+                        for job_id in ahead if job_id.encode() in backlog)
+    return time.time() + ahead_seconds / slots + (seconds or 0)
+
+def submit_edf_job(job_id, queue, args, deadline):
+    """إضافة المهمة إلى sorted set طابورها ثم محاولة الإرسال فوراً"""
+    client = get_redis_client()
+    client.hset(EDF_JOBS_KEY, job_id, json.dumps({'queue': queue, 'args': args}))
+    client.zadd(f'{EDF_QUEUE_PREFIX}{queue}', {job_id: deadline})
+    dispatch_edf_jobs()
+
+def edf_mark_started(job_id):
+    try:
+        get_redis_client().hdel(EDF_DISPATCHED_KEY, job_id)
+    except Exception:
+        pass
+    check_deadline_risk(job_id, 'بداية التنفيذ')
+
+def edf_cancel(job_id):
+    """حذف مهمة لم تُرسل بعد من الجدولة"""
+    try:
+        client = get_redis_client()
+        raw = client.hget(EDF_JOBS_KEY, job_id)
+        if raw:
+            client.zrem(f"{EDF_QUEUE_PREFIX}{json.loads(raw)['queue']}", job_id)
+            client.hdel(EDF_JOBS_KEY, job_id)
+        client.hdel(EDF_DISPATCHED_KEY, job_id)
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر حذف المهمة من الجدولة: {e}")
+
+def discard_job_schedule(job_id):
+    """إزالة كل قيود الجدولة لمهمة لم تُرسل (الموعد، العمل المنتظر، sorted set) قبل التراجع عنها"""
+    edf_cancel(job_id)
+    backlog_remove(job_id)
+    try:
+        get_redis_client().delete(f'{DEADLINE_KEY_PREFIX}{job_id}', f'{JOB_RESULT_KEY_PREFIX}{job_id}')
+    except Exception:
+        pass
+
+def dispatch_edf_jobs():
+    """
+    إرسال المهام الأقرب موعداً إلى Celery: لكل طابور حتى رسالة منتظرة واحدة لكل خانة حية
+    (أو كل المهام إذا لم يكن سجل العمال متاحاً). قفل Redis يمنع الإرسال المزدوج بين العمليات.
+    يُستدعى عند الرفع، وبعد انتهاء كل مهمة، ودورياً من خيط تسجيل العامل.
+    """
+    lock_token = uuid.uuid4().hex
+    try:
+        client = get_redis_client()
+        if not client.set(EDF_LOCK_KEY, lock_token, nx=True, ex=EDF_LOCK_TTL):
+            return 0
+    except Exception as e:
+        logger.debug(f"تعذر الحصول على قفل الجدولة: {e}")
+        return 0
+
+    sent = 0
+    try:
+        workers = get_live_workers()
+        now = time.time()
+        waiting = collections.Counter()
+        for job_id, raw in client.hgetall(EDF_DISPATCHED_KEY).items():
+            entry = json.loads(raw)
+            if now - entry['at'] > EDF_DISPATCH_STALE:
+                client.hdel(EDF_DISPATCHED_KEY, job_id)
+            else:
+                waiting[entry['queue']] += 1
+
+        for key in client.scan_iter(f'{EDF_QUEUE_PREFIX}*'):
+            key = key.decode() if isinstance(key, bytes) else key
+            queue = key[len(EDF_QUEUE_PREFIX):]
+            slots = sum(w['concurrency'] for w in workers if queue in w['queues'])
+            while not workers or waiting[queue] < slots:
+                head = client.zrange(key, 0, 0, withscores=True)
+                if not head:
+                    break
+                job_id, score = head[0][0].decode(), head[0][1]
+                client.zrem(key, job_id)
+                raw = client.hget(EDF_JOBS_KEY, job_id)
+                client.hdel(EDF_JOBS_KEY, job_id)
+                if not raw or is_job_cancelled(job_id):
+                    continue
+                check_deadline_risk(job_id, 'الإرسال')
+                # التسجيل قبل الإرسال: العامل قد يبدأ المهمة (ويحذف القيد) قبل عودة apply_async
+                client.hset(EDF_DISPATCHED_KEY, job_id, json.dumps({'queue': queue, 'at': now}))
+                try:
+                    process_video_task.apply_async(args=json.loads(raw)['args'], queue=queue, task_id=job_id)
+                except Exception:
+                    client.hdel(EDF_DISPATCHED_KEY, job_id)
+                    client.hset(EDF_JOBS_KEY, job_id, raw)
+                    client.zadd(key, {job_id: score})
+                    raise
+                waiting[queue] += 1
+                sent += 1
+    except Exception as e:
+        logger.warning(f"⚠️ فشل إرسال المهام حسب الموعد النهائي: {e}")
+    finally:
+        try:
+            client.eval(EDF_LOCK_RELEASE_SCRIPT, 1, EDF_LOCK_KEY, lock_token)
+        except Exception:
+            pass
+    if sent:
+        logger.info(f"📤 أُرسلت {sent} مهام حسب الموعد النهائي")
+    return sent
+
+@task_postrun.connect
+def dispatch_after_task(sender=None, **kwargs):
+    """خانة تحررت: إرسال المهمة التالية الأقرب موعداً"""
+    if EDF_SCHEDULING and sender is not None and sender.name in (process_video_task.name, join_chunks_task.name):
+        dispatch_edf_jobs()
+
+# كاش النتائج حسب المحتوى: نفس المدخلات + نفس الأصول + نفس إعدادات الترميز = نفس الناتج،
+# فإعادة رفع نفس الملف (بعد انقطاع المتصفح مثلاً) تُرجع الناتج الموجود بدون ترميز جديد
+RESULT_CACHE = os.getenv('RESULT_CACHE', 'true').lower() == 'true'
+RESULT_CACHE_PREFIX = 'result:'
+RESULT_CACHE_STATS_KEY = 'result_cache_stats'
+JOB_RESULT_KEY_PREFIX = 'job_result_key:'  # job_id -> مفتاح الناتج حتى تكتمل المهمة
+# مدة الاحتفاظ بالنواتج منذ آخر استخدام (0 = بلا حذف)؛ مدخل الكاش ينتهي مع ملفه
+OUTPUT_RETENTION_HOURS = float(os.getenv('OUTPUT_RETENTION_HOURS', '0'))
+OUTPUT_RETENTION_SECONDS = OUTPUT_RETENTION_HOURS * 3600 if OUTPUT_RETENTION_HOURS > 0 else None
+OUTPUT_SWEEP_INTERVAL = 600
+RESULT_CACHE_MAX_AGE = 7 * 24 * 3600  # عمر مدخل الكاش عند عدم تحديد مدة احتفاظ
+
+_last_output_sweep = 0.0
+
+def get_result_key(input_paths, output_profile=OUTPUT_PROFILE_STANDARD):
+    """
+    مفتاح الناتج: SHA-256 لمحتوى المدخلات (بالترتيب) والعلامة المائية والأوترو وإعدادات الجودة.
+    preset x264 الأساسي للملف جزء من المفتاح، أما المختار حسب الحمل فيُحفظ مع الناتج
+    ويُقارن عند القراءة (cached_preset_acceptable).
+    """
+    key_source = '|'.join([get_file_hash(path) for path in input_paths] + [
+        get_file_hash(WATERMARK_PATH), get_file_hash(OUTRO_PATH), str(WATERMARK_OPACITY), output_profile,
+        ' '.join(get_cpu_encoder_settings(get_x264_preset(output_profile))),
+        ' '.join(get_final_nvenc_settings()),
+        ' '.join(AUDIO_ENCODE_ARGS),
+    ])
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def _count_result_cache(field):
+    try:
+        get_redis_client().hincrby(RESULT_CACHE_STATS_KEY, field, 1)
+    except Exception:
+        pass
+
+def get_result_cache_stats():
+    try:
+        stats = {k.decode(): int(v) for k, v in get_redis_client().hgetall(RESULT_CACHE_STATS_KEY).items()}
+    except Exception:
+        return {}
+    lookups = stats.get('hits', 0) + stats.get('misses', 0)
+    stats['hit_rate'] = round(stats.get('hits', 0) / lookups, 3) if lookups else None
+    return stats
+
+def cached_preset_acceptable(entry, output_profile=OUTPUT_PROFILE_STANDARD):
+    """
+    ناتج رُمّز تحت الحمل بـ preset أسرع من الأساسي للملف أقل جودة مما سيحصل عليه الطلب:
+    يُقبل NVENC أو preset x264 بطء الأساسي أو أبطأ (المدخلات القديمة بدون encoder تُرفض).
+    """
+    if entry.get('encoder') == 'nvenc':
+        return True
+    if entry.get('encoder') != 'x264' or entry.get('x264_preset') not in X264_PRESETS:
+        return False
+    base = get_x264_preset(output_profile)
+    return X264_PRESETS.index(entry['x264_preset']) >= _preset_index(base, 'veryfast')
+
+def lookup_cached_result(result_key, output_profile=OUTPUT_PROFILE_STANDARD):
+    """
+    الناتج المخزن لهذا المفتاح إذا كان ملفه ما زال موجوداً وpreset ترميزه مقبولاً، وإلا None.
+    الاستخدام يجدد مدة الاحتفاظ بالملف ومدخل الكاش.
+    """
+    key = f'{RESULT_CACHE_PREFIX}{result_key}'
+    try:
+        client = get_redis_client()
+        raw = client.get(key)
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر قراءة كاش النتائج: {e}")
+        return None
+    if not raw:
+        _count_result_cache('misses')
+        return None
+
+    entry = json.loads(raw)
+    if not cached_preset_acceptable(entry, output_profile):
+        # يُعاد الترميز ويحل الناتج الجديد محل هذا المدخل
+        _count_result_cache('misses')
+        return None
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], entry['output_filename'])
+    try:
+        os.utime(output_path)
+    except OSError:
+        # الملف حُذف (انتهت مدة الاحتفاظ أو حذف يدوي)
+        client.delete(key)
+        _count_result_cache('evictions')
+        _count_result_cache('misses')
+        return None
+    client.expire(key, int(OUTPUT_RETENTION_SECONDS or RESULT_CACHE_MAX_AGE))
+    _count_result_cache('hits')
+    return entry
+
+def store_cached_result(result_key, output_path, job_id=None, x264_preset=None):
+    """x264_preset: الـ preset المستخدم فعلاً، أو None لناتج NVENC"""
+    try:
+        get_redis_client().set(f'{RESULT_CACHE_PREFIX}{result_key}', json.dumps({
+            'output_filename': os.path.basename(output_path),
+            'job_id': job_id,
+            'encoder': 'x264' if x264_preset else 'nvenc',
+            'x264_preset': x264_preset,
+            'created_at': time.time(),
+        }), ex=int(OUTPUT_RETENTION_SECONDS or RESULT_CACHE_MAX_AGE))
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر حفظ الناتج في كاش النتائج: {e}")
+
+def remember_job_result_key(job_id, result_key, inflight_key=None):
+    """
+    ربط المهمة بمفتاح ناتجها حتى يُخزن عند نجاحها، وبمفتاح تسجيلها كمهمة جارية
+    (قد يختلف إذا خُفض ملف الناتج بعد التسجيل) حتى يُحرر عند انتهائها.
+    """
+    try:
+        get_redis_client().set(f'{JOB_RESULT_KEY_PREFIX}{job_id}', json.dumps({
+            'result_key': result_key, 'inflight_key': inflight_key,
+        }), ex=BACKLOG_MAX_AGE)
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر ربط المهمة بمفتاح الناتج: {e}")
+
+def get_job_result_keys(job_id):
+    raw = get_redis_client().get(f'{JOB_RESULT_KEY_PREFIX}{job_id}')
+    return json.loads(raw) if raw else None
+
+@task_postrun.connect
+def cache_task_result(sender=None, task_id=None, retval=None, state=None, **kwargs):
+    """
+    عند انتهاء المهمة (أو join للترميز الموزع): تخزين ناتجها تحت مفتاحه إذا نجحت،
+    ثم تحرير تسجيلها كمهمة جارية (الطلبات المكررة بعدها تجد الناتج في الكاش أو تبدأ من جديد).
+    """
+    if sender is None or sender.name not in (process_video_task.name, join_chunks_task.name):
+        return
+    # RETRY / IGNORED (إلغاء أو استبدال بالترميز الموزع) لا تنهي المهمة هنا
+    if state not in ('SUCCESS', 'FAILURE'):
+        return
+    try:
+        keys = get_job_result_keys(task_id)
+        if not keys:
+            return
+        if state == 'SUCCESS' and isinstance(retval, dict) and retval.get('output_path'):
+            store_cached_result(keys['result_key'], retval['output_path'], task_id, retval.get('x264_preset'))
+        if keys['inflight_key']:
+            release_inflight_job(keys['inflight_key'], task_id)
+        get_redis_client().delete(f'{JOB_RESULT_KEY_PREFIX}{task_id}')
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر حفظ ناتج المهمة في الكاش: {e}")
+
+# سجل المهام الجارية: رفع مكرر لنفس المحتوى أثناء ترميز الأول يُرفق بالمهمة الموجودة.
+# التسجيل بمهلة قصيرة (lease) يمددها العامل أثناء الترميز وخيط العامل الدوري للمهام المنتظرة،
+# فالمهمة التي مات عاملها تُحرر مفتاحها خلال INFLIGHT_LEASE
+INFLIGHT_PREFIX = 'inflight:'
+INFLIGHT_LEASE = float(os.getenv('INFLIGHT_LEASE', '300'))
+INFLIGHT_RENEW_INTERVAL = 60
+
+def _inflight_job_alive(job_id):
+    """المهمة المسجلة ما زالت منتظرة أو قيد التنفيذ (لم تفشل ولم تُلغ ولم تنته)"""
+    if is_job_cancelled(job_id):
+        return False
+    return process_video_task.AsyncResult(job_id).state not in ('SUCCESS', 'FAILURE', 'REVOKED', 'CANCELLED')
+
+def claim_inflight_job(result_key, job_id, output_filename, ttl):
+    """
+    تسجيل job_id كمهمة جارية لهذا المفتاح.
+    يُرجع مدخل المهمة القائمة لنفس المفتاح ({job_id, output_filename}) إذا كانت حية،
+    أو None إذا سُجلت هذه المهمة (أو تعذر التسجيل فتستمر بدون إزالة تكرار).
+    المهام المنتهية بفشل أو إلغاء تُزال من السجل فيأخذ الطلب الجديد مكانها.
+    """
+    client = get_redis_client()
+    key = f'{INFLIGHT_PREFIX}{result_key}'
+    value = json.dumps({'job_id': job_id, 'output_filename': output_filename})
+    for _ in range(2):
+        if client.set(key, value, nx=True, ex=int(ttl)):
+            return None
+        raw = client.get(key)
+        if raw is None:
+            continue  # انتهت المهلة بين الأمرين
+        existing = json.loads(raw)
+        if _inflight_job_alive(existing['job_id']):
+            return existing
+        logger.info(f"♻️ إزالة تسجيل مهمة منتهية {existing['job_id']} لنفس المحتوى")
+        release_inflight_job(result_key, existing['job_id'])
+    return None
+
+def release_inflight_job(result_key, job_id):
+    """حذف التسجيل فقط إذا كان ما زال لهذه المهمة"""
+    try:
+        client = get_redis_client()
+        key = f'{INFLIGHT_PREFIX}{result_key}'
+        raw = client.get(key)
+        if raw and json.loads(raw)['job_id'] == job_id:
+            client.delete(key)
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر تحرير تسجيل المهمة الجارية: {e}")
+
+def release_job_inflight(job_id):
+    """تحرير تسجيل المهمة الجارية بمعرفها (عند الإلغاء)"""
+    try:
+        keys = get_job_result_keys(job_id)
+    except Exception:
+        return
+    if keys and keys['inflight_key']:
+        release_inflight_job(keys['inflight_key'], job_id)
+
+def renew_inflight_lease(job_id):
+    """تمديد مهلة تسجيل المهمة الجارية (يُستدعى دورياً أثناء الترميز)"""
+    try:
+        keys = get_job_result_keys(job_id)
+        if not keys or not keys['inflight_key']:
+            return
+        client = get_redis_client()
+        key = f"{INFLIGHT_PREFIX}{keys['inflight_key']}"
+        raw = client.get(key)
+        if raw and json.loads(raw)['job_id'] == job_id:
+            client.expire(key, int(INFLIGHT_LEASE))
+    except Exception as e:
+        logger.debug(f"تعذر تمديد تسجيل المهمة الجارية: {e}")
+
+def renew_queued_leases():
+    """تمديد تسجيل المهام التي لم يبدأها عامل بعد (العمل المنتظر)، فلا تنتهي مهلتها في الطابور"""
+    try:
+        job_ids = get_redis_client().hkeys(BACKLOG_KEY)
+    except Exception as e:
+        logger.debug(f"تعذر قراءة المهام المنتظرة: {e}")
+        return
+    for job_id in job_ids:
+        renew_inflight_lease(job_id.decode() if isinstance(job_id, bytes) else job_id)
+
+def sweep_expired_outputs():
+    """حذف النواتج التي لم تُستخدم خلال OUTPUT_RETENTION_HOURS (مرة كل OUTPUT_SWEEP_INTERVAL)"""
+    global _last_output_sweep
+    now = time.time()
+    if not OUTPUT_RETENTION_SECONDS or now - _last_output_sweep < OUTPUT_SWEEP_INTERVAL:
+        return 0
+    _last_output_sweep = now
+    removed = 0
+    try:
+        with os.scandir(app.config['OUTPUT_FOLDER']) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and now - entry.stat().st_mtime > OUTPUT_RETENTION_SECONDS:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+    except OSError as e:
+        logger.warning(f"⚠️ تعذر تنظيف النواتج القديمة: {e}")
+    if removed:
+        logger.info(f"🧹 حُذفت {removed} نواتج تجاوزت مدة الاحتفاظ ({OUTPUT_RETENTION_HOURS:g} ساعة)")
+    return removed
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+def submit_saved_upload(project_id, video_path, video2_path, priority, deadline, sla_class, streaming=False,
+                        keep_session=False):
+    """
+    تسليم ملفات مرفوعة (داخل مجلد المشروع project_id) لمسار المعالجة:
+    كاش النتائج، إزالة التكرار، القبول، ثم Celery أو المعالجة المباشرة. يُرجع استجابة Flask.
+    يُستخدم من /upload ومن إنهاء الرفع المجزأ، ومع streaming=True لملف رفع ما زال يصل
+    (بدون كاش/إزالة تكرار لأن المحتوى لم يكتمل، وبدون معالجة مباشرة، والمجلد لا يُحذف عند الرفض).
+    مع keep_session=True (جلسة رفع مجزأ) يبقى المجلد وملف الجلسة: الرفض يترك الملفات لإعادة
+    محاولة الإنهاء، وعند انتهاء الحاجة للمدخلات تُحذف الفيديوهات فقط.
+    """
+    project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
+
+    # نفس المحتوى والأصول والإعدادات سبق ترميزه؟ يُرجع الناتج الموجود بدون إرسال أي مهمة
+    input_paths = [video_path] + ([video2_path] if video2_path else [])
 
+    def discard_inputs():
+        if not keep_session:
+            shutil.rmtree(project_folder, ignore_errors=True)
+            return
+        for path in input_paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    result_key = None
+    if RESULT_CACHE and not streaming:
+        try:
+            result_key = get_result_key(input_paths)
+            cached = lookup_cached_result(result_key)
         except Exception as e:
-            error_id, _ = log_detailed_error(e, "merge_videos", {
-                'video1_path': video1_path,
-                'video2_path': video2_path,
-                'merged_path': merged_path
+            logger.warning(f"⚠️ تعذر فحص كاش النتائج: {e}")
+            cached = None
+        if cached:
+            discard_inputs()
+            logger.info(f"♻️ ناتج موجود لنفس المحتوى: {cached['output_filename']}")
+            return jsonify({
+                'success': True,
+                'message': 'تمت معالجة نفس الفيديو سابقاً',
+                'download_url': f"/download/{cached['output_filename']}",
+                'filename': cached['output_filename'],
+                'cache': 'hit',
+                'mode': 'cached'
             })
-            logger.error(f"❌ خطأ في دالة دمج الفيديوهات [ID: {error_id}]: {str(e)}")
-            return None
 
-def cleanup_temp_files(video2_path, final_video_path, original_video_path):
-    """تنظيف مركزي مضمون للملفات المؤقتة"""
+    # تقدير زمن الترميز لكل مسار (يُحفظ مع المهمة للتوجيه والقبول)
+    estimate = None
     try:
-        if video2_path and final_video_path != original_video_path:
-            if os.path.exists(final_video_path):
-                os.unlink(final_video_path)
-                logger.info("🧹 تم تنظيف الملف المدموج المؤقت")
+        estimate = estimate_job_cost([get_video_info(path) for path in input_paths])
     except Exception as e:
-        logger.warning(f"⚠️ فشل في تنظيف الملف المؤقت: {str(e)}")
-
-@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
-def process_video_task(self, video_path, output_path, video2_path=None):
-    """مهمة Celery لمعالجة الفيديو"""
-    try:
-        # تحديث حالة المهمة
-        self.update_state(state='PROCESSING', meta={'progress': 10, 'status': 'بدء المعالجة...'})
-        
-        print("🔍 اختبار دعم GPU...")
-        gpu_supported = test_gpu_support()
-        
-        # تحديث التقدم
-        self.update_state(state='PROCESSING', meta={'progress': 20, 'status': 'فحص دعم GPU...'})
+        logger.warning(f"⚠️ تعذر تقدير تكلفة المهمة: {e}")
 
-        # دمج الفيديوهات إذا كان هناك فيديو ثاني
-        final_video_path = video_path
-        if video2_path:
-            print("🔗 دمج الفيديوهات...")
-            self.update_state(state='PROCESSING', meta={'progress': 30, 'status': 'دمج الفيديوهات...'})
-            merged_path = merge_videos(video_path, video2_path)
-            if merged_path:
-                final_video_path = merged_path
-            else:
-                print("⚠️ فشل دمج الفيديوهات، استخدام الفيديو الأول فقط")
+    # ناتج المعالجة
+    output_filename = f"output_{project_id}.mp4"
+    output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
 
-        # تحديث التقدم
-        self.update_state(state='PROCESSING', meta={'progress': 50, 'status': 'معالجة الفيديو...'})
-
-        if gpu_supported:
-            print("🚀 استخدام GPU (NVENC)...")
-            self.update_state(state='PROCESSING', meta={'progress': 60, 'status': 'معالجة بـ GPU...'})
-            if process_video_ffmpeg_gpu(final_video_path, output_path):
-                # تنظيف الملف المدموج المؤقت إذا كان موجوداً
-                if video2_path and final_video_path != video_path:
-                    try:
-                        os.unlink(final_video_path)
-                        print("🧹 تم تنظيف الملف المدموج المؤقت")
-                    except:
-                        pass
-                
-                self.update_state(state='SUCCESS', meta={'progress': 100, 'status': 'تمت المعالجة بنجاح!'})
-                return {'status': 'completed', 'output_path': output_path}
-            else:
-                print("⚠️ فشل GPU، الانتقال إلى CPU...")
+    # محاولة استخدام Celery، مع fallback للمعالجة المباشرة
+    inflight_key = None
+    scheduled = enqueued = False
+    try:
+        # فحص اتصال Redis أولاً
+        from redis import Redis
+        redis_url = os.environ.get("REDIS_URL", "redis://redis:6379/0")
+        r = Redis.from_url(redis_url, socket_connect_timeout=2)
+        r.ping()
 
-        print("🖥️ استخدام FFmpeg CPU كبديل...")
-        self.update_state(state='PROCESSING', meta={'progress': 70, 'status': 'معالجة بـ FFmpeg CPU...'})
-        result = process_video_fallback(final_video_path, output_path)
-        
-        # تنظيف مركزي مضمون
-        cleanup_temp_files(video2_path, final_video_path, video_path)
+        # نفس المحتوى قيد الترميز الآن؟ يُرفق الطلب بالمهمة الموجودة بدل ترميز ثانٍ
+        job_id = str(uuid.uuid4())
+        if result_key:
+            existing = claim_inflight_job(result_key, job_id, output_filename, INFLIGHT_LEASE)
+            if existing:
+                discard_inputs()
+                logger.info(f"🔗 رفع مكرر - إرفاق بالمهمة الجارية {existing['job_id']}")
+                return jsonify({
+                    'success': True,
+                    'job_id': existing['job_id'],
+                    'status': 'queued',
+                    'message': 'نفس الفيديو قيد المعالجة بالفعل',
+                    'output_filename': existing['output_filename'],
+                    'deduplicated': True,
+                    'mode': 'async'
+                })
+            inflight_key = result_key
         
-        if result:
-            self.update_state(state='SUCCESS', meta={'progress': 100, 'status': 'تمت المعالجة بنجاح!'})
-            return {'status': 'completed', 'output_path': output_path}
-        else:
-            raise Exception("فشل في معالجة الفيديو")
+        # إذا نجح الاتصال، استخدم Celery
+        queue = choose_job_queue(estimate, bool(video2_path))
+        admission = admit_job(estimate, queue)
+        if admission['action'] == 'defer':
+            if inflight_key:
+                release_inflight_job(inflight_key, job_id)
+            if not (streaming or keep_session):
+                shutil.rmtree(project_folder, ignore_errors=True)
+            return admission_rejected(admission)
+        output_profile = admission['output_profile']
+        if admission['action'] == 'downgrade':
+            logger.info(f"⬇️ تخفيض ملف الناتج إلى {output_profile}: {admission['reason']}")
 
-    except Exception as e:
-        error_id, error_details = log_detailed_error(e, "process_video_task", {
-            'video_path': video_path,
-            'output_path': output_path,
-            'video2_path': video2_path,
-            'task_id': self.request.id
-        })
-        
-        error_message = f"خطأ في المعالجة [ID: {error_id}]: {str(e)}"
-        logger.error(f"❌ {error_message}")
-        
-        self.update_state(
-            state='FAILURE', 
-            meta={
-                'progress': 0, 
-                'status': error_message,
-                'error_id': error_id,
-                'error_details': error_details,
-                'timestamp': datetime.datetime.now().isoformat()
-            }
-        )
-        raise
+        cost = get_queue_cost(estimate, queue)
+        if estimate and output_profile != OUTPUT_PROFILE_STANDARD:
+            cost = estimate['paths'][get_encoder_path_key(False, get_x264_preset(output_profile))]['seconds']
+        task_args = [video_path, output_path, video2_path, priority, estimate, output_profile, streaming]
+        if result_key and output_profile != OUTPUT_PROFILE_STANDARD:
+            result_key = get_result_key(input_paths, output_profile)
 
-def process_video_direct(video_path, output_path, video2_path=None):
-    """معالجة مباشرة بدون Celery (fallback mode)"""
-    try:
-        logger.info("🔍 بدء المعالجة المباشرة...")
+        # كل قيود المهمة تُسجل قبل أن يستلمها أي عامل
+        estimated_finish = estimate_edf_finish(queue, deadline, cost) if EDF_SCHEDULING else None
+        at_risk = estimated_finish is not None and estimated_finish > deadline
+        scheduled = True
+        record_job_deadline(job_id, deadline, sla_class, cost, at_risk)
+        if result_key:
+            remember_job_result_key(job_id, result_key, inflight_key)
+        backlog_add(job_id, queue, cost, video_path, output_path)
+        if EDF_SCHEDULING:
+            submit_edf_job(job_id, queue, task_args, deadline)
+        else:
+            process_video_task.apply_async(args=task_args, queue=queue, task_id=job_id)
+        enqueued = True
+        if at_risk:
+            logger.warning(f"⏰ المهمة {job_id} لن تلحق موعدها النهائي على الأرجح (طابور {queue})")
+        logger.info(f"✅ استخدام Celery - Task ID: {job_id} (طابور {queue})")
         
-        # دمج الفيديوهات إذا كان هناك فيديو ثاني
-        final_video_path = video_path
-        if video2_path:
-            logger.info("🔗 دمج الفيديوهات...")
-            merged_path = merge_videos(video_path, video2_path)
-            if merged_path:
-                final_video_path = merged_path
-            else:
-                logger.warning("⚠️ فشل دمج الفيديوهات، استخدام الفيديو الأول فقط")
-
-        # فحص GPU
-        gpu_supported = test_gpu_support()
-
-        if gpu_supported:
-            logger.info("🚀 استخدام GPU (NVENC)...")
-            if process_video_ffmpeg_gpu(final_video_path, output_path):
-                # تنظيف الملف المدموج المؤقت
-                if video2_path and final_video_path != video_path:
-                    try:
-                        os.unlink(final_video_path)
-                    except:
-                        pass
-                logger.info("✅ تمت المعالجة بنجاح باستخدام GPU!")
-                return True
-            else:
-                logger.warning("⚠️ فشل GPU، الانتقال إلى CPU...")
-
-        logger.info("🖥️ استخدام FFmpeg CPU...")
-        result = process_video_fallback(final_video_path, output_path)
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'message': 'تم بدء معالجة الفيديو باستخدام Celery',
+            'output_filename': output_filename,
+            'estimate': estimate,
+            'queue': queue,
+            'admission': admission['action'],
+            'output_profile': output_profile,
+            'deadline': datetime.datetime.fromtimestamp(deadline, datetime.timezone.utc).isoformat(),
+            'sla_class': sla_class,
+            'at_risk': at_risk,
+            'estimated_finish': (datetime.datetime.fromtimestamp(estimated_finish, datetime.timezone.utc).isoformat()
+                                 if estimated_finish else None),
+            'mode': 'async'
+        })
         
-        # تنظيف مركزي مضمون
-        cleanup_temp_files(video2_path, final_video_path, video_path)
+    except Exception as redis_error:
+        if enqueued:
+            # المهمة في الجدولة وقد يستلمها عامل: المعالجة المباشرة وحذف المدخلات يعنيان ترميزاً
+            # مزدوجاً أو عاملاً على ملفات محذوفة
+            error_id, _ = log_detailed_error(redis_error, "submit_saved_upload", {"job_id": job_id})
+            return jsonify({'error': f'تعذر إكمال إرسال المهمة [ID: {error_id}]', 'job_id': job_id}), 503
+        # Fallback: معالجة مباشرة بدون Celery
+        logger.warning(f"⚠️ فشل Celery، استخدام المعالجة المباشرة: {redis_error}")
+        if scheduled:
+            discard_job_schedule(job_id)
+        if inflight_key:
+            release_inflight_job(inflight_key, job_id)
+        if streaming:
+            return jsonify({'error': 'الترميز أثناء الرفع يحتاج Celery'}), 503
         
-        if result:
-            logger.info("✅ تمت المعالجة بنجاح باستخدام CPU!")
-            return True
+        # معالجة مباشرة (مع timeout أطول)
+        success = process_video_direct(video_path, output_path, video2_path)
 
-        return False
+    if success:
+            # تنظيف مجلد المشروع المؤقت
+        discard_inputs()
 
-    except Exception as e:
-        error_id, _ = log_detailed_error(e, "process_video_direct", {
-            'video_path': video_path,
-            'output_path': output_path,
-            'video2_path': video2_path
+        return jsonify({
+            'success': True,
+                'message': 'تمت معالجة الفيديو بنجاح (معالجة مباشرة)',
+            'download_url': f'/download/{output_filename}',
+                'filename': output_filename,
+                'estimate': estimate,
+                'merge_mode': success['merge_mode'],
+                'mode': 'direct'
         })
-        logger.error(f"❌ خطأ في المعالجة المباشرة [ID: {error_id}]: {str(e)}")
-        return False
-
-@app.route('/')
-def index():
-    return render_template('index.html')
+    else:
+        return jsonify({'error': 'فشل في معالجة الفيديو'}), 500
 
 @app.route('/upload', methods=['POST'])
 def upload_video():
     try:
+        # الملفات تُستقبل بالبث إلى مجلد المشروع عند أول وصول لـ request.files
+        try:
+            files = request.files
+        except UploadRejected as e:
+            discard_upload()
+            if e.decision:
+                return admission_rejected(e.decision)
+            logger.warning(f"🚫 رفض الرفع أثناء الاستقبال: {e}")
+            return jsonify({'error': str(e)}), e.status
+
         # تحقق من وجود ملف الفيديو الأول
-        if 'video' not in request.files:
-            return jsonify({'error': 'ملف الفيديو الأول مطلوب'}), 400
+        if 'video' not in files:
+            return reject_upload('ملف الفيديو الأول مطلوب')
 
-        video_file = request.files['video']
-        video2_file = request.files.get('video2')  # الفيديو الثاني اختياري
+        video_file = files['video']
+        video2_file = files.get('video2')  # الفيديو الثاني اختياري
 
         # تحقق من اسم الملف الأول
         if video_file.filename == '':
-            return jsonify({'error': 'يرجى اختيار ملف الفيديو الأول'}), 400
+            return reject_upload('يرجى اختيار ملف الفيديو الأول')
 
         # تحقق من امتداد الفيديو الأول
         if not allowed_file(video_file.filename, ALLOWED_EXTENSIONS):
-            return jsonify({'error': 'صيغة الفيديو الأول غير مدعومة'}), 400
-        
-        # حماية من الملفات الضخمة - تحقق من الحجم الفعلي
-        video_file.seek(0, 2)  # الانتقال لنهاية الملف
-        video_size = video_file.tell()
-        video_file.seek(0)  # العودة للبداية
-        
-        # حد أقصى 500MB لكل فيديو
-        max_size = 500 * 1024 * 1024
-        if video_size > max_size:
-            return jsonify({'error': f'حجم الفيديو الأول كبير جداً ({video_size // (1024*1024)}MB). الحد الأقصى 500MB'}), 400
-            
+            return reject_upload('صيغة الفيديو الأول غير مدعومة')
+
         # تحقق من الفيديو الثاني إذا كان موجوداً
         has_second_video = video2_file and video2_file.filename != ''
-        if has_second_video:
-            if not allowed_file(video2_file.filename, ALLOWED_EXTENSIONS):
-                return jsonify({'error': 'صيغة الفيديو الثاني غير مدعومة'}), 400
-            
-            # حماية من الملفات الضخمة - تحقق من الحجم الفعلي للفيديو الثاني
-            video2_file.seek(0, 2)  # الانتقال لنهاية الملف
-            video2_size = video2_file.tell()
-            video2_file.seek(0)  # العودة للبداية
-            
-            if video2_size > max_size:
-                return jsonify({'error': f'حجم الفيديو الثاني كبير جداً ({video2_size // (1024*1024)}MB). الحد الأقصى 500MB'}), 400
+        if has_second_video and not allowed_file(video2_file.filename, ALLOWED_EXTENSIONS):
+            return reject_upload('صيغة الفيديو الثاني غير مدعومة')
             
+        # الأولوية اختيارية (interactive / batch)، وإلا تُحدد حسب مدة الفيديو
+        priority = request.form.get('priority') or None
+        if priority and priority not in PRIORITY_CLASSES:
+            return reject_upload(f'أولوية غير معروفة: {priority}')
+
+        # الموعد النهائي اختياري (deadline أو sla_class)، وإلا DEFAULT_SLA_CLASS
+        try:
+            deadline, sla_class = parse_job_deadline(request.form)
+        except ValueError as e:
+            return reject_upload(str(e))
+
         # تحقق من وجود الملفات الثابتة
         if not os.path.exists(WATERMARK_PATH):
-            return jsonify({'error': 'العلامة المائية غير موجودة'}), 500
+            return reject_upload('العلامة المائية غير موجودة', 500)
         if not os.path.exists(OUTRO_PATH):
-            return jsonify({'error': 'الأوترو غير موجود'}), 500
+            return reject_upload('الأوترو غير موجود', 500)
 
-        # مشروع مؤقت بمعرف فريد
-        project_id = str(uuid.uuid4())
+        # مجلد المشروع أنشأه الاستقبال بالبث (معرفه هو معرف المشروع)
+        project_id = request.ingest_project_id or str(uuid.uuid4())
         project_folder = os.path.join(app.config['UPLOAD_FOLDER'], project_id)
         os.makedirs(project_folder, exist_ok=True)
 
-        # حفظ ملف الفيديو الأول
-        video_path = os.path.join(project_folder, secure_filename(video_file.filename))
-        video_file.save(video_path)
-        
-        # حفظ ملف الفيديو الثاني إذا كان موجوداً
-        video2_path = None
-        if has_second_video:
-            video2_path = os.path.join(project_folder, secure_filename(video2_file.filename))
-            video2_file.save(video2_path)
-
-        # ناتج المعالجة
-        output_filename = f"output_{project_id}.mp4"
-        output_path = os.path.join(app.config['OUTPUT_FOLDER'], output_filename)
-
-        # محاولة استخدام Celery، مع fallback للمعالجة المباشرة
+        # الملفات مكتوبة بالفعل: إعادة تسمية فقط (مع فحص بصمة الملفات القصيرة جداً)
         try:
-            # فحص اتصال Redis أولاً
-            from redis import Redis
-            redis_url = os.environ.get("REDIS_URL", "redis://redis:6379/0")
-            r = Redis.from_url(redis_url, socket_connect_timeout=2)
-            r.ping()
-            
-            # إذا نجح الاتصال، استخدم Celery
-            task = process_video_task.apply_async(args=[video_path, output_path, video2_path])
-            
-            logger.info(f"✅ استخدام Celery - Task ID: {task.id}")
-            
-            return jsonify({
-                'success': True,
-                'job_id': task.id,
-                'status': 'queued',
-                'message': 'تم بدء معالجة الفيديو باستخدام Celery',
-                'output_filename': output_filename,
-                'mode': 'async'
-            })
-            
-        except Exception as redis_error:
-            # Fallback: معالجة مباشرة بدون Celery
-            logger.warning(f"⚠️ فشل Celery، استخدام المعالجة المباشرة: {redis_error}")
-            
-            # معالجة مباشرة (مع timeout أطول)
-            success = process_video_direct(video_path, output_path, video2_path)
-
-        if success:
-                # تنظيف مجلد المشروع المؤقت
-            try:
-                shutil.rmtree(project_folder)
-            except Exception:
-                pass
+            video_path = save_ingested_file(video_file, project_folder)
+            video2_path = save_ingested_file(video2_file, project_folder) if has_second_video else None
+        except UploadRejected as e:
+            return reject_upload(str(e), e.status)
 
-            return jsonify({
-                'success': True,
-                    'message': 'تمت معالجة الفيديو بنجاح (معالجة مباشرة)',
-                'download_url': f'/download/{output_filename}',
-                    'filename': output_filename,
-                    'mode': 'direct'
-            })
-        else:
-            return jsonify({'error': 'فشل في معالجة الفيديو'}), 500
+        return submit_saved_upload(project_id, video_path, video2_path, priority, deadline, sla_class)
 
     except Exception as e:
         error_id, error_details = log_detailed_error(e, "upload_video", {
@@ -832,13 +3437,610 @@ def upload_video():
             'debug_info': error_details if app.config.get('DEBUG') else None
         }), 500
 
+# الرفع المجزأ القابل للاستئناف: إنشاء جلسة ← PUT أجزاء بإزاحاتها (بالتوازي وبأي ترتيب) ← إنهاء.
+# حالة الجلسة تُحفظ داخل مجلد المشروع في UPLOAD_FOLDER، فالانقطاع يعني إعادة الأجزاء الناقصة فقط
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+UPLOAD_SESSION_TTL = float(os.getenv('UPLOAD_SESSION_TTL', str(24 * 3600)))
+UPLOAD_SESSION_FILE = 'upload_session.json'
+UPLOAD_FIELDS = ('video', 'video2')
+
+_last_session_sweep = 0.0
+
+def get_upload_session_folder(upload_id):
+    """مجلد الجلسة (= مجلد المشروع)، أو None لمعرف غير صالح"""
+    try:
+        uuid.UUID(upload_id)
+    except ValueError:
+        return None
+    return os.path.join(app.config['UPLOAD_FOLDER'], upload_id)
+
+@contextlib.contextmanager
+def locked_upload_session(upload_id):
+    """
+    قراءة حالة الجلسة تحت قفل (الأجزاء المتوازية تحدّث نفس الملف) وحفظها عند الخروج.
+    يُعطي None إذا لم تكن الجلسة موجودة.
+    """
+    folder = get_upload_session_folder(upload_id)
+    session_path = os.path.join(folder, UPLOAD_SESSION_FILE) if folder else None
+    if not session_path or not os.path.exists(session_path):
+        yield None
+        return
+    with open(f"{session_path}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(session_path) as f:
+            session = json.load(f)
+        yield session
+        # المجلد قد يُحذف أثناء التسليم (ناتج من الكاش، مهمة مكررة، أو رفض)
+        if os.path.isdir(folder):
+            tmp_path = f"{session_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(session, f)
+            os.replace(tmp_path, session_path)
+
+def get_missing_chunks(entry):
+    chunks = max(1, -(-entry['size'] // entry['chunk_size']))
+    received = set(entry['received'])
+    return [i for i in range(chunks) if i not in received]
+
+def describe_upload_session(session):
+    return {
+        'upload_id': session['upload_id'],
+        'chunk_size': session['chunk_size'],
+        'files': {
+            field: {
+                'filename': entry['filename'],
+                'size': entry['size'],
+                'received': sorted(entry['received']),
+                'missing': get_missing_chunks(entry),
+            }
+            for field, entry in session['files'].items()
+        },
+        'streaming': (session.get('stream') or {}).get('state'),
+        'result': session.get('result'),
+    }
+
+def upload_session_closed(session):
+    """استجابة 410 لجلسة أُنهيت أو 409 لجلسة يجري إنهاؤها، أو None إذا كانت تقبل أجزاء"""
+    if session.get('result'):
+        return jsonify({'error': 'جلسة الرفع أُنهيت بالفعل'}), 410
+    if session.get('finalizing'):
+        return jsonify({'error': 'إنهاء الرفع جارٍ بالفعل'}), 409
+    return None
+
+@app.route('/uploads', methods=['POST'])
+def create_upload_session():
+    """
+    إنشاء جلسة رفع: {files: [{field, filename, size, sha256?}], priority?, sla_class?, deadline?}.
+    الحقول نفسها التي يقبلها /upload، وتُفحص هنا قبل رفع أي جزء.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        files = {item.get('field'): item for item in data.get('files') or [] if isinstance(item, dict)}
+        if 'video' not in files:
+            return jsonify({'error': 'ملف الفيديو الأول مطلوب'}), 400
+        for field, item in files.items():
+            if field not in UPLOAD_FIELDS:
+                return jsonify({'error': f'حقل غير معروف: {field}'}), 400
+            if not allowed_file(str(item.get('filename') or ''), ALLOWED_EXTENSIONS):
+                return jsonify({'error': f"صيغة الفيديو غير مدعومة: {item.get('filename')}"}), 400
+            size = item.get('size')
+            if not isinstance(size, int) or size <= 0:
+                return jsonify({'error': 'حجم الملف مطلوب'}), 400
+            if size > UPLOAD_MAX_FILE_SIZE:
+                return jsonify({'error': f'حجم الفيديو كبير جداً. الحد الأقصى {UPLOAD_MAX_FILE_SIZE // (1024 * 1024)}MB'}), 413
+
+        priority = data.get('priority') or None
+        if priority and priority not in PRIORITY_CLASSES:
+            return jsonify({'error': f'أولوية غير معروفة: {priority}'}), 400
+        try:
+            deadline, sla_class = parse_job_deadline({k: str(v) for k, v in data.items()
+                                                      if k in ('deadline', 'sla_class') and v})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # فئة SLA تُحسب من لحظة الإنهاء (مدة الرفع لا تُستقطع منها)، والموعد الصريح يبقى كما هو
+        if not data.get('deadline'):
+            deadline = None
+
+        if not os.path.exists(WATERMARK_PATH):
+            return jsonify({'error': 'العلامة المائية غير موجودة'}), 500
+        if not os.path.exists(OUTRO_PATH):
+            return jsonify({'error': 'الأوترو غير موجود'}), 500
+
+        disk_decision = check_disk_admission(sum(item['size'] for item in files.values()))
+        if disk_decision:
+            return admission_rejected(disk_decision)
+
+        upload_id = str(uuid.uuid4())
+        folder = get_upload_session_folder(upload_id)
+        os.makedirs(folder, exist_ok=True)
+        session = {
+            'upload_id': upload_id,
+            'chunk_size': UPLOAD_CHUNK_SIZE,
+            'created_at': time.time(),
+            'priority': priority,
+            'deadline': deadline,
+            'sla_class': sla_class,
+            'files': {},
+        }
+        for field, item in files.items():
+            part_path = os.path.join(folder, f'.ingest-{field}.part')
+            with open(part_path, 'wb') as f:
+                f.truncate(item['size'])
+            session['files'][field] = {
+                'filename': item['filename'],
+                'size': item['size'],
+                'sha256': (item.get('sha256') or '').lower() or None,
+                'chunk_size': UPLOAD_CHUNK_SIZE,
+                'part': os.path.basename(part_path),
+                'received': [],
+            }
+        with open(os.path.join(folder, UPLOAD_SESSION_FILE), 'w') as f:
+            json.dump(session, f)
+
+        sizes = ', '.join(f"{field}={item['size'] // (1024 * 1024)}MB" for field, item in files.items())
+        logger.info(f"📦 جلسة رفع {upload_id}: {sizes}")
+        return jsonify(describe_upload_session(session)), 201
+
+    except Exception as e:
+        error_id, _ = log_detailed_error(e, "create_upload_session", {'remote_addr': request.remote_addr})
+        return jsonify({'error': f'خطأ في إنشاء جلسة الرفع [ID: {error_id}]: {str(e)}', 'error_id': error_id}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload_session(upload_id):
+    """حالة الجلسة: الأجزاء المستلمة والناقصة (للاستئناف بعد انقطاع)"""
+    # قراءة فقط: بدون قفل ولا إعادة كتابة ملف الجلسة في كل استعلام
+    folder = get_upload_session_folder(upload_id)
+    session = read_upload_session(folder) if folder else None
+    if session is None:
+        return jsonify({'error': 'جلسة الرفع غير موجودة'}), 404
+    return jsonify(describe_upload_session(session))
+
+@app.route('/uploads/<upload_id>/<field>', methods=['PUT'])
+def upload_chunk(upload_id, field):
+    """
+    كتابة جزء عند ?offset= (مضاعف chunk_size). الترويسة X-Chunk-SHA256 اختيارية لفحص سلامة الجزء.
+    إعادة إرسال جزء مستلم آمنة (نفس البايتات في نفس المكان).
+    """
+    try:
+        folder = get_upload_session_folder(upload_id)
+        session_path = os.path.join(folder, UPLOAD_SESSION_FILE) if folder else None
+        if not session_path or not os.path.exists(session_path):
+            return jsonify({'error': 'جلسة الرفع غير موجودة'}), 404
+        with open(session_path) as f:
+            session = json.load(f)
+        entry = session['files'].get(field)
+        if entry is None:
+            return jsonify({'error': f'حقل غير معروف في الجلسة: {field}'}), 404
+        # بعد الإنهاء يُعاد تسمية ملف الأجزاء: جزء متأخر أو مُعاد لا مكان له
+        closed = upload_session_closed(session)
+        if closed:
+            return closed
+
+        offset = request.args.get('offset', type=int)
+        if offset is None or offset < 0 or offset >= entry['size'] or offset % entry['chunk_size']:
+            return jsonify({'error': 'إزاحة غير صالحة'}), 400
+        data = request.get_data(cache=False)
+        expected = min(entry['chunk_size'], entry['size'] - offset)
+        if len(data) != expected:
+            return jsonify({'error': f'طول الجزء {len(data)} بدلاً من {expected}'}), 400
+        checksum = request.headers.get('X-Chunk-SHA256')
+        if checksum and hashlib.sha256(data).hexdigest() != checksum.lower():
+            return jsonify({'error': 'المجموع الاختباري للجزء غير مطابق'}), 422
+        # أول جزء يحمل بصمة الحاوية: رفض الملفات غير المدعومة قبل رفع الباقي
+        if offset == 0 and detect_container(data[:CONTAINER_MAGIC_BYTES]) is None:
+            return jsonify({'error': 'محتوى الملف ليس فيديو بصيغة مدعومة'}), 400
+
+        try:
+            fd = os.open(os.path.join(folder, entry['part']), os.O_WRONLY)
+        except FileNotFoundError:
+            # الإنهاء سبق هذا الجزء بعد الفحص أعلاه
+            return upload_session_closed(read_upload_session(folder) or {'result': True})
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+
+        with locked_upload_session(upload_id) as session:
+            if session is None:
+                return jsonify({'error': 'جلسة الرفع غير موجودة'}), 404
+            entry = session['files'][field]
+            index = offset // entry['chunk_size']
+            if index not in entry['received']:
+                entry['received'].append(index)
+            missing = len(get_missing_chunks(entry))
+            start_stream = (STREAMING_INGEST and 'stream' not in session and missing
+                            and claim_streaming_start(session))
+            snapshot = session
+            streaming = (session.get('stream') or {}).get('state')
+
+        # فحص الحاوية وإرسال المهمة خارج القفل (الأجزاء الأخرى والحالة لا تنتظرهما)
+        if start_stream:
+            try:
+                stream = maybe_start_streaming_job(snapshot)
+            except Exception as e:
+                log_detailed_error(e, "maybe_start_streaming_job", {'upload_id': upload_id})
+                stream = {'state': 'unsupported', 'reason': 'error'}
+            with locked_upload_session(upload_id) as session:
+                # الإنهاء قد سبق المهمة وعالج الجلسة بالمسار العادي
+                superseded = session is None or (session.get('stream') or {}).get('state') != 'starting'
+                if not superseded:
+                    session['stream'] = stream
+            if superseded and stream['state'] == 'started':
+                cancel_streaming_job(stream['job_id'], 'الرفع أُنهي قبل تسجيل المهمة')
+                stream = session.get('stream') if session else None
+            streaming = (stream or {}).get('state')
+        return jsonify({'field': field, 'offset': offset, 'missing': missing, 'streaming': streaming})
+
+    except Exception as e:
+        error_id, _ = log_detailed_error(e, "upload_chunk", {
+            'upload_id': upload_id, 'field': field, 'offset': request.args.get('offset')
+        })
+        return jsonify({'error': f'خطأ في استلام الجزء [ID: {error_id}]: {str(e)}', 'error_id': error_id}), 500
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload_session(upload_id):
+    """
+    التحقق من اكتمال الأجزاء وSHA-256 والبصمة، ثم تسليم الملفات لمسار /upload نفسه.
+    تكرار الطلب بعد نجاحه يُرجع نفس النتيجة.
+    """
+    try:
+        with locked_upload_session(upload_id) as session:
+            if session is None:
+                return jsonify({'error': 'جلسة الرفع غير موجودة'}), 404
+            if session.get('result'):
+                return jsonify(session['result'])
+            if session.get('finalizing'):
+                return jsonify({'error': 'إنهاء الرفع جارٍ بالفعل'}), 409
+
+            missing = {field: get_missing_chunks(entry) for field, entry in session['files'].items()}
+            if any(missing.values()):
+                return jsonify({'error': 'الرفع غير مكتمل', 'missing': missing}), 409
+
+            stream = session.get('stream') or {}
+            # جزء سابق يرسل مهمة الترميز أثناء الرفع الآن (خارج القفل)
+            if stream.get('state') == 'starting':
+                if time.time() - stream['since'] < STREAMING_INGEST_START_WAIT:
+                    return jsonify({'error': 'بدء الترميز أثناء الرفع جارٍ، أعد المحاولة'}), 409, {'Retry-After': '1'}
+                stream = session['stream'] = {'state': 'unsupported', 'reason': 'start_timeout'}
+
+            # التحقق (SHA-256 لملف قد يبلغ MAX_CONTENT_LENGTH) والتسليم (وقد يكون معالجة مباشرة
+            # طويلة) يتمان خارج القفل، فالأجزاء المتأخرة وطلبات الحالة لا تُحجب
+            session['finalizing'] = time.time()
+            files = session['files']
+            priority, sla_class = session['priority'], session['sla_class']
+            deadline = session['deadline'] or time.time() + SLA_CLASSES[sla_class]
+
+        folder = get_upload_session_folder(upload_id)
+        result = None
+        try:
+            paths = {}
+            for field, entry in files.items():
+                part_path = os.path.join(folder, entry['part'])
+                paths[field] = os.path.join(folder, secure_filename(entry['filename']))
+                # إنهاء سابق نقل الملف ثم فشل التسليم: الملف سبق التحقق منه
+                if not os.path.exists(part_path) and os.path.exists(paths[field]):
+                    continue
+                digest = get_file_hash(part_path)
+                if entry['sha256'] and digest != entry['sha256']:
+                    if stream.get('state') == 'started':
+                        cancel_streaming_job(stream['job_id'], 'الملف المرفوع لم يطابق SHA-256')
+                    return jsonify({'error': f'SHA-256 للملف {entry["filename"]} غير مطابق'}), 422
+                with open(part_path, 'rb') as f:
+                    if detect_container(f.read(CONTAINER_MAGIC_BYTES)) is None:
+                        return jsonify({'error': 'محتوى الملف ليس فيديو بصيغة مدعومة'}), 400
+                # العامل الذي يرمّز أثناء الرفع فتح الملف مسبقاً فلا تؤثر عليه إعادة التسمية
+                os.replace(part_path, paths[field])
+                prime_file_hash(paths[field], digest)
+
+            # المهمة بدأت أثناء الرفع: تسجيل مفتاح الكاش الآن بعد أن أصبح المحتوى معروفاً.
+            # الحالة تُقرأ من جديد لأن العامل قد يعيد الجلسة للمسار العادي أثناء التحقق
+            stream = (read_upload_session(folder) or {}).get('stream') or {}
+            if stream.get('state') == 'started':
+                if RESULT_CACHE:
+                    remember_job_result_key(stream['job_id'], get_result_key(
+                        [paths['video']], stream['response'].get('output_profile') or OUTPUT_PROFILE_STANDARD))
+                result = stream['response']
+                logger.info(f"📦 اكتمل الرفع المجزأ {upload_id} (الترميز بدأ أثناء الرفع)")
+                return jsonify(result)
+
+            flask_response = app.make_response(submit_saved_upload(
+                upload_id, paths['video'], paths.get('video2'), priority, deadline, sla_class, keep_session=True))
+            if flask_response.status_code == 200:
+                result = flask_response.get_json()
+        finally:
+            with locked_upload_session(upload_id) as session:
+                if session is not None:
+                    session.pop('finalizing', None)
+                    if result is not None:
+                        session['result'] = result
+        logger.info(f"📦 اكتمل الرفع المجزأ {upload_id}")
+        return flask_response
+
+    except Exception as e:
+        error_id, _ = log_detailed_error(e, "finalize_upload_session", {'upload_id': upload_id})
+        return jsonify({'error': f'خطأ في إنهاء الرفع [ID: {error_id}]: {str(e)}', 'error_id': error_id}), 500
+
+def sweep_stale_upload_sessions():
+    """حذف جلسات الرفع غير المكتملة التي لم تُحدّث خلال UPLOAD_SESSION_TTL"""
+    global _last_session_sweep
+    now = time.time()
+    if now - _last_session_sweep < OUTPUT_SWEEP_INTERVAL:
+        return 0
+    _last_session_sweep = now
+    removed = 0
+    try:
+        with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+            for entry in entries:
+                session_path = os.path.join(entry.path, UPLOAD_SESSION_FILE)
+                try:
+                    # القفل يُلمس مع كل جزء، وقد لا يوجد إذا لم يصل أي جزء بعد
+                    touched = [os.path.getmtime(path) for path in (session_path, f"{session_path}.lock")
+                               if os.path.exists(path)]
+                    if not touched:
+                        continue
+                    stale = now - max(touched)
+                    with open(session_path) as f:
+                        finalized = bool(json.load(f).get('result'))
+                    # الجلسة المكتملة تبقى ما دامت مدخلاتها موجودة (المهمة قد لا تكون بدأت)
+                    removable = not finalized or all(name.startswith(UPLOAD_SESSION_FILE)
+                                                     for name in os.listdir(entry.path))
+                except (OSError, ValueError):
+                    continue
+                if removable and stale > UPLOAD_SESSION_TTL:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+    except OSError as e:
+        logger.warning(f"⚠️ تعذر تنظيف جلسات الرفع القديمة: {e}")
+    if removed:
+        logger.info(f"🧹 حُذفت {removed} جلسات رفع غير مكتملة")
+    return removed
+
+# الترميز أثناء الرفع: لجلسة بملف واحد في حاوية تُقرأ بالترتيب (MP4 بـ moov قبل mdat، MKV/WebM، TS)
+# تُرسل المهمة بمجرد وصول بداية متصلة كافية، ويقرأ FFmpeg الملف النامي عبر FIFO.
+# غير ذلك (أو عند فشل الترميز أثناء الرفع) تُعالج بالمسار العادي بعد الإنهاء
+STREAMING_INGEST = os.getenv('STREAMING_INGEST', 'true').lower() == 'true'
+STREAMING_INGEST_START_BYTES = int(os.getenv('STREAMING_INGEST_START_BYTES', str(16 * 1024 * 1024)))
+STREAMING_INGEST_STALL = float(os.getenv('STREAMING_INGEST_STALL', '300'))  # ثوانٍ بدون أجزاء جديدة
+STREAMING_INGEST_POLL = 0.5
+STREAMING_INGEST_START_WAIT = 2 * FFPROBE_TIMEOUT  # بعده يُعتبر إرسال المهمة متعثراً ويُنهى الرفع بالمسار العادي
+STREAMING_INGEST_READ_SIZE = 1024 * 1024
+
+class UploadStalled(Exception):
+    """الرفع توقف أثناء انتظار مهمة بدأت قبل اكتماله (أُعيدت الجلسة للمسار العادي)"""
+
+def read_upload_session(folder):
+    """حالة الجلسة بدون قفل (تُحفظ بـ os.replace فلا تُقرأ نصف مكتوبة)، أو None"""
+    try:
+        with open(os.path.join(folder, UPLOAD_SESSION_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_contiguous_bytes(entry):
+    """عدد البايتات المستلمة المتصلة من بداية الملف"""
+    received = set(entry['received'])
+    index = 0
+    while index in received:
+        index += 1
+    return min(index * entry['chunk_size'], entry['size'])
+
+def is_streamable_container(head):
+    """
+    هل يمكن فك ترميز الحاوية من بدايتها بالترتيب؟ في MP4/MOV يجب أن يسبق moov الصندوق mdat
+    (None إذا لم تكفِ البايتات للحكم).
+    """
+    container = detect_container(head)
+    if container in ('matroska', 'mpegts'):
+        return True
+    if container != 'mp4':
+        return False
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], 'big')
+        box = head[offset + 4:offset + 8]
+        if box == b'moov':
+            return True
+        if box == b'mdat':
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                return None
+            size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        if size < 8:
+            return False
+        offset += size
+    return None
+
+def claim_streaming_start(session):
+    """
+    هل وصلت بداية متصلة كافية لبدء الترميز أثناء الرفع؟ يُستدعى تحت قفل الجلسة
+    ويسجل session['stream'] = starting (فلا يبدأ جزء متوازٍ آخر مهمة ثانية) أو unsupported.
+    """
+    if list(session['files']) != ['video']:
+        session['stream'] = {'state': 'unsupported', 'reason': 'multiple_inputs'}
+        return False
+    if get_contiguous_bytes(session['files']['video']) < STREAMING_INGEST_START_BYTES:
+        return False
+    session['stream'] = {'state': 'starting', 'since': time.time()}
+    return True
+
+def maybe_start_streaming_job(session):
+    """
+    إرسال مهمة الترميز قبل اكتمال الرفع لحاوية قابلة للبث (بعد claim_streaming_start).
+    يُستدعى خارج القفل بنسخة من الجلسة ويُرجع قرار session['stream'] (started / unsupported).
+    """
+    entry = session['files']['video']
+    available = get_contiguous_bytes(entry)
+    upload_id = session['upload_id']
+    part_path = os.path.join(get_upload_session_folder(upload_id), entry['part'])
+    with open(part_path, 'rb') as f:
+        head = f.read(STREAMING_INGEST_START_BYTES)
+    if not is_streamable_container(head):
+        logger.info(f"📦 {upload_id}: الحاوية لا تُقرأ بالترتيب، الترميز بعد اكتمال الرفع")
+        return {'state': 'unsupported', 'reason': 'container'}
+
+    deadline = session['deadline'] or time.time() + SLA_CLASSES[session['sla_class']]
+    response = app.make_response(submit_saved_upload(upload_id, part_path, None, session['priority'],
+                                                     deadline, session['sla_class'], streaming=True))
+    result = response.get_json() or {}
+    if response.status_code != 200 or not result.get('job_id'):
+        return {'state': 'unsupported', 'reason': result.get('error') or response.status_code}
+    logger.info(f"🌊 {upload_id}: بدء الترميز أثناء الرفع ({available // (1024 * 1024)}MB من "
+                f"{entry['size'] // (1024 * 1024)}MB) - المهمة {result['job_id']}")
+    return {'state': 'started', 'job_id': result['job_id'], 'response': result}
+
+def cancel_streaming_job(job_id, reason):
+    """إلغاء مهمة بدأت أثناء الرفع (فشل التحقق من الملف المكتمل، أو سبقها الإنهاء)"""
+    request_job_cancel(job_id)
+    celery.control.revoke(job_id)
+    backlog_remove(job_id)
+    edf_cancel(job_id)
+    logger.warning(f"🛑 إلغاء المهمة {job_id}: {reason}")
+
+class GrowingUpload:
+    """
+    ملف رفع مجزأ ما زال يصل. يُفتح مرة واحدة (فلا تؤثر إعادة تسميته عند الإنهاء)،
+    وpath يشير إلى الواصف المفتوح لـ ffprobe. feed() يمرر البداية المتصلة المستلمة
+    إلى FFmpeg عبر FIFO وينتظر الأجزاء التالية حتى آخر الملف، ثم يضع deadline
+    (الحد الأقصى لإنهاء الترميز حسب مدة الملف المكتمل).
+    """
+    def __init__(self, part_path, fd):
+        self.folder = os.path.dirname(part_path)
+        self.part = os.path.basename(part_path)
+        self.fd = fd
+        self.path = f"/proc/{os.getpid()}/fd/{fd}"
+        self.fifo_dir = tempfile.mkdtemp(prefix='ingest-')
+        self.fifo_path = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.fed = 0
+        self.complete = False
+        self.deadline = None
+
+    def get_entry(self):
+        session = read_upload_session(self.folder)
+        if session is None:
+            return None
+        return next((entry for entry in session['files'].values() if entry['part'] == self.part), None)
+
+    def feed(self):
+        """FIFO جديد يُمرر إلى FFmpeg بدل مسار الملف (لكل محاولة ترميز)"""
+        self.stop()
+        self.stopped.clear()
+        self.fed = 0
+        self.complete = False
+        self.deadline = None
+        self.fifo_path = os.path.join(self.fifo_dir, f'ingest-{uuid.uuid4().hex}.fifo')
+        os.mkfifo(self.fifo_path)
+        self.thread = threading.Thread(target=self._feed, args=(self.fifo_path,), daemon=True)
+        self.thread.start()
+        return self.fifo_path
+
+    def _feed(self, fifo_path):
+        try:
+            # open يُحجب حتى يفتح FFmpeg الـ FIFO للقراءة
+            with open(fifo_path, 'wb') as pipe:
+                while not self.stopped.is_set():
+                    entry = self.get_entry()
+                    if entry is None:
+                        logger.warning("⚠️ جلسة الرفع لم تعد موجودة أثناء الترميز")
+                        return
+                    available = get_contiguous_bytes(entry)
+                    while self.fed < available and not self.stopped.is_set():
+                        data = os.pread(self.fd, min(STREAMING_INGEST_READ_SIZE, available - self.fed), self.fed)
+                        if not data:
+                            return
+                        pipe.write(data)
+                        self.fed += len(data)
+                    if self.fed >= entry['size']:
+                        self.complete = True
+                        break
+                    self.stopped.wait(STREAMING_INGEST_POLL)
+        except OSError as e:
+            # FFmpeg أُنهي (فشل، توقف، إلغاء) قبل قراءة كل الملف
+            logger.warning(f"⚠️ توقف تمرير الملف النامي إلى FFmpeg: {e}")
+            return
+        if self.complete:
+            # بعد إغلاق الـ FIFO (نهاية الملف لـ FFmpeg): المدة الحقيقية للملف المكتمل
+            info = get_video_info(self.path)
+            duration = float((info or {}).get('format', {}).get('duration') or 0)
+            self.deadline = time.time() + encode_time_limit(duration)
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        if self.thread.is_alive():
+            # فك حجب open إذا لم يفتح FFmpeg الـ FIFO أبداً
+            try:
+                os.close(os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        self.thread.join(timeout=5)
+        self.thread = None
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def open_growing_upload(part_path):
+    """GrowingUpload إذا كان الرفع ما زال جارياً، أو None إذا أُنهي (الملف أُعيدت تسميته)"""
+    try:
+        fd = os.open(part_path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    return GrowingUpload(part_path, fd)
+
+def wait_for_upload(part_path, job):
+    """
+    انتظار إنهاء الرفع المجزأ (اكتمال الأجزاء والتحقق منها) ثم مسار الملف النهائي.
+    إذا لم يصل جزء جديد خلال STREAMING_INGEST_STALL تُعاد الجلسة للمسار العادي (UploadStalled).
+    """
+    folder = os.path.dirname(part_path)
+    part = os.path.basename(part_path)
+    received = None
+    progressed_at = time.time()
+    while True:
+        job.check_cancelled()
+        job.renew_lease()
+        session = read_upload_session(folder)
+        if session is None:
+            raise Exception("جلسة الرفع لم تعد موجودة")
+        if session.get('result'):
+            entry = next(entry for entry in session['files'].values() if entry['part'] == part)
+            return os.path.join(folder, secure_filename(entry['filename']))
+        count = sum(len(entry['received']) for entry in session['files'].values())
+        # التحقق من الملف المكتمل (SHA-256) يجري خارج القفل ولا يُعد توقفاً للرفع
+        if count != received or session.get('finalizing'):
+            received = count
+            progressed_at = time.time()
+        elif time.time() - progressed_at > STREAMING_INGEST_STALL:
+            with locked_upload_session(os.path.basename(folder)) as session:
+                stalled = session is not None and not session.get('result') and not session.get('finalizing')
+                if stalled:
+                    session['stream'] = {'state': 'unsupported', 'reason': 'stalled'}
+            if stalled:
+                raise UploadStalled("توقف الرفع، سيُعالج الفيديو بعد اكتماله")
+            continue
+        time.sleep(STREAMING_INGEST_POLL)
+
 @app.route('/status/<task_id>')
 def task_status(task_id):
     """تتبع حالة مهمة معالجة الفيديو"""
     try:
         task = process_video_task.AsyncResult(task_id)
         
-        if task.state == 'PENDING':
+        if task.state == 'CANCELLED' or (task.state in ('PENDING', 'PROCESSING', 'STARTED', 'FAILURE', 'REVOKED')
+                                         and is_job_cancelled(task_id)):
+            response = {
+                'state': 'CANCELLED',
+                'status': 'تم إلغاء المعالجة',
+                'progress': 0
+            }
+        elif task.state == 'PENDING':
             response = {
                 'state': task.state,
                 'status': 'في الانتظار...',
@@ -848,7 +4050,10 @@ def task_status(task_id):
             response = {
                 'state': task.state,
                 'status': task.info.get('status', 'جاري المعالجة...'),
-                'progress': task.info.get('progress', 0)
+                'progress': task.info.get('progress', 0),
+                'eta_seconds': task.info.get('eta_seconds'),
+                'fps': task.info.get('fps'),
+                'speed': task.info.get('speed')
             }
         elif task.state == 'SUCCESS':
             response = {
@@ -864,6 +4069,14 @@ def task_status(task_id):
                 'progress': 0,
                 'error': str(task.info)
             }
+
+        deadline_info = get_job_deadline(task_id)
+        if deadline_info:
+            response.update({
+                'deadline': datetime.datetime.fromtimestamp(deadline_info['deadline'], datetime.timezone.utc).isoformat(),
+                'sla_class': deadline_info['sla_class'],
+                'at_risk': deadline_info['at_risk'],
+            })
         
         return jsonify(response)
     
@@ -882,6 +4095,56 @@ def task_status(task_id):
             'timestamp': datetime.datetime.now().isoformat()
         }), 500
 
+@app.route('/jobs/<task_id>', methods=['DELETE'])
+@app.route('/cancel/<task_id>', methods=['POST'])
+def cancel_job(task_id):
+    """
+    إلغاء مهمة: المهام في الطابور تُلغى (revoke)، والمهام قيد التشغيل يرى عاملها
+    علامة الإلغاء فيقتل عمليات FFmpeg وينظف الملفات خلال ثوانٍ.
+    """
+    try:
+        task = process_video_task.AsyncResult(task_id)
+        if task.state in ('SUCCESS', 'FAILURE'):
+            return jsonify({
+                'error': 'لا يمكن إلغاء مهمة منتهية',
+                'state': task.state
+            }), 409
+
+        request_job_cancel(task_id)
+        celery.control.revoke(task_id)
+        queued = backlog_pop(task_id)
+        edf_cancel(task_id)
+        release_job_inflight(task_id)
+        logger.info(f"🛑 طلب إلغاء المهمة {task_id} (الحالة: {task.state})")
+
+        # مهمة لم يبدأها عامل (في الطابور أو في جدولة EDF) لن تُنفذ لتنظف ملفاتها بنفسها
+        if queued and queued.get('video_path'):
+            mark_job_cancelled(None, queued['video_path'], queued.get('output_path'), job_id=task_id)
+            return jsonify({
+                'success': True,
+                'job_id': task_id,
+                'state': 'CANCELLED',
+                'message': 'تم إلغاء المعالجة'
+            })
+
+        return jsonify({
+            'success': True,
+            'job_id': task_id,
+            'state': 'CANCELLING',
+            'message': 'تم طلب إلغاء المعالجة'
+        }), 202
+
+    except Exception as e:
+        error_id, _ = log_detailed_error(e, "cancel_job", {
+            'task_id': task_id,
+            'remote_addr': request.remote_addr
+        })
+        logger.error(f"❌ خطأ في إلغاء المهمة [ID: {error_id}]: {str(e)}")
+        return jsonify({
+            'error': f'خطأ في إلغاء المهمة [ID: {error_id}]: {str(e)}',
+            'error_id': error_id
+        }), 500
+
 @app.route('/download/<filename>')
 def download_file(filename):
     """تحميل آمن للملفات"""
@@ -967,6 +4230,9 @@ def health_check():
         'status': 'healthy',
         'redis': redis_status,
         'celery': celery_status,
+        'workers': get_live_workers() if 'connected' in redis_status else [],
+        'backlog': get_queue_backlog() if 'connected' in redis_status else {},
+        'result_cache': get_result_cache_stats() if 'connected' in redis_status else {},
         'upload_folder': app.config['UPLOAD_FOLDER'],
         'output_folder': app.config['OUTPUT_FOLDER'],
         'assets': {
@@ -1096,10 +4362,22 @@ def get_memory_info():
 def test_gpu():
     """نقطة فحص دعم GPU"""
     try:
+        if request.args.get('refresh', '').lower() in ('1', 'true'):
+            refresh_ffmpeg_capabilities()
         gpu_supported = test_gpu_support()
+        caps = get_ffmpeg_capabilities()
         return jsonify({
             'gpu_supported': gpu_supported,
-            'message': 'GPU مدعوم' if gpu_supported else 'GPU غير مدعوم'
+            'message': 'GPU مدعوم' if gpu_supported else 'GPU غير مدعوم',
+            'capabilities': {
+                'ffmpeg_version': caps['ffmpeg_version'],
+                'nvenc_encoder': caps['nvenc_encoder'],
+                'hwaccels': caps['hwaccels'],
+                'encoders_count': len(caps['encoders']),
+                'filters_count': len(caps['filters']),
+                'probed_at': datetime.datetime.fromtimestamp(caps['probed_at']).isoformat(),
+                'ttl_seconds': FFMPEG_CAPS_TTL
+            }
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -200,18 +200,23 @@ uploadForm.addEventListener("submit", async function (e) {
     // سيتم تتبع التقدم الحقيقي من Celery
 
     const API_BASE = window.API_BASE || "http://localhost:5000";
-    console.log("Uploading to:", `${API_BASE}/upload`);
+    console.log("Uploading to:", `${API_BASE}/uploads`);
 
-    const response = await fetch(`${API_BASE}/upload`, {
-      method: "POST",
-      body: formData,
-      headers: {
-        // لا نضع Content-Type لأن FormData يضعه تلقائياً
-      },
-    });
+    // رفع مجزأ قابل للاستئناف، ثم الإنهاء يُرجع نفس استجابة /upload
+    const response = await uploadResumable(API_BASE, formData);
 
     console.log("Response status:", response.status);
 
+    if (response.status === 429) {
+      // الخادم مزدحم - retry_after بالثواني
+      const result = await response.json();
+      showError(
+        `${result.error} (بعد ${formatEta(result.retry_after || 60)})`,
+        result
+      );
+      return;
+    }
+
     if (!response.ok) {
       throw new Error(`HTTP ${response.status}: ${response.statusText}`);
     }
@@ -224,9 +229,9 @@ uploadForm.addEventListener("submit", async function (e) {
         // معالجة غير متزامنة مع Celery
         console.log("🔄 استخدام Celery للمعالجة غير المتزامنة");
         trackJobProgress(result.job_id, result.output_filename);
-      } else if (result.mode === "direct") {
-        // معالجة مباشرة مكتملة
-        console.log("✅ معالجة مباشرة مكتملة");
+      } else if (result.mode === "direct" || result.mode === "cached") {
+        // معالجة مباشرة مكتملة، أو ناتج سابق لنفس الفيديو
+        console.log(`✅ الناتج جاهز (${result.mode})`);
         showResult(result);
       } else {
         // حالة غير معروفة
@@ -259,6 +264,173 @@ uploadForm.addEventListener("submit", async function (e) {
   }
 });
 
+// الرفع المجزأ: أجزاء متوازية بإزاحاتها، وإعادة المحاولة للجزء الفاشل فقط
+const UPLOAD_PARALLEL = 3;
+const UPLOAD_RETRIES = 5;
+const FINALIZE_RETRIES = 30;
+
+// SHA-256 للجزء (crypto.subtle متاح فقط في السياقات الآمنة، وإلا يُرفع بدون فحص)
+async function sha256Hex(buffer) {
+  if (!window.crypto || !window.crypto.subtle) {
+    return null;
+  }
+  const digest = await window.crypto.subtle.digest("SHA-256", buffer);
+  return Array.from(new Uint8Array(digest))
+    .map((b) => b.toString(16).padStart(2, "0"))
+    .join("");
+}
+
+// مفتاح الجلسة المحفوظة: نفس الملفات (الاسم والحجم وتاريخ التعديل) تستأنف نفس الجلسة
+function uploadSessionKey(files) {
+  return (
+    "upload:" +
+    Object.entries(files)
+      .map(([field, file]) => `${field}=${file.name}:${file.size}:${file.lastModified}`)
+      .join("|")
+  );
+}
+
+async function uploadResumable(API_BASE, formData) {
+  const files = {};
+  const fields = {};
+  for (const [name, value] of formData.entries()) {
+    if (value instanceof File) {
+      if (value.size > 0) files[name] = value;
+    } else if (value) {
+      fields[name] = value;
+    }
+  }
+
+  // استئناف جلسة سابقة لنفس الملفات إن وُجدت
+  const storageKey = uploadSessionKey(files);
+  let session = null;
+  const savedId = localStorage.getItem(storageKey);
+  if (savedId) {
+    const response = await fetch(`${API_BASE}/uploads/${savedId}`);
+    if (response.ok) {
+      session = await response.json();
+      console.log("♻️ استئناف رفع سابق:", savedId);
+    } else {
+      localStorage.removeItem(storageKey);
+    }
+  }
+
+  if (!session) {
+    const response = await fetch(`${API_BASE}/uploads`, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        ...fields,
+        files: Object.entries(files).map(([field, file]) => ({
+          field,
+          filename: file.name,
+          size: file.size,
+        })),
+      }),
+    });
+    if (response.status !== 201) {
+      return response;
+    }
+    session = await response.json();
+    localStorage.setItem(storageKey, session.upload_id);
+  }
+
+  // الأجزاء الناقصة فقط
+  const chunkSize = session.chunk_size;
+  const pending = [];
+  let totalBytes = 0;
+  let sentBytes = 0;
+  for (const [field, info] of Object.entries(session.files)) {
+    totalBytes += info.size;
+    sentBytes += info.size;
+    for (const index of info.missing) {
+      const offset = index * chunkSize;
+      const length = Math.min(chunkSize, info.size - offset);
+      sentBytes -= length;
+      pending.push({ field, offset, length });
+    }
+  }
+  // الخادم قد يبدأ الترميز قبل اكتمال الرفع (حاويات قابلة للبث)، لذا تُرفع الأجزاء بالترتيب
+  let uploadStatus = session.streaming === "started" ? "جاري الرفع والترميز..." : "جاري الرفع...";
+  updateProgress((sentBytes / totalBytes) * 100, uploadStatus);
+
+  async function uploadChunk(chunk) {
+    const buffer = await files[chunk.field]
+      .slice(chunk.offset, chunk.offset + chunk.length)
+      .arrayBuffer();
+    const checksum = await sha256Hex(buffer);
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const response = await fetch(
+          `${API_BASE}/uploads/${session.upload_id}/${chunk.field}?offset=${chunk.offset}`,
+          {
+            method: "PUT",
+            headers: checksum ? { "X-Chunk-SHA256": checksum } : {},
+            body: buffer,
+          }
+        );
+        if (response.ok) {
+          const result = await response.json();
+          if (result.streaming === "started") {
+            uploadStatus = "جاري الرفع والترميز...";
+          }
+          return;
+        }
+        // أخطاء 4xx (عدا فشل المجموع الاختباري) لن تتغير بإعادة المحاولة
+        if (response.status < 500 && response.status !== 422) {
+          const result = await response.json().catch(() => ({}));
+          if (response.status === 404) {
+            localStorage.removeItem(storageKey);
+          }
+          throw Object.assign(
+            new Error(result.error || `HTTP ${response.status}`),
+            { fatal: true }
+          );
+        }
+      } catch (error) {
+        if (error.fatal || attempt >= UPLOAD_RETRIES) {
+          throw error;
+        }
+      }
+      await new Promise((resolve) => setTimeout(resolve, 1000 * 2 ** attempt));
+    }
+  }
+
+  async function worker() {
+    while (pending.length) {
+      const chunk = pending.shift();
+      await uploadChunk(chunk);
+      sentBytes += chunk.length;
+      updateProgress((sentBytes / totalBytes) * 100, uploadStatus);
+    }
+  }
+  await Promise.all(Array.from({ length: UPLOAD_PARALLEL }, worker));
+
+  updateProgress(100, "جاري التحقق من الملف...");
+  // 409 مع Retry-After: الترميز المتدفق ما زال يبدأ، يُعاد الإنهاء بعد المهلة
+  let response;
+  for (let attempt = 0; ; attempt++) {
+    response = await fetch(
+      `${API_BASE}/uploads/${session.upload_id}/finalize`,
+      { method: "POST" }
+    );
+    const retryAfter = parseFloat(response.headers.get("Retry-After"));
+    if (
+      response.status !== 409 ||
+      !(retryAfter >= 0) ||
+      attempt >= FINALIZE_RETRIES
+    ) {
+      break;
+    }
+    await new Promise((resolve) => setTimeout(resolve, retryAfter * 1000));
+  }
+  // 409 (أجزاء ناقصة أو إنهاء جارٍ) و429 (الخادم مشغول) تُعاد على نفس الجلسة
+  if (response.status !== 409 && response.status !== 429) {
+    localStorage.removeItem(storageKey);
+  }
+  return response;
+}
+
 // Validate form
 function validateForm() {
   const video = videoInput.files[0];
@@ -292,6 +464,27 @@ function updateProgress(percentage, status = null) {
   }
 }
 
+// Format ETA seconds as m:ss / h:mm:ss
+function formatEta(seconds) {
+  const h = Math.floor(seconds / 3600);
+  const m = Math.floor((seconds % 3600) / 60);
+  const s = Math.floor(seconds % 60);
+  const pad = (n) => String(n).padStart(2, "0");
+  return h > 0 ? `${h}:${pad(m)}:${pad(s)}` : `${m}:${pad(s)}`;
+}
+
+// Build processing status text with real encode speed and ETA
+function formatProcessingStatus(status) {
+  let text = status.status || "جاري المعالجة...";
+  if (status.speed) {
+    text += ` (${status.speed}x)`;
+  }
+  if (status.eta_seconds !== null && status.eta_seconds !== undefined) {
+    text += ` - متبقٍ ${formatEta(status.eta_seconds)}`;
+  }
+  return text;
+}
+
 // Track job progress
 async function trackJobProgress(jobId, outputFilename) {
   const pollInterval = 2000; // 2 seconds
@@ -316,7 +509,7 @@ async function trackJobProgress(jobId, outputFilename) {
       if (status.state === "PENDING") {
         updateProgress(5, "في الانتظار...");
       } else if (status.state === "PROCESSING") {
-        updateProgress(status.progress || 0, status.status);
+        updateProgress(status.progress || 0, formatProcessingStatus(status));
       } else if (status.state === "SUCCESS") {
         updateProgress(100, "تمت المعالجة بنجاح!");
         showResult({
@@ -326,6 +519,9 @@ async function trackJobProgress(jobId, outputFilename) {
           filename: outputFilename,
         });
         return; // Stop polling
+      } else if (status.state === "CANCELLED") {
+        showError("تم إلغاء المعالجة");
+        return; // Stop polling
       } else {
         // FAILURE or other error states
         showError(status.status || status.error || "حدث خطأ في المعالجة");